@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures how Google Drive uploads scale with the number of upload workers sharing a pool of API clients.
+
+Uploads go to a local fake Drive HTTP server answering the folder listing and resumable upload sessions after a fixed
+latency, so no credentials or network access are needed. Usage:
+
+    python benchmarks/drive_pool.py [--latency 0.05] [--uploads 64] [--workers 1 2 4 8 16]
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sys
+import tempfile
+from threading import Thread
+from time import perf_counter, sleep
+
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from httplib2 import Http
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from music2storage.googledrive import DriveClientPool, GoogleDrive
+
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    """Answers the Drive v3 requests made by GoogleDrive.upload after the latency of the server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, body, headers=None):
+        sleep(self.server.latency)
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.reply({'files': [{'id': 'music-folder'}]})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply({}, headers={'Location': f"http://127.0.0.1:{self.server.server_address[1]}/upload-session"})
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply({'id': 'file-id'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(latency):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeDriveHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_drive(endpoint, pool_size):
+    # The discovery document bundled with the client, pointed at the fake server (media uploads keep the scheme of rootUrl)
+    document = get_static_doc('drive', 'v3').replace('https://www.googleapis.com/', endpoint)
+    drive = GoogleDrive(pool_size=pool_size)
+    drive.pool = DriveClientPool(lambda: build_from_document(document, http=Http()), size=pool_size)
+    return drive
+
+
+def measure(endpoint, file_name, uploads, workers):
+    drive = make_drive(endpoint, workers)
+    start = perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        locations = list(executor.map(lambda _: drive.upload(file_name), range(uploads)))
+    elapsed = perf_counter() - start
+    assert locations == ['file-id'] * uploads
+    return {
+        'workers': workers,
+        'uploads': uploads,
+        'seconds': round(elapsed, 4),
+        'uploads_per_second': round(uploads / elapsed, 1),
+        'clients': drive.pool.created,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds taken by the fake server to answer every request')
+    parser.add_argument('--uploads', type=int, default=64, help='Number of uploads per run')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='Numbers of upload workers to run')
+    args = parser.parse_args()
+
+    server = start_server(args.latency)
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}/"
+    with tempfile.NamedTemporaryFile(suffix='.mp3') as track:
+        track.write(os.urandom(64 * 1024))
+        track.flush()
+        results = [measure(endpoint, track.name, args.uploads, workers) for workers in args.workers]
+    server.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
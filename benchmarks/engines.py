@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compares Music2Storage with AsyncMusic2Storage on network-bound downloads.
+
+Both engines download the same MP3 files from a local HTTP server, running in its own process, that waits for a fixed latency before
+answering every request. The threaded engine downloads with RangedDownloader on its worker threads, the asyncio engine with
+AsyncRangedDownloader on its event loop. The files are MP3, so no conversion runs, and uploads are simulated with blocking sleeps,
+which the asyncio engine runs on its pool of threads. Memory is the peak Python heap measured with tracemalloc, which leaves out
+thread stacks, so the peak number of threads, sampled while the items run, is reported too. The asyncio engine needs aiohttp. Usage:
+
+    python benchmarks/engines.py [--latency 0.05] [--size 65536] [--items 10 100 500] [--workers 8] [--engines threaded asyncio]
+"""
+
+import argparse
+import asyncio
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib.util import find_spec
+import json
+from multiprocessing import Process, Queue
+import os
+import re
+import sys
+import tempfile
+import threading
+import tracemalloc
+from time import perf_counter, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from music2storage import Music2Storage
+from music2storage.aio import AsyncMusic2Storage
+from music2storage.downloader import RangedDownloader, resize_session
+from music2storage.service import MusicService, StorageService
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Serves size bytes at every path, with ranges, after waiting for the latency of the server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        sleep(self.server.latency)
+        size = self.server.size
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        start, end = (int(match.group(1)), min(int(match.group(2)), size - 1)) if match else (0, size - 1)
+        self.send_response(206 if match else 200)
+        if match:
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.end_headers()
+        self.wfile.write(bytes(end + 1 - start))
+
+    def log_message(self, *args):
+        pass
+
+
+class MediaServer(ThreadingHTTPServer):
+    """Server of the media, ignoring the connections the clients drop when they are done."""
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(latency, size, ports):
+    server = MediaServer(('127.0.0.1', 0), MediaHandler)
+    server.latency = latency
+    server.size = size
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeMusicService(MusicService):
+    """Music service that downloads from the benchmark server, or waits for a fixed latency instead without one."""
+
+    def __init__(self, latency, server=None):
+        self.name = 'fake'
+        self.latency = latency
+        self.server = server
+        self.downloader = RangedDownloader(progress_bar=False)
+
+    def set_pool_size(self, size):
+        resize_session(self.downloader.session, size * self.downloader.connections)
+
+    def locate(self, url, fresh=False):
+        if self.server is None:
+            return super().locate(url, fresh)
+        name = url.rsplit('/', 1)[-1]
+        return f"{self.server}/{name}", name + '.mp3', 'mp3'
+
+    def download(self, url, directory=''):
+        if self.server is None:
+            sleep(self.latency)
+            return url.rsplit('/', 1)[-1] + '.mp3'
+        media_url, name, _ = self.locate(url)
+        return self.downloader.download(media_url, os.path.join(directory, name))
+
+    def codec(self, file_name):
+        return 'mp3'
+
+
+class FakeStorageService(StorageService):
+    """Storage service that waits for a fixed latency instead of uploading."""
+
+    def __init__(self, latency):
+        self.name = 'fake'
+        self.latency = latency
+
+    def connect(self):
+        pass
+
+    def upload(self, file_name):
+        sleep(self.latency)
+        return file_name
+
+
+class ThreadSampler(threading.Thread):
+    """Samples the number of threads of the process until stopped, keeping the peak."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = threading.active_count()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(0.005):
+            self.peak = max(self.peak, threading.active_count())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak - 1
+
+
+def run_threaded(items, latency, workers, server):
+    m2s = Music2Storage()
+    m2s.connection_handler.current_music = FakeMusicService(latency, server)
+    m2s.connection_handler.current_storage = FakeStorageService(latency)
+
+    m2s.start_workers(pool_sizes=dict.fromkeys(('download', 'convert', 'upload', 'delete'), workers))
+    m2s.connection_handler.current_music.set_pool_size(workers)
+    jobs = [m2s.add_to_queue(f"http://example.com/{i}") for i in range(items)]
+    for job in jobs:
+        job.result()
+
+    m2s.stopper.set()
+    for worker in list(m2s.workers):
+        worker.stop()
+    for worker in list(m2s.workers):
+        worker.join()
+
+
+def run_async(items, latency, workers, server):
+    loop = asyncio.new_event_loop()
+    m2s = AsyncMusic2Storage(concurrency={'download': workers, 'convert': workers, 'upload': workers, 'delete': workers,
+                                          'pending': items, 'threads': min(workers, 32)}, loop=loop)
+    m2s.connection_handler.current_music = FakeMusicService(latency, server)
+    m2s.connection_handler.current_storage = FakeStorageService(latency)
+
+    async def run():
+        try:
+            jobs = [await m2s.add_to_queue(f"http://example.com/{i}") for i in range(items)]
+            await asyncio.gather(*jobs)
+        finally:
+            await m2s.close()
+    loop.run_until_complete(run())
+    loop.close()
+
+
+def measure(engine, items, latency, workers, server):
+    tracemalloc.start()
+    sampler = ThreadSampler()
+    sampler.start()
+    start = perf_counter()
+    engine(items, latency, workers or items, server)
+    elapsed = perf_counter() - start
+    peak_threads = sampler.stop()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'items': items,
+        'workers': workers or items,
+        'seconds': round(elapsed, 4),
+        'items_per_second': round(items / elapsed, 1),
+        'peak_memory_bytes': peak_memory,
+        'peak_threads': peak_threads,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds taken by every request to the server and every upload')
+    parser.add_argument('--size', type=int, default=64 * 1024, help='Size of every downloaded file in bytes')
+    parser.add_argument('--items', type=int, nargs='+', default=[10, 100, 500], help='Numbers of items to run')
+    parser.add_argument('--workers', type=int, help='Number of items in each stage at once (optional, every item by default)')
+    parser.add_argument('--engines', nargs='+', choices=['threaded', 'asyncio'], default=['threaded', 'asyncio'],
+                        help='Engines to compare')
+    args = parser.parse_args()
+    if 'asyncio' in args.engines and find_spec('aiohttp') is None:
+        parser.error("the asyncio engine downloads with aiohttp: pip install music2storage[async]")
+
+    ports = Queue()
+    process = Process(target=serve, args=(args.latency, args.size, ports), daemon=True)
+    process.start()
+    server = f"http://127.0.0.1:{ports.get()}"
+    engines = {'threaded': run_threaded, 'asyncio': run_async}
+
+    results = []
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            for items in args.items:
+                for name in args.engines:
+                    results.append(dict(engine=name, **measure(engines[name], items, args.latency, args.workers, server)))
+            os.chdir(cwd)
+    finally:
+        process.terminate()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures the latency of single-track requests while another tenant's bulk backlog goes through the same pipeline.
+
+One tenant adds a backlog of tracks at once, then other tenants add single tracks at a steady rate until the backlog is done.
+Downloads and uploads are simulated with sleeps, like in benchmarks/engines.py. Each scheduling mode runs the same load:
+plain FIFO queues, fair queuing between tenants, fair queuing with a higher priority for the single tracks, and fair
+queuing with a cap on the bulk tenant's downloads. The latency of a track runs from add_to_queue until its job finishes. Usage:
+
+    python benchmarks/fairness.py [--latency 0.02] [--backlog 400] [--interval 0.05] [--workers 4]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+from time import perf_counter, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engines import FakeMusicService, FakeStorageService
+
+from music2storage import Music2Storage
+
+MODES = {
+    'fifo': {'tenants': False, 'priority': 0, 'options': {}},
+    'fair': {'tenants': True, 'priority': 0, 'options': {}},
+    'fair+priority': {'tenants': True, 'priority': 1, 'options': {}},
+    'fair+caps': {'tenants': True, 'priority': 0, 'options': {'tenant_caps': {'download': 2}}},
+}
+"""Whether jobs carry tenants, priority of the single tracks, and options of Music2Storage, by scheduling mode."""
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run(mode, latency, backlog, interval, workers):
+    settings = MODES[mode]
+    m2s = Music2Storage(**settings['options'])
+    m2s.connection_handler.current_music = FakeMusicService(latency)
+    m2s.connection_handler.current_storage = FakeStorageService(latency)
+    m2s.start_workers(workers)
+
+    start = perf_counter()
+    bulk = [m2s.add_to_queue(f"http://example.com/bulk/{i}", tenant='bulk' if settings['tenants'] else None)
+            for i in range(backlog)]
+    singles = []
+    while not all(job.done() for job in bulk):
+        i = len(singles)
+        singles.append(m2s.add_to_queue(f"http://example.com/single/{i}", priority=settings['priority'],
+                                        tenant=f'user-{i}' if settings['tenants'] else None))
+        sleep(interval)
+    for job in singles:
+        job.result()
+    elapsed = perf_counter() - start
+
+    m2s.stopper.set()
+    for worker in list(m2s.workers):
+        worker.stop()
+    for worker in list(m2s.workers):
+        worker.join()
+
+    single_latency = [job.finished_at - job.created_at for job in singles]
+    bulk_latency = [job.finished_at - job.created_at for job in bulk]
+    return {
+        'mode': mode,
+        'singles': len(singles),
+        'single_p50': round(statistics.median(single_latency), 3),
+        'single_p99': round(percentile(single_latency, 0.99), 3),
+        'bulk_finished_after': round(max(bulk_latency), 3),
+        'seconds': round(elapsed, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds taken by every simulated download and upload')
+    parser.add_argument('--backlog', type=int, default=400, help='Number of tracks added at once by the bulk tenant')
+    parser.add_argument('--interval', type=float, default=0.05, help='Seconds between two single tracks')
+    parser.add_argument('--workers', type=int, default=4, help='Number of workers per stage')
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    args = parser.parse_args()
+
+    results = [run(mode, args.latency, args.backlog, args.interval, args.workers) for mode in args.modes]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures the cold-start cost of importing music2storage with different combinations of service backends.
+
+Every run is a fresh interpreter that imports music2storage, then the modules of the backends of the combination, the way
+ConnectionHandler does on first use of a service. The import time is measured inside the interpreter and the wall time of the
+whole process outside of it, and the number of modules loaded is counted. Usage:
+
+    python benchmarks/imports.py [--runs 5]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMBINATIONS = {
+    'none': [],
+    'local': ['music2storage.localstorage'],
+    'soundcloud+local': ['music2storage.soundcloud', 'music2storage.localstorage'],
+    'youtube+local': ['music2storage.youtube', 'music2storage.localstorage'],
+    'soundcloud+google drive': ['music2storage.soundcloud', 'music2storage.googledrive'],
+    'all': ['music2storage.youtube', 'music2storage.soundcloud', 'music2storage.googledrive', 'music2storage.localstorage'],
+}
+"""Backend modules imported by every combination."""
+
+SCRIPT = '''
+import json, sys
+from importlib import import_module
+from time import perf_counter
+start = perf_counter()
+import music2storage
+for module in sys.argv[1:]:
+    import_module(module)
+print(json.dumps({'seconds': perf_counter() - start, 'modules': len(sys.modules)}))
+'''
+
+
+def measure(modules, runs):
+    import_times, wall_times, counts = [], [], []
+    for _ in range(runs):
+        start = perf_counter()
+        output = subprocess.run([sys.executable, '-c', SCRIPT] + modules, cwd=ROOT, stdout=subprocess.PIPE, check=True).stdout
+        wall_times.append(perf_counter() - start)
+        result = json.loads(output.decode())
+        import_times.append(result['seconds'])
+        counts.append(result['modules'])
+    return {
+        'import_seconds': round(statistics.median(import_times), 4),
+        'process_seconds': round(statistics.median(wall_times), 4),
+        'modules': max(counts),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='Number of fresh interpreters per combination, the median is reported')
+    args = parser.parse_args()
+
+    results = [dict(backends=name, **measure(modules, args.runs)) for name, modules in COMBINATIONS.items()]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
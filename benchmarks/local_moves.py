@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures the throughput of batch imports into local storage, from a scratch folder to a Music folder.
+
+Every strategy moves the same batch of files with a number of upload workers: shutil.move, alone and followed by an fsync of every
+file and of the folder, then LocalStorage.upload flushing every file as it is stored, in batches, or never. The scratch folder
+defaults to /dev/shm, so that the moves cross filesystems like they do with a workspace on a tmpfs; pass the same filesystem for
+both to measure renames. Usage:
+
+    python benchmarks/local_moves.py [--source /dev/shm] [--destination /tmp] [--files 200] [--size 4] [--workers 4]
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import shutil
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from music2storage.localstorage import LocalStorage
+
+
+def fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def shutil_move(music, sync):
+    def move(file_name):
+        destination = shutil.move(file_name, os.path.join(music, os.path.basename(file_name)))
+        if sync:
+            fsync(destination)
+            fsync(music)
+    return move, lambda: None
+
+
+def local_storage(music, sync_every):
+    storage = LocalStorage(custom_path=music, sync_every=sync_every)
+    return storage.upload, storage.flush
+
+
+STRATEGIES = {
+    'shutil.move': lambda music: shutil_move(music, False),
+    'shutil.move+fsync': lambda music: shutil_move(music, True),
+    'local sync_every=0': lambda music: local_storage(music, 0),
+    'local sync_every=64': lambda music: local_storage(music, 64),
+    'local sync_every=None': lambda music: local_storage(music, None),
+}
+"""Function moving a file into the Music folder, and function flushing at the end of the batch, by strategy."""
+
+
+def run(strategy, source, destination, files, size, workers):
+    scratch = tempfile.mkdtemp(dir=source)
+    music = tempfile.mkdtemp(dir=destination)
+    try:
+        block = os.urandom(1024 * 1024)
+        names = []
+        for i in range(files):
+            name = os.path.join(scratch, f'track {i}.mp3')
+            with open(name, 'wb') as f:
+                for _ in range(size):
+                    f.write(block)
+            names.append(name)
+
+        move, flush = STRATEGIES[strategy](music)
+        start = perf_counter()
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(move, names))
+        flush()
+        seconds = perf_counter() - start
+        assert len(os.listdir(music)) == files
+        return {
+            'strategy': strategy,
+            'seconds': round(seconds, 3),
+            'files_per_second': round(files / seconds, 1),
+            'mb_per_second': round(files * size / seconds, 1),
+        }
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+        shutil.rmtree(music, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--source', default='/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                        help='Folder where the scratch files are written')
+    parser.add_argument('--destination', default=tempfile.gettempdir(), help='Folder where the Music folder is created')
+    parser.add_argument('--files', type=int, default=200, help='Number of files in the batch')
+    parser.add_argument('--size', type=int, default=4, help='Size of every file in MB')
+    parser.add_argument('--workers', type=int, default=4, help='Number of upload workers')
+    parser.add_argument('--strategies', nargs='+', default=list(STRATEGIES), choices=list(STRATEGIES))
+    args = parser.parse_args()
+
+    same_filesystem = os.stat(args.source).st_dev == os.stat(args.destination).st_dev
+    results = [run(strategy, args.source, args.destination, args.files, args.size, args.workers) for strategy in args.strategies]
+    print(json.dumps({'same_filesystem': same_filesystem, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures the throughput of the whole pipeline, from download to storage, against local stand-in services.
+
+Tracks are sample media generated by FFmpeg and served by a local HTTP server that serves ranges, downloaded by a music service
+using the ranged downloader, converted by the real FFmpeg, and stored either in a local directory or through the fake Drive
+server of drive_pool.py. Every scenario runs in its own process, so its peak RSS is its own. The scratch disk high-water mark
+is the largest space taken by the files in the working directory of the scenario, sampled while it runs. Usage:
+
+    python benchmarks/pipeline.py [--workers 1 2 4] [--durations 30 240] [--items 16] [--storage local drive] [--codec aac]
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from threading import Event, Thread
+from time import perf_counter, sleep
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from drive_pool import make_drive, start_server as start_drive_server
+from music2storage import Music2Storage
+from music2storage.downloader import RangedDownloader
+from music2storage.localstorage import LocalStorage
+from music2storage.service import MusicService
+
+
+CODECS = {
+    'aac': ('m4a', ['-codec:a', 'aac', '-b:a', '128k']),
+    'opus': ('webm', ['-codec:a', 'libopus', '-b:a', '128k']),
+    'mp3': ('mp3', ['-codec:a', 'libmp3lame', '-b:a', '128k']),
+}
+"""Extension and FFmpeg encoding options of the sample media, by audio codec."""
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Serves the files of the media directory of the server, in ranges when asked for."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = os.path.join(self.server.directory, os.path.basename(self.path.split('?')[0]))
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            self.send_error(404)
+            return
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        start, end = 0, size - 1
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end + 1 - start
+            while remaining:
+                data = f.read(min(remaining, 256 * 1024))
+                self.wfile.write(data)
+                remaining -= len(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_media_server(directory):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    server.daemon_threads = True
+    server.directory = directory
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class LocalMediaService(MusicService):
+    """Music service downloading the media of the local media server, every URL into a file of its own."""
+
+    def __init__(self, codec, connections=4):
+        self.name = 'bench'
+        self.audio_codec = codec
+        self.downloader = RangedDownloader(requests.Session(), connections=connections, segment_size=1024 * 1024,
+                                           progress_bar=False)
+
+    def download(self, url, directory=None):
+        media, track = url.rsplit('/', 1)[-1].split('?track=')
+        file_name = os.path.join(directory or '', f"{track}-{media}")
+        return self.downloader.download(url, file_name)
+
+    def codec(self, file_name):
+        return self.audio_codec
+
+    def track_id(self, url):
+        return url
+
+
+class DiskSampler(Thread):
+    """Samples the space taken by the files of a directory, keeping the largest value seen."""
+
+    def __init__(self, directory, interval=0.05):
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.interval = interval
+        self.peak = 0
+        self.stopper = Event()
+
+    def sample(self):
+        total = 0
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_blocks * 512
+            except OSError:
+                pass
+        self.peak = max(self.peak, total)
+
+    def run(self):
+        while not self.stopper.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopper.set()
+        self.join()
+        self.sample()
+
+
+def make_media(directory, duration, codec):
+    """Generates a sine wave of the given duration in seconds, encoded with the codec, and returns its filename."""
+
+    extension, options = CODECS[codec]
+    file_name = os.path.join(directory, f"sample-{duration}s.{extension}")
+    if not os.path.exists(file_name):
+        cmd = ['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}",
+               '-vn'] + options + [file_name]
+        subprocess.run(cmd, check=True)
+    return file_name
+
+
+def run_scenario(scenario):
+    """Runs one scenario in the current process and returns its results."""
+
+    scratch = tempfile.mkdtemp(prefix='m2s-scratch-')
+    output = tempfile.mkdtemp(prefix='m2s-output-')
+    media_server = start_media_server(os.path.dirname(scenario['media']))
+    os.chdir(scratch)
+
+    m2s = Music2Storage(metrics=True)
+    m2s.connection_handler.current_music = LocalMediaService(scenario['codec'])
+    drive_server = None
+    if scenario['storage'] == 'drive':
+        drive_server = start_drive_server(scenario['latency'])
+        m2s.connection_handler.current_storage = make_drive(f"http://127.0.0.1:{drive_server.server_address[1]}/",
+                                                            scenario['workers'])
+    else:
+        m2s.connection_handler.current_storage = LocalStorage(output)
+
+    sampler = DiskSampler(scratch)
+    sampler.start()
+    url = f"http://127.0.0.1:{media_server.server_address[1]}/{os.path.basename(scenario['media'])}"
+    start = perf_counter()
+    m2s.start_workers(scenario['workers'])
+    jobs = [m2s.add_to_queue(f"{url}?track={i}") for i in range(scenario['items'])]
+    while any(job.stage not in ('done', 'failed') for job in jobs):
+        sleep(0.01)
+    elapsed = perf_counter() - start
+    sampler.stop()
+
+    m2s.stopper.set()
+    for worker in list(m2s.workers):
+        worker.stop()
+    for worker in list(m2s.workers):
+        worker.join()
+    stats = m2s.stats()
+    media_server.shutdown()
+    if drive_server is not None:
+        drive_server.shutdown()
+    shutil.rmtree(scratch, ignore_errors=True)
+    shutil.rmtree(output, ignore_errors=True)
+
+    done = sum(1 for job in jobs if job.stage == 'done')
+    return dict(scenario, **{
+        'media_bytes': os.path.getsize(scenario['media']),
+        'done': done,
+        'failed': len(jobs) - done,
+        'seconds': round(elapsed, 4),
+        'tracks_per_minute': round(done / elapsed * 60, 1),
+        'stages': {stage: {'p50': round(metrics['latency']['p50'], 4), 'p99': round(metrics['latency']['p99'], 4),
+                           'errors': metrics['errors']} for stage, metrics in stats['stages'].items()},
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'peak_ffmpeg_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        'scratch_high_water_bytes': sampler.peak,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='Numbers of workers per task to run')
+    parser.add_argument('--durations', type=int, nargs='+', default=[30, 240], help='Durations in seconds of the sample tracks')
+    parser.add_argument('--items', type=int, nargs='+', default=[16], help='Numbers of tracks per run')
+    parser.add_argument('--storage', nargs='+', default=['local', 'drive'], choices=['local', 'drive'], help='Storage services')
+    parser.add_argument('--codec', default='aac', choices=sorted(CODECS), help='Audio codec of the sample tracks')
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds taken by the fake Drive server to answer every request')
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        print(json.dumps(run_scenario(json.loads(args.scenario))))
+        return
+
+    if shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None:
+        sys.exit('FFmpeg and FFprobe must be installed to run the pipeline benchmark.')
+
+    media_directory = tempfile.mkdtemp(prefix='m2s-media-')
+    results = []
+    try:
+        for duration in args.durations:
+            media = make_media(media_directory, duration, args.codec)
+            for storage in args.storage:
+                for workers in args.workers:
+                    for items in args.items:
+                        scenario = {'storage': storage, 'workers': workers, 'items': items, 'duration': duration,
+                                    'codec': args.codec, 'media': media, 'latency': args.latency}
+                        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--scenario', json.dumps(scenario)],
+                                                stdout=subprocess.PIPE, check=True).stdout
+                        results.append(json.loads(output.decode().strip().splitlines()[-1]))
+    finally:
+        shutil.rmtree(media_directory, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
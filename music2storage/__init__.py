@@ -4,129 +4,809 @@ import logging
 
 log = logging.getLogger(__name__)
 
-from queue import Queue
+import os
 import signal
-from threading import Event
+from functools import wraps
+from threading import Event, Lock, Thread
 
+from music2storage.completions import Completions
 from music2storage.connection import ConnectionHandler
-from music2storage.helpers import convert_to_mp3, delete_local_file
+from music2storage.helpers import convert_to_mp3, delete_local_file, transcode_stream, TranscodedStream
+from music2storage.index import TrackIndex
+from music2storage.job import Job, STAGES
+from music2storage.jobstore import JobStore
+from music2storage.metrics import Metrics, MetricsServer
+from music2storage.pool import Autoscaler, WorkerPool
+from music2storage.queues import StageQueue
+from music2storage.scheduler import ConversionScheduler
+from music2storage.service import GuardedRequests
 from music2storage.signalhandler import SignalHandler
-from music2storage.worker import Worker
+from music2storage.workspace import Sweeper, Workspace
 
 
 class Music2Storage:
     """Manages workers, queues, services for music2storage."""
 
-    def __init__(self):
-        """Initializes all the queues and sets default values for services and workers."""
+    def __init__(self, job_store=None, track_index=None, queue_sizes=None, max_conversions=None, streaming=False,
+                 streaming_upload=False, mp3_preset=None, metrics=False, workspace=None, disk_budget=None, completions=1000,
+                 tenant_weights=None, tenant_caps=None):
+        """
+        Initializes all the queues and sets default values for services and workers.
+
+        Bounded queues apply backpressure: when a stage falls behind, the workers of the stage before it (and add_to_queue, for the
+        download queue) wait for room instead of piling up files on disk.
+
+        :param str job_store: Path to a SQLite file where jobs are persisted so they can be resumed after a restart (optional)
+        :param str track_index: Path to a SQLite file where stored tracks are indexed so they are never processed twice (optional)
+        :param dict queue_sizes: Maximum number of items in the queue of specific stages, e.g. {'convert': 10} (optional, unbounded by
+                                 default)
+        :param int max_conversions: Maximum number of FFmpeg processes converting files at once (optional, defaults to the workers
+                                    converting files, at most one per core). Conversions piped to or from the network are paced by
+                                    the transfer, so they run one FFmpeg thread each without waiting for a slot
+        :param bool streaming: Pipes downloads straight into FFmpeg, so the original file never touches local storage and jobs skip
+                               the convert stage
+        :param bool streaming_upload: Feeds the output of FFmpeg straight into the storage service, so the MP3 file never touches local
+                                      storage and jobs skip the upload stage
+        :param str mp3_preset: MP3 encoding preset used when audio has to be transcoded, one of helpers.MP3_PRESETS such as 'v0'
+                               or '320k' (optional, FFmpeg defaults otherwise)
+        :param bool metrics: Measures the latency, throughput and errors of every stage and the bytes transferred, reported by stats
+                             and metrics_text. Queue depths and service stats are reported either way
+        :param str workspace: Scratch directory where every job downloads and converts its files in a directory of its own, which
+                              may be on a tmpfs such as /dev/shm (optional, files go to the current directory by default)
+        :param int disk_budget: Maximum number of bytes taken by the workspace; downloads wait for finished jobs to free space once it
+                                is reached (optional, unlimited by default)
+        :param int completions: Number of finished jobs kept for completed to replay, the oldest ones being dropped past it
+        :param dict tenant_weights: Share of every queue of specific tenants relative to the others, e.g. {'radio': 3} (optional, tenants
+                                    share queues equally by default)
+        :param dict tenant_caps: Maximum number of jobs of any one tenant in specific stages at once, e.g. {'download': 4, 'convert': 2}
+                                 (optional, unlimited by default). The download cap counts the downloads of every music service together,
+                                 unless a service has a cap of its own under 'download:<service name>'. Jobs without a tenant are never
+                                 capped
+        """
 
-        self.queues = {
-            'download': Queue(),
-            'convert': Queue(),
-            'upload': Queue(),
-            'delete': Queue(),
-            'done': Queue(),
-        }
+        self.queue_sizes = queue_sizes or {}
+        self.tenant_weights = tenant_weights or {}
+        self.tenant_caps = tenant_caps or {}
+        self.queues = {stage: self._new_queue(stage) for stage in STAGES[:-1]}
+        self.completions = Completions(completions)
 
         self.connection_handler = ConnectionHandler()
         self.workers = []
+        self.pools = {}
+        self.pool_sizes = {}
+        self.routing_lock = Lock()
+        self.expanders = []
+        self.expanders_lock = Lock()
+        self.autoscaler = None
         self.stopper = Event()
         self.signal_handler = None
-
-    def add_to_queue(self, url):
+        self.job_store = JobStore(job_store) if job_store else None
+        self.track_index = TrackIndex(track_index) if track_index else None
+        self.in_flight = {}
+        self.in_flight_lock = Lock()
+        self.converter = ConversionScheduler(max_jobs=max_conversions)
+        self.streaming = streaming
+        self.streaming_upload = streaming_upload
+        self.mp3_preset = mp3_preset
+        self.metrics = Metrics() if metrics else None
+        self.metrics_server = None
+        self.workspace = Workspace(workspace, budget=disk_budget) if workspace else None
+        self.sweeper = None
+
+    def add_to_queue(self, url, priority=0, tenant=None):
         """
-        Adds an URL to the download queue.
+        Adds an URL to the download queue of the music service it points to.
+
+        URLs are routed by host to every music service used so far, each with its own download queue and workers. URLs matching none
+        of them go to the current music service, through the shared download queue. If the track was already stored, the job is
+        finished right away from the track index. If the same track is already in the pipeline, the job waits for that run to finish
+        instead of starting a new one.
+
+        Playlist URLs are expanded in the background, their tracks added one by one as the pages of the playlist are fetched. Adding
+        waits for room in a bounded download queue, so the expansion of a long playlist never runs far ahead of the downloads.
 
-        :param str url: URL to the music service track
+        Every queue takes the jobs with the highest priority first, then shares its workers fairly between tenants, so that the single
+        tracks of one user don't wait behind the playlists of another.
+
+        The job is a handle on the outcome of the track: job.result() waits for it and returns where the track was stored, and
+        coroutines can await the job the same way.
+
+        :param str url: URL to the music service track or playlist
+        :param int priority: Priority of the job, or of the jobs of every track of a playlist, higher priorities being taken first
+        :param str tenant: Key of the user or client adding the URL (optional)
+        :return: Job created for the URL, a list filled with the jobs of the tracks of a playlist as it is expanded, or None if it was
+                 not added
         """
 
-        if self.connection_handler.current_music is None:
+        music = self.connection_handler.music_for(url)
+        if music is None:
             log.error('Music service is not initialized. URL was not added to queue.')
         elif self.connection_handler.current_storage is None:
             log.error('Drive service is not initialized. URL was not added to queue.')
+        elif music.is_playlist(url):
+            return self._add_playlist(music, url, priority, tenant)
         else:
-            self.queues['download'].put(url)
+            job, new = self._admit(music, url, priority, tenant)
+            if new:
+                self._download_queue(job).put(job)
+            return job
+
+    def _admit(self, music, url, priority=0, tenant=None):
+        """
+        Creates the job of a track, finishing it right away from the track index, or attaching it to the run of the same track already
+        in the pipeline. Otherwise the job is recorded in the job store, and is left for the caller to put in its download queue.
+
+        :param MusicService music: Music service of the track
+        :param str url: URL of the track
+        :param int priority: Priority of the job
+        :param str tenant: Key of the user or client adding the track (optional)
+        :return tuple: Job of the track, and whether it has to be downloaded
+        """
+
+        job = Job(url, track_id=music.track_id(url), priority=priority, tenant=tenant)
+
+        if self.track_index is not None:
+            location = self.track_index.get(self.connection_handler.current_storage.name, job.track_id)
+            if location is not None:
+                log.info(f"{url} is already stored at {location}, skipping it.")
+                job.location = location
+                job.advance('done')
+                self._complete(job)
+                return job, False
+
+        with self.in_flight_lock:
+            key = self._in_flight_key(job)
+            if key in self.in_flight:
+                log.info(f"{url} is already in the pipeline, waiting for it to finish.")
+                self.in_flight[key].append(job)
+                return job, False
+            self.in_flight[key] = []
+
+        if self.job_store is not None:
+            self.job_store.add(job)
+        return job, True
+
+    def _add_playlist(self, music, url, priority=0, tenant=None):
+        """
+        Starts a thread adding the tracks of the playlist to the queue as the playlist is expanded.
+
+        :param MusicService music: Music service of the playlist
+        :param str url: URL of the playlist
+        :param int priority: Priority of the jobs of the tracks
+        :param str tenant: Key of the user or client adding the playlist (optional)
+        :return list: Jobs of the tracks added so far, appended to by the thread
+        """
+
+        jobs = []
+
+        def expand():
+            count = 0
+            try:
+                for track_url in music.expand(url):
+                    if self.stopper.is_set():
+                        break
+                    job = self.add_to_queue(track_url, priority, tenant)
+                    if job is not None:
+                        jobs.append(job)
+                    count += 1
+            except Exception:
+                log.exception(f"Expansion of {url} has failed after {count} tracks")
+            else:
+                log.info(f"Expansion of {url} has finished with {count} tracks")
+            finally:
+                with self.expanders_lock:
+                    self.expanders.remove(expander)
+
+        expander = Thread(target=expand, name=f"expand {url}", daemon=True)
+        with self.expanders_lock:
+            self.expanders.append(expander)
+        expander.start()
+        return jobs
+
+    def wait_for_expansions(self, timeout=None):
+        """
+        Waits until every playlist added so far is fully expanded into the queue, as well as the jobs resumed from the job store.
+
+        :param float timeout: Maximum number of seconds to wait for each playlist (optional, waits as long as needed by default)
+        """
+
+        with self.expanders_lock:
+            expanders = list(self.expanders)
+        for expander in expanders:
+            expander.join(timeout)
+
+    def completed(self, timeout=None, replay=False):
+        """
+        Follows the jobs as they finish or fail, whatever added them. Only the latest jobs are kept, so memory stays flat when nothing
+        follows them, and a follower that falls too far behind skips the jobs dropped meanwhile.
 
-    def use_music_service(self, service_name, api_key=None):
+        :param float timeout: Seconds without any job finishing after which the iteration stops (optional, follows forever by default)
+        :param bool replay: Starts with the finished jobs that were kept, rather than with the next job to finish
+        :return: Iterator over finished jobs, with their location, timings and error
         """
-        Sets the current music service to service_name.
+
+        return self.completions.follow(timeout, replay)
+
+    def on_completion(self, callback):
+        """
+        Calls the callback with every job that finishes or fails from now on, e.g. to send a notification.
+
+        :param callback: Function taking the job as its only argument, called from the worker thread finishing the job
+        """
+
+        self.completions.subscribe(callback)
+
+    def use_music_service(self, service_name, api_key=None, **options):
+        """
+        Sets the current music service to service_name. Services used before keep receiving the URLs of their hosts.
         
         :param str service_name: Name of the music service
         :param str api_key: Optional API key if necessary
+        :param options: Options passed to the music service when it is created (e.g. max_abr=128 for youtube)
         """
 
-        self.connection_handler.use_music_service(service_name, api_key=api_key)
+        self.connection_handler.use_music_service(service_name, api_key=api_key, **options)
 
-    def use_storage_service(self, service_name, custom_path=None):
+    def use_storage_service(self, service_name, custom_path=None, **options):
         """
         Sets the current storage service to service_name and attempts to connect to it.
         
         :param str service_name: Name of the storage service
         :param str custom_path: Custom path where to download tracks for local storage (optional, and must already exist, use absolute paths only)
+        :param options: Options passed to the storage service when it is created (e.g. pool_size=8 for google drive, sync_every=0 for local)
         """
 
-        self.connection_handler.use_storage_service(service_name, custom_path=custom_path)
+        self.connection_handler.use_storage_service(service_name, custom_path=custom_path, **options)
 
-    def start_workers(self, workers_per_task=1):
+    def limit_service(self, service_name, **options):
+        """
+        Sets the rate limit, retry policy and circuit breaker of the requests to a service.
+
+        :param str service_name: Name of the music or storage service
+        :param options: Options of the ServiceGuard of the service: rate and burst of requests per second, retries, backoff and
+                        max_backoff in seconds, and the failure_threshold and cooldown of the circuit breaker
+        """
+
+        self.connection_handler.limit_service(service_name, **options)
+
+    def stats(self):
+        """
+        Returns the state of the pipeline. Stage metrics and bytes transferred are only there when metrics are enabled.
+
+        :return dict: Requests, retries, failures, rate limiter and circuit breaker state of every service under 'services'; depth and
+                      wait time of every queue under 'queues'; number of workers of every pool under 'workers'; and with metrics,
+                      latency percentiles, items per second, errors and utilisation of every stage under 'stages' and bytes
+                      downloaded and uploaded under 'bytes'
+        """
+
+        stats = {
+            'services': self.connection_handler.stats(),
+            'queues': {name: {'depth': queue.qsize(), 'wait_time': queue.wait_time, 'oldest_wait': queue.oldest_wait()}
+                       for name, queue in list(self.queues.items())},
+            'workers': {name: pool.size for name, pool in list(self.pools.items())},
+        }
+        if self.metrics is not None:
+            stats.update(self.metrics.stats(dict(self.pools)))
+        if self.workspace is not None:
+            stats['workspace'] = self.workspace.stats()
+        stats['completions'] = self.completions.stats()
+        return stats
+
+    def metrics_text(self):
+        """
+        :return str: Metrics of the stages, queues, workers and services in the Prometheus text format
+        """
+
+        metrics = self.metrics or Metrics()
+        return metrics.prometheus(dict(self.queues), dict(self.pools), self.connection_handler.stats())
+
+    def serve_metrics(self, port=9100, host='127.0.0.1'):
+        """
+        Serves metrics_text over HTTP from a background thread, for Prometheus to scrape.
+
+        :param int port: Port the server listens on (0 picks a free one)
+        :param str host: Address the server listens on
+        :return int: Port the server listens on
+        """
+
+        if self.metrics_server is None:
+            self.metrics_server = MetricsServer(self.metrics_text, host=host, port=port)
+            self.metrics_server.start()
+        return self.metrics_server.port
+
+    def start_workers(self, workers_per_task=1, pool_sizes=None, autoscale_interval=5):
         """
         Creates and starts the workers, as well as attaching a handler to terminate them gracefully when a SIGINT signal is received.
 
+        If a job store is used, the jobs left unfinished by a previous run are put back in the queue of the stage where they stopped, from
+        a background thread that wait_for_expansions waits for.
+        With a workspace, a sweeper then starts removing the scratch files left behind by jobs that are not in the pipeline.
+        The pool of HTTP connections of every music service is sized to the largest number of its download workers.
+
         :param int workers_per_task: Number of workers to create for each task in the pipeline
+        :param dict pool_sizes: Number of workers for specific tasks, overriding workers_per_task (optional). A (min, max) tuple lets the
+                                autoscaler grow and shrink the pool within those bounds based on the depth and wait time of its input queue.
+                                Every music service has its own download pool, sized by 'download:<service name>' or else by 'download'.
+        :param float autoscale_interval: Seconds between two autoscaling decisions
         """
 
         if not self.workers:
-            for _ in range(workers_per_task):
-                self.workers.append(Worker(self._download, self.queues['download'], self.queues['convert'], self.stopper))
-                self.workers.append(Worker(self._convert, self.queues['convert'], self.queues['upload'], self.stopper))
-                self.workers.append(Worker(self._upload, self.queues['upload'], self.queues['delete'], self.stopper))
-                self.workers.append(Worker(self._delete, self.queues['delete'], self.queues['done'], self.stopper))
+            self.pool_sizes = dict.fromkeys(STAGES[:-1], workers_per_task)
+            self.pool_sizes.update(pool_sizes or {})
+            for stage, (func, next_stage) in self._stage_plan().items():
+                self.pools[stage] = self._make_pool(stage, func, next_stage)
+            for service_name in list(self.connection_handler.music_services):
+                name = 'download:' + service_name
+                if name not in self.queues:
+                    self.queues[name] = self._new_queue(name)
+                self.pools[name] = self._make_pool(name, *self._stage_plan()['download'])
+                self.connection_handler.music_services[service_name].set_pool_size(self.pools[name].max_size)
+            self.converter.fit(self.pools['convert'].max_size)
 
             self.signal_handler = SignalHandler(self.workers, self.stopper)
             signal.signal(signal.SIGINT, self.signal_handler)
 
-            for worker in self.workers:
-                worker.start()
+            for pool in self.pools.values():
+                pool.start()
+
+            if any(pool.min_size != pool.max_size for pool in self.pools.values()):
+                self.autoscaler = Autoscaler(list(self.pools.values()), self.stopper, interval=autoscale_interval)
+                self.autoscaler.start()
+
+            if self.job_store is not None:
+                self._resume(self.job_store.pending())
 
-    def _download(self, url):
+            if self.workspace is not None:
+                self.sweeper = Sweeper(self.workspace, self.stopper)
+                self.sweeper.start()
+
+    def _resume(self, jobs):
         """
-        Downloads the file associated with the given URL.
+        Puts the jobs left unfinished by a previous run back in the queue of the stage where they stopped.
+
+        The jobs are claimed right away, but they are put in their queues from a background thread, as bounded queues only take them as
+        fast as the workers drain them.
 
-        :param str url: URL of the video/audio file
-        :return str: Filename of the file in local storage
+        :param list jobs: Jobs loaded from the job store
+        """
+
+        self._claim(jobs)
+
+        def resume():
+            count = 0
+            try:
+                for job in jobs:
+                    if self.stopper.is_set():
+                        break
+                    (self._download_queue(job) if job.stage == 'download' else self.queues[job.stage]).put(job)
+                    count += 1
+            finally:
+                log.info(f"{count} of {len(jobs)} unfinished jobs have been resumed")
+                with self.expanders_lock:
+                    self.expanders.remove(resumer)
+
+        resumer = Thread(target=resume, name="resume jobs", daemon=True)
+        with self.expanders_lock:
+            self.expanders.append(resumer)
+        resumer.start()
+
+    def _claim(self, jobs):
+        """
+        Marks the jobs resumed from the job store as in the pipeline, so neither new jobs for the same tracks nor the sweeper touch them.
+
+        :param list jobs: Jobs loaded from the job store
+        """
+
+        for job in jobs:
+            with self.in_flight_lock:
+                self.in_flight.setdefault(self._in_flight_key(job), [])
+            if self.workspace is not None:
+                self.workspace.keep(job)
+
+    def _new_queue(self, name):
+        """
+        Creates the queue of the given name, bounded by queue_sizes and with the tenant caps of its stage.
+
+        :param str name: Name of the stage, or 'download:<service name>' for the download queue of a music service, which defaults to
+                         the size of the download stage and shares its cap, so a tenant is capped across every music service at once
+        :return StageQueue: Empty queue
+        """
+
+        stage = 'download' if name.startswith('download:') else name
+        sibling = self.queues['download'] if stage != name and name not in self.tenant_caps else None
+        return StageQueue(self.queue_sizes.get(name, self.queue_sizes.get(stage, 0)), weights=self.tenant_weights,
+                          cap=self.tenant_caps.get(name, self.tenant_caps.get(stage)), sibling=sibling,
+                          order=self._input_size if name == 'convert' else None)
+
+    @staticmethod
+    def _input_size(job):
+        """
+        Returns the size of the file of a job waiting to be converted, which stands in for the duration of its conversion, so short
+        tracks don't wait behind long ones and the mean latency goes down.
+
+        :param Job job: Job put in the queue of the conversion stage
+        :return int: Size of the file of the job, or 0 if it is unknown
+        """
+
+        try:
+            return os.path.getsize(job.file_name)
+        except (AttributeError, OSError, TypeError):
+            return 0
+
+    def _make_pool(self, name, func, next_stage):
+        """
+        Creates the pool of workers running func on the queue of the given name, sized from pool_sizes.
+
+        :param str name: Name of the stage, or 'download:<service name>' for the download queue of a music service
+        :param func: Function run by the workers
+        :param str next_stage: Stage the results go to, none for the done stage since finished jobs go to the completions
+        :return WorkerPool: Pool of workers, not started
+        """
+
+        size = self.pool_sizes.get(name, self.pool_sizes['download'] if name.startswith('download:') else None)
+        min_size, max_size = size if isinstance(size, tuple) else (size, size)
+        if self.queues[name].cap is not None:
+            func = self._releasing(self.queues[name], func)
+        if self.metrics is not None:
+            func = self.metrics.timed(name, func)
+        return WorkerPool(name, func, self.queues[name], self.queues.get(next_stage), self.stopper, self.workers,
+                          min_size=min_size, max_size=max_size, on_error=self._crashed)
+
+    @staticmethod
+    def _releasing(queue, func):
+        """
+        Wraps the function run by the workers of a queue with tenant caps, so that every item is released once processed.
+
+        :param StageQueue queue: Input queue of the workers
+        :param func: Function run on each item of the queue
+        :return: Wrapped function
+        """
+
+        @wraps(func)
+        def wrapper(item):
+            try:
+                return func(item)
+            finally:
+                queue.release(item)
+
+        return wrapper
+
+    def _download_queue(self, job):
+        """
+        Returns the download queue of the music service the job's URL points to, creating it on first use.
+
+        When workers are already running, the workers of a new queue are started right away.
+
+        :param Job job: Job waiting to be downloaded
+        :return StageQueue: Download queue of the music service, or the shared one if no service matches the URL
         """
-        
-        return self.connection_handler.current_music.download(url)
 
-    def _convert(self, file_name):
+        name = self._download_queue_name(job)
+        if name == 'download':
+            return self.queues[name]
+
+        music = self.connection_handler.music_for(job.url)
+        with self.routing_lock:
+            if name not in self.queues:
+                self.queues[name] = self._new_queue(name)
+            if self.pools and name not in self.pools:
+                self.pools[name] = pool = self._make_pool(name, *self._stage_plan()['download'])
+                music.set_pool_size(pool.max_size)
+                pool.start()
+                if self.autoscaler is not None:
+                    self.autoscaler.pools.append(pool)
+        return self.queues[name]
+
+    def _download_queue_name(self, job):
+        """
+        :param Job job: Job waiting to be downloaded
+        :return str: 'download:<service name>' for the music service the job's URL points to, or 'download' if no service matches it
+        """
+
+        music = self.connection_handler.music_for(job.url)
+        if music is None or not music.handles(job.url):
+            return 'download'
+        return 'download:' + music.name
+
+    def _stage_plan(self):
+        """
+        Returns the function run by the workers of each stage and the stage their results go to, depending on the streaming options.
+
+        :return dict: Function and next stage, by stage
+        """
+
+        plan = {stage: (getattr(self, '_' + stage), next_stage) for stage, next_stage in zip(STAGES, STAGES[1:])}
+        if self.streaming and self.streaming_upload:
+            plan['download'] = (self._stream_upload, 'delete')
+        elif self.streaming:
+            plan['download'] = (self._stream, 'upload')
+        elif self.streaming_upload:
+            plan['convert'] = (self._convert_upload, 'delete')
+        return plan
+
+    def _in_flight_key(self, job):
+        """
+        Returns the key under which the job is coalesced with other jobs for the same track and storage service.
+
+        :param Job job: Job in the pipeline
+        :return tuple: Storage service name and canonical track ID (or URL if the track ID is unknown)
         """
-        Converts the file associated with the file_name passed into a MP3 file.
 
-        :param str file_name: Filename and extension of the file to be converted
-        :return str: Filename of the new file in local storage
+        return self.connection_handler.current_storage.name, job.track_id or job.url
+
+    def _crashed(self, job, error):
+        """
+        Fails a job whose stage raised an exception instead of handling it, so that its handle settles and its in-flight entry is released.
+
+        :param Job job: Job the worker was processing
+        :param Exception error: Exception raised by the stage
         """
 
-        return convert_to_mp3(file_name, self.queues['delete'])
+        if isinstance(job, Job) and not job.done():
+            self._fail(job, error)
 
-    def _upload(self, file_name):
+    def _fail(self, job, error=None):
         """
-        Uploads the file associated with the file_name passed to the storage service.
+        Marks the job as failed and finishes it.
+
+        :param Job job: Job that failed its current stage
+        :param error: Exception or message explaining the failure (optional, the error already recorded on the job by default)
+        :return: None, for the worker to drop the job
+        """
+
+        error = error or job.error or f"The {job.stage} stage has failed for {job.url}"
+        self._advance(job, 'failed')
+        self._finish(job, error)
+        return None
 
-        :param str file_name: Filename of the file to be uploaded
-        :return str: Original filename passed as an argument
+    def _finish(self, job, error=None):
         """
+        Releases the in-flight entry of the job, gives its outcome to every job that was waiting on it, and completes them all.
+
+        :param Job job: Job that just finished or failed
+        :param error: Exception or message explaining why the job failed (optional)
+        """
+
+        with self.in_flight_lock:
+            waiting = self.in_flight.pop(self._in_flight_key(job), [])
+        if self.workspace is not None:
+            # A failed download can be resumed from its partial file by the next job for the track
+            self.workspace.remove(job, keep=job.stage == 'failed')
+
+        if job.stage == 'done' and self.track_index is not None and job.location is not None:
+            self.track_index.add(self.connection_handler.current_storage.name, job.track_id or job.url, job.location)
+
+        self._complete(job, error)
+        for waiting_job in waiting:
+            waiting_job.location = job.location
+            waiting_job.advance(job.stage)
+            self._complete(waiting_job, error)
 
-        return self.connection_handler.current_storage.upload(file_name)
+    def _complete(self, job, error=None):
+        """
+        Resolves the handle of the job that finished or failed, and adds it to the completions.
+
+        :param Job job: Job that finished or failed
+        :param error: Exception or message explaining why the job failed (optional)
+        """
+
+        job.finish(error)
+        self.completions.put(job)
+
+    def _advance(self, job, stage, file_name=None):
+        """
+        Moves the job to the given stage and records it in the job store.
+
+        :param Job job: Job that finished its current stage
+        :param str stage: Next stage of the job
+        :param str file_name: Filename of the intermediate file produced by the current stage (optional)
+        :return Job: The job that was passed as an argument
+        """
+
+        job.advance(stage)
+        if file_name is not None:
+            job.file_name = file_name
+        if self.job_store is not None:
+            self.job_store.update(job)
+        return job
+
+    def _count_bytes(self, direction, file_name):
+        """
+        Adds the size of the file to the bytes transferred in the direction, when metrics are enabled.
+
+        :param str direction: 'downloaded' or 'uploaded'
+        :param str file_name: Filename of the file that was transferred
+        """
+
+        if self.metrics is not None:
+            try:
+                self.metrics.add_bytes(direction, os.path.getsize(file_name))
+            except OSError:
+                pass
+
+    def _scratch(self, job):
+        """
+        Admits the job into the workspace, waiting while the workspace is over its disk budget.
+
+        :param Job job: Job about to write files to local storage
+        :return str: Directory of the job in the workspace, or an empty string to use the current directory if there is no workspace
+        """
+
+        if self.workspace is None:
+            return ''
+        return self.workspace.admit(job, self.stopper)
+
+    def _request(self, service, func, *args, retry=True):
+        """
+        Calls a method of a service through the rate limiter, retry policy and circuit breaker of the service, unless the service sends
+        each of its requests through them itself.
 
-    def _delete(self, file_name):
+        :param service: Music or storage service
+        :param func: Method of the service making the request
+        :param bool retry: Whether the request may be retried after a transient error
+        :return: Result of the method
         """
-        Deletes the file associated with the file_name passed from local storage.
 
-        :param str file_name: Filename of the file to be deleted
-        :return str: Filename of the file that was just deleted
+        if isinstance(service, GuardedRequests):
+            return func(*args)
+        return self.connection_handler.guard(service).call(func, *args, retry=retry)
+
+    def _download(self, job):
+        """
+        Downloads the file associated with the URL of the job.
+
+        :param Job job: Job waiting to be downloaded
+        :return Job: Job with the filename of the file in local storage, or None if the download failed
+        """
+
+        music = self.connection_handler.music_for(job.url)
+        directory = self._scratch(job)
+        try:
+            file_name = self._request(music, music.download, job.url, *([directory] if directory else []))
+        except Exception as e:
+            log.exception(f"Download for {job.url} has failed")
+            job.error = e
+            file_name = None
+        if file_name is None:
+            return self._fail(job)
+        job.codec = music.codec(file_name)
+        self._count_bytes('downloaded', file_name)
+        return self._advance(job, 'convert', file_name)
+
+    def _open_stream(self, job):
+        """
+        Opens the media associated with the URL of the job as a stream of bytes.
+
+        :param Job job: Job waiting to be downloaded
+        :return tuple: Name of the media and an iterator over chunks of its bytes, or None if it can't be opened
+        """
+
+        music = self.connection_handler.music_for(job.url)
+        try:
+            return self._request(music, music.open_stream, job.url)
+        except Exception as e:
+            log.exception(f"Download for {job.url} has failed")
+            job.error = e
+            return None
+
+    def _stream(self, job):
+        """
+        Downloads the media associated with the URL of the job and converts it into a MP3 file as the bytes arrive.
+
+        :param Job job: Job waiting to be downloaded
+        :return Job: Job with the filename of the MP3 file in local storage, or None if the download or conversion failed
+        """
+
+        stream = self._open_stream(job)
+        file_name = None
+        if stream is not None:
+            name, chunks = stream
+            file_name = transcode_stream(chunks, os.path.join(self._scratch(job), name + '.mp3'), threads=1, preset=self.mp3_preset)
+        if file_name is None:
+            return self._fail(job)
+        return self._advance(job, 'upload', file_name)
+
+    def _stream_upload(self, job):
+        """
+        Downloads the media associated with the URL of the job, converts it and uploads the MP3 file as the bytes arrive.
+
+        :param Job job: Job waiting to be downloaded
+        :return Job: Job with the location of the stored file, or None if any step failed
+        """
+
+        stream = self._open_stream(job)
+        if stream is None or not self._transcode_upload(job, stream[1], stream[0] + '.mp3'):
+            return self._fail(job)
+        job.file_name = None
+        return self._advance(job, 'delete')
+
+    def _convert_upload(self, job):
+        """
+        Converts the file of the job into a MP3 file and uploads it as FFmpeg writes it. Files that already are MP3 are uploaded as is.
+
+        :param Job job: Job waiting to be converted
+        :return Job: Job with the location of the stored file, ready for the original file to be deleted, or None if any step failed
+        """
+
+        root, extension = os.path.splitext(job.file_name)
+        if extension == '.mp3':
+            return self._upload(job)
+        if not self._transcode_upload(job, job.file_name, root + '.mp3'):
+            return self._fail(job)
+        return self._advance(job, 'delete')
+
+    def _transcode_upload(self, job, source, file_name):
+        """
+        Runs FFmpeg on the source and uploads its output to the storage service while it is being written.
+
+        :param Job job: Job being processed, whose location is set once the upload is done
+        :param source: Filename of the original file in local storage, or an iterable of chunks of its bytes
+        :param str file_name: Filename of the MP3 file in the storage
+        :return bool: Whether the conversion and upload succeeded
+        """
+
+        stream = None
+        try:
+            stream = TranscodedStream(source, threads=1, preset=self.mp3_preset)
+            storage = self.connection_handler.current_storage
+            job.location = self._request(storage, storage.upload_stream, stream, file_name, retry=False)
+        except Exception as e:
+            log.exception(f"Streaming upload for {file_name} has failed")
+            job.error = e
+            job.location = None
+        finally:
+            if stream is not None:
+                stream.close()
+        return job.location is not None
+
+    def _convert(self, job):
+        """
+        Converts the file of the job into a MP3 file.
+
+        :param Job job: Job waiting to be converted
+        :return Job: Job with the filename of the new file in local storage, or None if the conversion failed
+        """
+
+        with self.converter.slot() as threads:
+            file_name = convert_to_mp3(job.file_name, self.queues['delete'], threads=threads, codec=job.codec,
+                                       preset=self.mp3_preset)
+        if file_name is None:
+            return self._fail(job)
+        return self._advance(job, 'upload', file_name)
+
+    def _upload(self, job):
+        """
+        Uploads the file of the job to the storage service.
+
+        :param Job job: Job waiting to be uploaded
+        :return Job: Job with the location of the stored file, ready for its local file to be deleted, or None if the upload failed
+        """
+
+        storage = self.connection_handler.current_storage
+        try:
+            job.location = self._request(storage, storage.upload, job.file_name)
+        except Exception as e:
+            log.exception(f"Upload for {job.file_name} has failed")
+            return self._fail(job, e)
+        self._count_bytes('uploaded', job.file_name)
+        return self._advance(job, 'delete')
+
+    def _delete(self, item):
+        """
+        Deletes the file of the job from local storage, and finishes the job.
+
+        The conversion stage also sends the original downloaded files through here, as plain filenames.
+
+        :param item: Job waiting for its file to be deleted, or filename of an intermediate file
+        :return: None, finished jobs going to the completions rather than to another queue
         """
 
-        return delete_local_file(file_name)
+        if not isinstance(item, Job):
+            delete_local_file(item)
+            return None
 
-    def _notify(self):
-        """TODO: Notify that the MP3 has been uploaded through a messaging service."""
-        pass
+        if item.file_name is not None:
+            delete_local_file(item.file_name)
+        self._advance(item, 'done')
+        self._finish(item)
+        return None
@@ -0,0 +1,732 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os
+from queue import Empty
+import re
+import subprocess
+from time import perf_counter, time
+
+from music2storage import Music2Storage, log
+from music2storage.downloader import RangedDownloader
+from music2storage.helpers import _record_conversion, conversion_plan
+from music2storage.job import STAGES
+from music2storage.resilience import error_status
+from music2storage.workspace import Sweeper
+
+
+STALE_LOCATION_STATUSES = (401, 403, 404, 410)
+"""Statuses a signed media location is refused with once it expired, after which it is looked up again."""
+
+NEXT_STAGE = dict(zip(STAGES, STAGES[1:]))
+
+
+class AsyncRangedDownloader(RangedDownloader):
+    """
+    Coroutine counterpart of RangedDownloader on an aiohttp session. The ranges of a download are fetched by tasks of the event loop
+    rather than threads, into the same preallocated file and sidecar progress map, so a download interrupted in one engine can be
+    resumed by the other.
+    """
+
+    def __init__(self, session, connections=4, segment_size=4 * 1024 * 1024, chunk_size=256 * 1024):
+        """
+        :param aiohttp.ClientSession session: Session the requests go through
+        :param int connections: Number of connections used by one download
+        :param int segment_size: Number of bytes fetched by one range request, files up to this size use a single connection
+        :param int chunk_size: Number of bytes read from a response at a time
+        """
+
+        super().__init__(session, connections=connections, segment_size=segment_size, chunk_size=chunk_size, progress_bar=False)
+
+    @staticmethod
+    async def _guarded(guard, func, *args):
+        """
+        Sends a request through the guard of the service, if there is one.
+
+        :param ServiceGuard guard: Guard of the service (None to send the request directly)
+        :param func: Coroutine function making one request
+        :return: Result of func
+        """
+
+        if guard is None:
+            return await func(*args)
+        return await guard.call_async(func, *args)
+
+    async def _probe(self, url):
+        """
+        Asks for the first byte of the media, to learn its size and whether the server serves ranges.
+
+        :param str url: URL of the media
+        :return tuple: Size of the media in bytes (None if unknown), and True if ranges are served
+        """
+
+        async with self.session.get(url, headers={'Range': 'bytes=0-0'}) as r:
+            r.raise_for_status()
+            match = re.match(r'bytes \d+-\d+/(\d+)', r.headers.get('Content-Range', ''))
+            if r.status == 206 and match:
+                return int(match.group(1)), True
+            length = r.headers.get('Content-Length')
+            return (int(length) if length else None), False
+
+    async def _fetch_segment(self, url, fd, start, end, state):
+        """
+        Fetches the bytes from start to end (inclusive) that aren't written yet, so a retry resumes where a failed request stopped.
+
+        :param str url: URL of the media
+        :param int fd: File descriptor of the partial download
+        :param int start: Offset of the first byte of the segment
+        :param int end: Offset of the last byte of the segment
+        :param dict state: Progress map and sidecar filename shared by the segments of the download
+        """
+
+        offset = start + state['segments'].get(start, 0)
+        if offset > end:
+            return
+        async with self.session.get(url, headers={'Range': f"bytes={offset}-{end}"}) as r:
+            r.raise_for_status()
+            if r.status != 206:
+                raise ValueError(f"Range request for {url} was answered with status {r.status}")
+            async for data in r.content.iter_chunked(self.chunk_size):
+                data = data[:end + 1 - offset]
+                os.pwrite(fd, data, offset)
+                offset += len(data)
+                state['segments'][start] = offset - start
+                if time() - state['saved_at'] >= 1:
+                    self._save_progress(state['progress_file'], state['size'], state['segments'])
+                    state['saved_at'] = time()
+        if offset <= end:
+            raise ConnectionError(f"Range request for {url} ended {end + 1 - offset} bytes early")
+
+    async def _download_ranges(self, url, file_name, size, guard):
+        """Downloads the media in segments fetched concurrently, resuming from the sidecar progress map if there is one."""
+
+        part_file = file_name + '.part'
+        progress_file = file_name + '.progress'
+        segments = self._load_progress(progress_file, part_file, size)
+        if segments:
+            log.info(f"Resuming download of {file_name} with {sum(segments.values())} of {size} bytes already fetched")
+
+        fd = os.open(part_file, os.O_RDWR | os.O_CREAT)
+        try:
+            if not segments:
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except (AttributeError, OSError):
+                    os.ftruncate(fd, size)
+            state = {'segments': segments, 'progress_file': progress_file, 'size': size, 'saved_at': time()}
+            connections = asyncio.Semaphore(self.connections)
+
+            async def fetch(start, end):
+                async with connections:
+                    await self._guarded(guard, self._fetch_segment, url, fd, start, end, state)
+
+            tasks = [asyncio.ensure_future(fetch(start, min(start + self.segment_size, size) - 1))
+                     for start in range(0, size, self.segment_size)]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                self._save_progress(progress_file, size, segments)
+            await asyncio.get_event_loop().run_in_executor(None, os.fsync, fd)
+        finally:
+            os.close(fd)
+        os.replace(part_file, file_name)
+        os.remove(progress_file)
+
+    async def _download_whole(self, url, file_name):
+        """Downloads the media over one connection, from the start, for servers that don't serve ranges."""
+
+        part_file = file_name + '.part'
+        async with self.session.get(url) as r:
+            r.raise_for_status()
+            with open(part_file, 'wb') as f:
+                async for data in r.content.iter_chunked(self.chunk_size):
+                    f.write(data)
+        os.replace(part_file, file_name)
+
+    async def download(self, url, file_name, guard=None):
+        """
+        Downloads the media at the URL into the file, over several connections when the server serves ranges.
+
+        :param str url: URL of the media
+        :param str file_name: Filename of the file in local storage
+        :param ServiceGuard guard: Guard every request goes through, which retries a failed range from where it stopped (optional)
+        :return str: Filename of the file in local storage
+        """
+
+        size, ranged = await self._guarded(guard, self._probe, url)
+        log.info(f"Download for {file_name} has started ({size} bytes, {'ranged' if ranged else 'single connection'})")
+        start_time = time()
+        if ranged and size > self.segment_size:
+            await self._download_ranges(url, file_name, size, guard)
+        else:
+            await self._guarded(guard, self._download_whole, url, file_name)
+        log.info(f"Download for {file_name} has finished in {time() - start_time} seconds")
+        return file_name
+
+
+async def run_ffmpeg(cmd):
+    """
+    Runs an FFmpeg command as a subprocess of the event loop and waits for it to finish. The process is killed if the wait is cancelled.
+
+    :param list cmd: FFmpeg command and its arguments
+    """
+
+    process = await asyncio.create_subprocess_exec(*cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                                   stderr=subprocess.DEVNULL)
+    try:
+        returncode = await process.wait()
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+    if returncode != 0:
+        from ffmpy import FFRuntimeError
+        raise FFRuntimeError(subprocess.list2cmdline(cmd), returncode, None, None)
+
+
+async def convert_to_mp3(file_name, threads=None, retries=1, backoff=1, codec=None, preset=None, executor=None):
+    """
+    Coroutine counterpart of helpers.convert_to_mp3, running FFmpeg as a subprocess of the event loop. The original file is left for
+    the caller to delete.
+
+    :param str file_name: Filename of the original file in local storage
+    :param int threads: Number of threads FFmpeg may use (optional, FFmpeg decides by default)
+    :param int retries: Number of times a failed conversion is retried
+    :param float backoff: Seconds to wait before the first retry, doubled for every following one
+    :param str codec: Audio codec of the file, if already known (optional, the file is probed otherwise)
+    :param str preset: Name of the MP3 encoding preset from MP3_PRESETS (optional, FFmpeg defaults otherwise)
+    :param executor: Executor probing the file when its codec is unknown (optional, the default executor of the event loop)
+    :return str: Filename of the new file in local storage, or None if the conversion failed
+    """
+
+    from ffmpy import FFRuntimeError
+
+    plan = partial(conversion_plan, file_name, threads=threads, codec=codec, preset=preset)
+    path, duration, new_file_name, cmd = await asyncio.get_event_loop().run_in_executor(executor, plan)
+    if path == 'skip':
+        log.info(f"{file_name} is already a MP3 file, no conversion needed.")
+        return file_name
+
+    log.info(f"Conversion for {file_name} has started using the {path} path")
+    start_time = time()
+    for attempt in range(retries + 1):
+        try:
+            await run_ffmpeg(cmd)
+        except (FFRuntimeError, OSError) as error:
+            if os.path.exists(new_file_name):
+                os.remove(new_file_name)
+            if attempt == retries:
+                log.error(f"Conversion for {file_name} has failed: {error}")
+                return None
+            delay = backoff * 2 ** attempt
+            log.warning(f"Conversion for {file_name} has failed, retrying in {delay} seconds")
+            await asyncio.sleep(delay)
+        else:
+            break
+    end_time = time()
+    log.info(f"Conversion for {file_name} has finished in {end_time - start_time} seconds")
+    _record_conversion(file_name, path, duration, end_time - start_time)
+    return new_file_name
+
+
+class AsyncMusic2Storage:
+    """
+    Pipeline running on an event loop, so hundreds of transfers can be in flight without a thread for each.
+
+    Every job is a task of the event loop going from stage to stage. Downloads fetch the ranges of the media over an aiohttp session,
+    and FFmpeg runs as a subprocess of the event loop. The stages share the queues and the bookkeeping of a Music2Storage: job store,
+    track index, in-flight coalescing, service guards, workspace, metrics, priorities, tenants and tenant caps.
+
+    The calls to clients that only have a blocking API run on a small pool of threads: looking up the media of a track, expanding
+    playlists, uploading to the storage service, and writing to the job store and track index. Music services that don't give the
+    location of their media download on that pool too. Streaming conversions are only available in Music2Storage.
+    """
+
+    def __init__(self, concurrency=None, loop=None, session=None, **options):
+        """
+        Sets up the pipeline; its stages start with the first URL added.
+
+        :param dict concurrency: Number of jobs in each of the download, convert, upload and delete stages at once (optional). Every
+                                 music service has its own download limit, set by 'download:<service name>' or else by 'download'.
+                                 Conversions are also capped by the cores. 'pending' bounds the number of jobs waiting to be
+                                 downloaded, which holds back the expansion of playlists. 'threads' sizes the pool of threads running
+                                 the blocking calls, which caps the uploads in flight.
+        :param loop: Event loop run by run_until_complete (optional, defaults to the current event loop)
+        :param aiohttp.ClientSession session: Session the downloads go through (optional, one is created on the first download)
+        :param options: Options of Music2Storage, e.g. job_store, track_index, workspace or tenant_caps
+        :raises ValueError: If streaming or streaming_upload is set
+        """
+
+        if options.get('streaming') or options.get('streaming_upload'):
+            raise ValueError("Streaming conversions are only available in Music2Storage")
+        self.concurrency = {'download': 100, 'convert': 4, 'upload': 8, 'delete': 4, 'pending': 200, 'threads': 16}
+        self.concurrency.update(concurrency or {})
+        queue_sizes = dict(options.pop('queue_sizes', None) or {})
+        queue_sizes.setdefault('download', self.concurrency['pending'])
+        self.pipeline = Music2Storage(queue_sizes=queue_sizes, **options)
+        self.loop = loop or asyncio.get_event_loop()
+        self.session = session
+        self.owns_session = False
+        self.downloader = None
+        self.executor = None
+        self.dispatchers = {}
+        self.ready = {}
+        self.room = {}
+        self.tasks = set()
+        self.busy = {stage: 0 for stage in STAGES[:-1]}
+        self.expanders = set()
+        self.jobs = set()
+        self.playlists = []
+
+    @property
+    def connection_handler(self):
+        return self.pipeline.connection_handler
+
+    @property
+    def completions(self):
+        return self.pipeline.completions
+
+    async def add_to_queue(self, url, priority=0, tenant=None):
+        """
+        Adds the URL to the pipeline, starting the stages on first use.
+
+        Adding waits, without blocking the event loop, while 'pending' jobs are already waiting to be downloaded.
+
+        :param str url: URL to the music service track or playlist
+        :param int priority: Priority of the job, or of the jobs of every track of a playlist, higher priorities being taken first
+        :param str tenant: Key of the user or client adding the URL (optional)
+        :return: Job created for the URL, which can be awaited for the location of the stored track, a list filled with the jobs of
+                 the tracks of a playlist as it is expanded, or None if it was not added
+        """
+
+        self._start()
+        music = self.connection_handler.music_for(url)
+        if music is None:
+            log.error('Music service is not initialized. URL was not added to queue.')
+            return None
+        if self.connection_handler.current_storage is None:
+            log.error('Drive service is not initialized. URL was not added to queue.')
+            return None
+        if music.is_playlist(url):
+            jobs = []
+            self.playlists.append(jobs)
+            self._spawn(self.expanders, self._expand(music, url, priority, tenant, jobs))
+            return jobs
+
+        job, new = await self._blocking(self.pipeline._admit, music, url, priority, tenant)
+        self._follow(job)
+        if new:
+            await self._put(self._route(job), job)
+        return job
+
+    def use_music_service(self, service_name, api_key=None, **options):
+        """
+        Sets the current music service to service_name and attempts to connect to it.
+
+        :param str service_name: Name of the music service
+        :param str api_key: Optional API key if necessary
+        :param options: Options passed to the music service when it is created (e.g. max_abr=128 for youtube)
+        """
+
+        self.pipeline.use_music_service(service_name, api_key=api_key, **options)
+
+    def use_storage_service(self, service_name, custom_path=None, **options):
+        """
+        Sets the current storage service to service_name and attempts to connect to it.
+
+        :param str service_name: Name of the storage service
+        :param str custom_path: Custom path where to download tracks for local storage (optional, and must already exist, use absolute paths only)
+        :param options: Options passed to the storage service when it is created (e.g. pool_size=8 for google drive)
+        """
+
+        self.pipeline.use_storage_service(service_name, custom_path=custom_path, **options)
+
+    def limit_service(self, service_name, **options):
+        """
+        Sets the rate limit, retry policy and circuit breaker of the requests to a service.
+
+        :param str service_name: Name of the music or storage service
+        :param options: Options of the ServiceGuard of the service
+        """
+
+        self.pipeline.limit_service(service_name, **options)
+
+    def on_completion(self, callback):
+        """
+        Calls the callback with every job that finishes or fails from now on, e.g. to send a notification.
+
+        :param callback: Function taking the job as its only argument, called from the thread or task finishing the job
+        """
+
+        self.pipeline.on_completion(callback)
+
+    def stats(self):
+        """
+        :return dict: State of the pipeline, as returned by Music2Storage.stats, with the number of jobs each stage is processing
+        """
+
+        stats = self.pipeline.stats()
+        stats['in_flight'] = dict(self.busy)
+        return stats
+
+    async def join(self):
+        """Waits until every job added so far, including the tracks of playlists and the jobs resumed from the job store, has finished or failed."""
+
+        while self.expanders:
+            await asyncio.gather(*list(self.expanders), return_exceptions=True)
+        jobs = list(self.jobs) + [job for playlist in self.playlists for job in playlist]
+        self.playlists = []
+        await asyncio.gather(*jobs, return_exceptions=True)
+
+    def run_until_complete(self):
+        """Runs the event loop until every job added so far has finished or failed."""
+
+        self.loop.run_until_complete(self.join())
+
+    async def close(self):
+        """Stops the stages, cancelling the jobs in flight, then closes the HTTP session and the pool of threads."""
+
+        self.pipeline.stopper.set()
+        tasks = list(self.expanders) + list(self.dispatchers.values()) + list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.dispatchers = {}
+        if self.owns_session:
+            await self.session.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def _start(self):
+        """
+        Creates the pool of threads and sizes the conversions on first use, then resumes the jobs left in the job store. With a
+        workspace, a sweeper then starts removing the scratch files left behind by jobs that are not in the pipeline.
+        """
+
+        if self.executor is not None:
+            return
+        self.executor = ThreadPoolExecutor(self.concurrency['threads'])
+        self.pipeline.converter.fit(self.concurrency['convert'])
+        if self.pipeline.job_store is not None:
+            self._spawn(self.expanders, self._resume())
+        else:
+            self._sweep()
+
+    def _sweep(self):
+        """Starts the sweeper of the workspace, if there is one."""
+
+        if self.pipeline.workspace is not None:
+            self.pipeline.sweeper = Sweeper(self.pipeline.workspace, self.pipeline.stopper)
+            self.pipeline.sweeper.start()
+
+    def _spawn(self, tasks, coroutine):
+        """
+        Runs the coroutine as a task of the event loop, kept in the set until it is done.
+
+        :param set tasks: Set the task is kept in
+        :param coroutine: Coroutine to run
+        :return asyncio.Task: Task running the coroutine
+        """
+
+        task = self.loop.create_task(coroutine)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+
+    async def _blocking(self, func, *args):
+        """
+        Runs a blocking call on the pool of threads.
+
+        :param func: Function to call
+        :return: Result of func
+        """
+
+        return await self.loop.run_in_executor(self.executor, partial(func, *args))
+
+    def _follow(self, job):
+        """
+        Keeps the job until it finishes, for join to wait for it.
+
+        :param Job job: Job added to the pipeline
+        """
+
+        self.jobs.add(job)
+        job.add_done_callback(lambda job: self.loop.call_soon_threadsafe(self.jobs.discard, job))
+
+    def _route(self, job):
+        """
+        :param Job job: Job entering the pipeline
+        :return str: Name of the queue of the stage of the job, the download queue of its music service being created on first use
+        """
+
+        if job.stage != 'download':
+            return job.stage
+        self.pipeline._download_queue(job)
+        return self.pipeline._download_queue_name(job)
+
+    async def _put(self, name, item):
+        """
+        Puts the item in a queue, waiting while the queue is full, and starts the dispatcher of the queue on first use.
+
+        :param str name: Name of the queue
+        :param item: Job, or filename for the delete stage
+        """
+
+        queue = self.pipeline.queues[name]
+        if name not in self.dispatchers:
+            self.ready[name] = asyncio.Event()
+            self.room[name] = asyncio.Event()
+            self.dispatchers[name] = self.loop.create_task(self._dispatch(name))
+        while queue.full():
+            self.room[name].clear()
+            await self.room[name].wait()
+        queue.put_nowait(item)
+        self.ready[name].set()
+
+    def _limit(self, name):
+        """
+        :param str name: Name of a queue
+        :return int: Number of items of the queue processed at once
+        """
+
+        stage = name.split(':')[0]
+        limit = self.concurrency.get(name, self.concurrency[stage])
+        if stage == 'convert':
+            limit = min(limit, self.pipeline.converter.max_jobs)
+        return max(1, limit)
+
+    async def _dispatch(self, name):
+        """
+        Takes the items out of a queue as soon as the stage has room for them, by priority and tenant, and processes each in a task.
+
+        :param str name: Name of the queue
+        """
+
+        queue = self.pipeline.queues[name]
+        slots = asyncio.Semaphore(self._limit(name))
+        while True:
+            await slots.acquire()
+            while True:
+                try:
+                    item = queue.get_nowait()
+                    break
+                except Empty:
+                    self.ready[name].clear()
+                    await self.ready[name].wait()
+            self.room[name].set()
+            self._spawn(self.tasks, self._process(name, item, slots))
+
+    async def _process(self, name, item, slots):
+        """
+        Runs the stage of the queue on the item, then puts the result in the queue of the next stage, holding the slot of the stage
+        until the next queue has room, as a worker does.
+
+        :param str name: Name of the queue the item was taken from
+        :param item: Job, or filename for the delete stage
+        :param asyncio.Semaphore slots: Slots of the stage, one of which is released once the item is processed
+        """
+
+        stage = name.split(':')[0]
+        queue = self.pipeline.queues[name]
+        metrics = self.pipeline.metrics
+        self.busy[stage] += 1
+        try:
+            if metrics is not None:
+                metrics.start(name)
+            start = perf_counter()
+            failed = True
+            result = None
+            try:
+                result = await getattr(self, '_' + stage)(item)
+                failed = result is None and getattr(item, 'stage', None) == 'failed'
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception(f"Worker has failed to process {item}")
+                await self._blocking(self.pipeline._crashed, item, e)
+            finally:
+                self.busy[stage] -= 1
+                if metrics is not None:
+                    metrics.observe(name, perf_counter() - start, failed)
+                if queue.cap is not None:
+                    queue.release(item)
+                    for other, ready in self.ready.items():
+                        if self.pipeline.queues[other] in queue.siblings:
+                            ready.set()
+
+            if result is not None and NEXT_STAGE[stage] in self.pipeline.queues:
+                await self._put(NEXT_STAGE[stage], result)
+        finally:
+            slots.release()
+
+    async def _resume(self):
+        """Puts the jobs left unfinished by a previous run back in the queue of the stage where they stopped."""
+
+        jobs = await self._blocking(self.pipeline.job_store.pending)
+        self.pipeline._claim(jobs)
+        self._sweep()
+        count = 0
+        try:
+            for job in jobs:
+                self._follow(job)
+                await self._put(self._route(job), job)
+                count += 1
+        finally:
+            log.info(f"{count} of {len(jobs)} unfinished jobs have been resumed")
+
+    async def _expand(self, music, url, priority, tenant, jobs):
+        """
+        Adds the tracks of the playlist to the queue as the playlist is expanded, each page being fetched on the pool of threads.
+
+        :param MusicService music: Music service of the playlist
+        :param str url: URL of the playlist
+        :param int priority: Priority of the jobs of the tracks
+        :param str tenant: Key of the user or client adding the playlist (optional)
+        :param list jobs: List the jobs of the tracks are appended to
+        """
+
+        count = 0
+        try:
+            tracks = await self._blocking(lambda: iter(music.expand(url)))
+            while True:
+                track_url = await self._blocking(next, tracks, None)
+                if track_url is None:
+                    break
+                job = await self.add_to_queue(track_url, priority, tenant)
+                if job is not None:
+                    jobs.append(job)
+                count += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception(f"Expansion of {url} has failed after {count} tracks")
+        else:
+            log.info(f"Expansion of {url} has finished with {count} tracks")
+
+    async def _scratch(self, job):
+        """
+        Admits the job into the workspace, waiting without holding a thread while the workspace is over its disk budget.
+
+        :param Job job: Job about to write files to local storage
+        :return str: Directory of the job in the workspace, or an empty string to use the current directory if there is no workspace
+        """
+
+        workspace = self.pipeline.workspace
+        if workspace is None:
+            return ''
+        while True:
+            directory = await self._blocking(workspace.admit, job, self.pipeline.stopper, False)
+            if directory is not None:
+                return directory
+            await asyncio.sleep(workspace.usage_ttl)
+
+    def _downloader(self):
+        """
+        :return AsyncRangedDownloader: Downloader of the media, on a session created on first use
+        :raises ImportError: If aiohttp is not installed
+        """
+
+        if self.downloader is None:
+            if self.session is None:
+                try:
+                    import aiohttp
+                except ImportError:
+                    raise ImportError("The asyncio engine downloads with aiohttp: pip install music2storage[async]") from None
+                self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency['download'] * 4))
+                self.owns_session = True
+            self.downloader = AsyncRangedDownloader(self.session)
+        return self.downloader
+
+    async def _fetch(self, music, job, media, directory):
+        """
+        Downloads the media of the track, looking its location up again once if the signed location was refused.
+
+        :param MusicService music: Music service of the track
+        :param Job job: Job waiting to be downloaded
+        :param tuple media: URL of the media, filename and codec, as returned by the locate method of the music service
+        :param str directory: Directory the file is downloaded into
+        :return str: Filename of the file in local storage
+        """
+
+        media_url, name, _ = media
+        file_name = os.path.join(directory, name)
+        guard = self.connection_handler.guard(music)
+        try:
+            return await self._downloader().download(media_url, file_name, guard)
+        except Exception as e:
+            if error_status(e) not in STALE_LOCATION_STATUSES:
+                raise
+            media = await self._blocking(music.locate, job.url, True)
+            if media is None:
+                raise
+            return await self._downloader().download(media[0], file_name, guard)
+
+    async def _download(self, job):
+        """
+        Downloads the file associated with the URL of the job, as a coroutine if the music service gives the location of its media.
+
+        :param Job job: Job waiting to be downloaded
+        :return Job: Job with the filename of the file in local storage, or None if the download failed
+        """
+
+        music = self.connection_handler.music_for(job.url)
+        directory = await self._scratch(job)
+        codec = None
+        try:
+            try:
+                media = await self._blocking(self.pipeline._request, music, music.locate, job.url)
+            except NotImplementedError:
+                file_name = await self._blocking(self.pipeline._request, music, music.download, job.url, *([directory] if directory else []))
+                codec = await self._blocking(music.codec, file_name) if file_name is not None else None
+            else:
+                file_name = await self._fetch(music, job, media, directory) if media is not None else None
+                codec = media[2] if media is not None else None
+        except Exception as e:
+            log.exception(f"Download for {job.url} has failed")
+            job.error = e
+            file_name = None
+        if file_name is None:
+            return await self._blocking(self.pipeline._fail, job)
+        job.codec = codec
+        self.pipeline._count_bytes('downloaded', file_name)
+        return await self._blocking(self.pipeline._advance, job, 'convert', file_name)
+
+    async def _convert(self, job):
+        """
+        Converts the file of the job into a MP3 file with FFmpeg running as a subprocess, then sends the original file to be deleted.
+
+        :param Job job: Job waiting to be converted
+        :return Job: Job with the filename of the new file in local storage, or None if the conversion failed
+        """
+
+        file_name = await convert_to_mp3(job.file_name, threads=self.pipeline.converter.threads_per_job, codec=job.codec,
+                                         preset=self.pipeline.mp3_preset, executor=self.executor)
+        if file_name is None:
+            return await self._blocking(self.pipeline._fail, job)
+        if file_name != job.file_name:
+            await self._put('delete', job.file_name)
+        return await self._blocking(self.pipeline._advance, job, 'upload', file_name)
+
+    async def _upload(self, job):
+        """
+        Uploads the file of the job on the pool of threads, the storage clients only having a blocking API.
+
+        :param Job job: Job waiting to be uploaded
+        :return Job: Job with the location of the stored file, or None if the upload failed
+        """
+
+        return await self._blocking(self.pipeline._upload, job)
+
+    async def _delete(self, item):
+        """
+        Deletes the file of the job from local storage and finishes the job, on the pool of threads.
+
+        :param item: Job waiting for its file to be deleted, or filename of an intermediate file
+        :return: None, finished jobs going to the completions rather than to another queue
+        """
+
+        return await self._blocking(self.pipeline._delete, item)
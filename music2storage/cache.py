@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class TTLCache:
+    """Thread-safe cache whose entries expire after a fixed time, dropping the least recently used ones when full."""
+
+    def __init__(self, ttl, maxsize=1024):
+        """
+        :param float ttl: Seconds an entry is kept
+        :param int maxsize: Maximum number of entries
+        """
+
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :param key: Key of the entry
+        :return: Value of the entry, or None if there is none or it expired
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        :param key: Key of the entry
+        :param value: Value of the entry
+        :param float ttl: Seconds this entry is kept, if it differs from the cache's (optional)
+        """
+
+        with self.lock:
+            self.entries[key] = (monotonic() + (self.ttl if ttl is None else ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        """
+        :param key: Key of the entry to drop
+        """
+
+        with self.lock:
+            self.entries.pop(key, None)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+from collections import deque
+from itertools import islice
+from threading import Condition
+
+from music2storage import log
+
+
+class Completions:
+    """
+    Ring buffer of the jobs that finished or failed, keeping only the latest ones so memory stays flat however long the pipeline runs.
+
+    Any number of consumers can follow the jobs as they complete, each at its own pace, or be called back for each of them. A consumer
+    that falls further behind than the size of the buffer skips the jobs that were dropped meanwhile.
+    """
+
+    def __init__(self, size=1000):
+        """
+        :param int size: Number of finished jobs kept
+        """
+
+        self.items = deque(maxlen=size)
+        self.condition = Condition()
+        self.count = 0
+        self.callbacks = []
+
+    def put(self, job):
+        """
+        Adds a finished job, dropping the oldest one if the buffer is full, and calls the callbacks with it.
+
+        :param Job job: Job that finished or failed
+        """
+
+        with self.condition:
+            self.items.append(job)
+            self.count += 1
+            self.condition.notify_all()
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            try:
+                callback(job)
+            except Exception:
+                log.exception(f"Completion callback for {job.url} has failed")
+
+    def subscribe(self, callback):
+        """
+        :param callback: Function called with every job that finishes from now on, in the thread finishing it
+        """
+
+        with self.condition:
+            self.callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        """
+        :param callback: Function previously subscribed
+        """
+
+        with self.condition:
+            self.callbacks.remove(callback)
+
+    def recent(self):
+        """
+        :return list: Finished jobs still in the buffer, oldest first
+        """
+
+        with self.condition:
+            return list(self.items)
+
+    def follow(self, timeout=None, replay=False):
+        """
+        Yields the jobs as they finish.
+
+        :param float timeout: Seconds without any job finishing after which the iteration stops (optional, follows forever by default)
+        :param bool replay: Starts with the finished jobs still in the buffer, rather than with the next job to finish
+        :return: Iterator over finished jobs
+        """
+
+        with self.condition:
+            position = self.count - len(self.items) if replay else self.count
+        return self._follow(position, timeout)
+
+    def _follow(self, position, timeout):
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.count > position, timeout):
+                    return
+                first = self.count - len(self.items)
+                if position < first:
+                    log.warning(f"{first - position} finished jobs were dropped before they could be followed")
+                    position = first
+                jobs = list(islice(self.items, position - first, None))
+                position = self.count
+            yield from jobs
+
+    def stats(self):
+        """
+        :return dict: Number of jobs finished so far, and number of them still in the buffer
+        """
+
+        with self.condition:
+            return {'finished': self.count, 'kept': len(self.items)}
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 
+from threading import Lock
+
 from music2storage import log
-from music2storage.service import Youtube, Soundcloud, GoogleDrive, LocalStorage
+from music2storage.resilience import ServiceGuard
+from music2storage.service import GuardedRequests
 
 
 class ConnectionHandler:
@@ -12,46 +15,118 @@ class ConnectionHandler:
         self.current_storage = None
         self.music_services = {}
         self.storage_services = {}
+        self.guards = {}
+        self.guard_options = {}
+        self.guards_lock = Lock()
+
+    def limit_service(self, service_name, **options):
+        """
+        Sets the rate limit, retry policy and circuit breaker of the requests to a service.
+
+        :param str service_name: Name of the music or storage service
+        :param options: Options of the ServiceGuard of the service (e.g. rate=5, retries=3, failure_threshold=5, cooldown=30)
+        """
+
+        with self.guards_lock:
+            self.guard_options[service_name] = options
+            self.guards[service_name] = ServiceGuard(service_name, **options)
+        for service in list(self.music_services.values()) + list(self.storage_services.values()):
+            if service.name == service_name:
+                self._attach(service)
+
+    def guard(self, service):
+        """
+        Returns the guard every request to the service goes through, created with the default options if no limit was set.
+
+        :param service: Music or storage service
+        :return ServiceGuard: Guard of the service
+        """
+
+        with self.guards_lock:
+            if service.name not in self.guards:
+                self.guards[service.name] = ServiceGuard(service.name, **self.guard_options.get(service.name, {}))
+            return self.guards[service.name]
+
+    def _attach(self, service):
+        """
+        Gives its guard to a service that sends each of its requests through it.
 
-    def use_music_service(self, service_name, api_key):
+        :param service: Music or storage service
+        :return: The service that was passed as an argument
         """
-        Sets the current music service to service_name.
+
+        if isinstance(service, GuardedRequests):
+            service.guard = self.guard(service)
+        return service
+
+    def stats(self):
+        """
+        :return dict: Requests, retries, failures, rate limiter and circuit breaker state of every service used so far
+        """
+
+        with self.guards_lock:
+            guards = dict(self.guards)
+        return {name: guard.stats() for name, guard in guards.items()}
+
+    def use_music_service(self, service_name, api_key, **options):
+        """
+        Sets the current music service to service_name. The module of a service, and its dependencies, are imported on first use.
 
         :param str service_name: Name of the music service
         :param str api_key: Optional API key if necessary
+        :param options: Options passed to the music service when it is created (e.g. max_abr for youtube)
         """
 
         try:
             self.current_music = self.music_services[service_name]
         except KeyError:
             if service_name == 'youtube':
-                self.music_services['youtube'] = Youtube()
+                from music2storage.youtube import Youtube
+                self.music_services['youtube'] = self._attach(Youtube(**options))
                 self.current_music = self.music_services['youtube']
             elif service_name == 'soundcloud':
-                self.music_services['soundcloud'] = Soundcloud(api_key=api_key)
+                from music2storage.soundcloud import Soundcloud
+                self.music_services['soundcloud'] = self._attach(Soundcloud(api_key=api_key, **options))
                 self.current_music = self.music_services['soundcloud']
             else:
                 log.error('Music service name is not recognized.')
 
-    def use_storage_service(self, service_name, custom_path):
+    def music_for(self, url):
+        """
+        Routes a URL to the music service it points to, among the services used so far.
+
+        :param str url: URL of a track
+        :return MusicService: Service whose hosts match the URL, or the current music service if none does
+        """
+
+        for service in list(self.music_services.values()):
+            if service.handles(url):
+                return service
+        return self.current_music
+
+    def use_storage_service(self, service_name, custom_path, **options):
         """
-        Sets the current storage service to service_name and runs the connect method on the service.
+        Sets the current storage service to service_name and runs the connect method on the service. The module of a service, and its
+        dependencies, are imported on first use.
 
         :param str service_name: Name of the storage service
         :param str custom_path: Custom path where to download tracks for local storage (optional, and must already exist, use absolute paths only)
+        :param options: Options passed to the storage service when it is created (e.g. pool_size for google drive, sync_every for local)
         """
 
         try:
             self.current_storage = self.storage_services[service_name]
         except KeyError:
             if service_name == 'google drive':
-                self.storage_services['google drive'] = GoogleDrive()
+                from music2storage.googledrive import GoogleDrive
+                self.storage_services['google drive'] = self._attach(GoogleDrive(**options))
                 self.current_storage = self.storage_services['google drive']
                 self.current_storage.connect()
             elif service_name == 'dropbox':
                 log.error('Dropbox is not supported yet.')
             elif service_name == 'local':
-                self.storage_services['local'] = LocalStorage(custom_path=custom_path)
+                from music2storage.localstorage import LocalStorage
+                self.storage_services['local'] = LocalStorage(custom_path=custom_path, **options)
                 self.current_storage = self.storage_services['local']
                 self.current_storage.connect()
             else:
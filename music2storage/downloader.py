@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import re
+import sys
+from threading import Lock
+from time import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, RequestException
+from tqdm import tqdm
+
+from music2storage import log
+from music2storage.resilience import unguarded
+
+
+def resize_session(session, size):
+    """
+    Sizes the pool of HTTP connections a session keeps open per host.
+
+    :param Session session: Session of a service
+    :param int size: Number of connections kept open per host
+    """
+
+    adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+class RangedDownloader:
+    """
+    Downloads media over several HTTP connections at once, each fetching a range of bytes written in place into a preallocated file.
+
+    Progress is kept in a sidecar file next to the partial download, so a download interrupted by an error or a restart only
+    fetches the bytes it is missing. Servers that don't serve ranges are downloaded over one connection, from the start. Every
+    request is sent through the guard of the service, which retries a failed range from where it stopped.
+    """
+
+    def __init__(self, session=None, connections=4, segment_size=4 * 1024 * 1024, chunk_size=256 * 1024, progress_bar=True,
+                 guarded=unguarded):
+        """
+        :param Session session: Session the requests go through (optional, a new one is created otherwise)
+        :param int connections: Number of connections used by one download
+        :param int segment_size: Number of bytes fetched by one range request, files up to this size use a single connection
+        :param int chunk_size: Number of bytes read from a response at a time
+        :param bool progress_bar: Shows a progress bar on stdout for every download
+        :param function guarded: Function sending a request through the guard of the service, e.g. GuardedRequests.guarded
+                                 (optional, requests are sent directly and never retried by default)
+        """
+
+        self.session = session or requests.Session()
+        self.connections = connections
+        self.segment_size = segment_size
+        self.chunk_size = chunk_size
+        self.progress_bar = progress_bar
+        self.guarded = guarded
+
+    def _probe(self, url):
+        """
+        Asks for the first byte of the media, to learn its size and whether the server serves ranges.
+
+        :param str url: URL of the media
+        :return tuple: Size of the media in bytes (None if unknown), and True if ranges are served
+        """
+
+        with self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True) as r:
+            r.raise_for_status()
+            match = re.match(r'bytes \d+-\d+/(\d+)', r.headers.get('Content-Range', ''))
+            if r.status_code == 206 and match:
+                return int(match.group(1)), True
+            length = r.headers.get('Content-Length')
+            return (int(length) if length else None), False
+
+    def _load_progress(self, progress_file, part_file, size):
+        """
+        :param str progress_file: Filename of the sidecar progress map
+        :param str part_file: Filename of the partial download
+        :param int size: Size of the media in bytes
+        :return dict: Number of bytes already written by segment start offset, empty if the download can't be resumed
+        """
+
+        try:
+            with open(progress_file) as f:
+                progress = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if progress.get('size') != size or progress.get('segment_size') != self.segment_size or not os.path.exists(part_file):
+            return {}
+        return {int(start): written for start, written in progress['segments'].items()}
+
+    def _save_progress(self, progress_file, size, segments):
+        """Writes the progress map atomically, so an interruption never leaves it half written."""
+
+        with open(progress_file + '.tmp', 'w') as f:
+            json.dump({'size': size, 'segment_size': self.segment_size, 'segments': segments}, f)
+        os.replace(progress_file + '.tmp', progress_file)
+
+    def _fetch_segment(self, url, fd, start, end, state):
+        """
+        Fetches the bytes from start to end (inclusive) that aren't written yet, so a retry resumes where a failed request stopped.
+
+        :param str url: URL of the media
+        :param int fd: File descriptor of the partial download
+        :param int start: Offset of the first byte of the segment
+        :param int end: Offset of the last byte of the segment
+        :param dict state: Progress map, lock, sidecar filename and progress bar shared by the segments of the download
+        """
+
+        offset = start + state['segments'].get(start, 0)
+        if offset > end:
+            return
+        with self.session.get(url, headers={'Range': f"bytes={offset}-{end}"}, stream=True) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise RequestException(f"Range request for {url} was answered with status {r.status_code}")
+            for data in r.iter_content(self.chunk_size):
+                data = data[:end + 1 - offset]
+                os.pwrite(fd, data, offset)
+                offset += len(data)
+                with state['lock']:
+                    state['segments'][start] = offset - start
+                    if state['bar'] is not None:
+                        state['bar'].update(len(data))
+                    if time() - state['saved_at'] >= 1:
+                        self._save_progress(state['progress_file'], state['size'], state['segments'])
+                        state['saved_at'] = time()
+        if offset <= end:
+            raise ConnectionError(f"Range request for {url} ended {end + 1 - offset} bytes early")
+
+    def _download_ranges(self, url, file_name, size, desc):
+        """Downloads the media in segments fetched in parallel, resuming from the sidecar progress map if there is one."""
+
+        part_file = file_name + '.part'
+        progress_file = file_name + '.progress'
+        segments = self._load_progress(progress_file, part_file, size)
+        if segments:
+            log.info(f"Resuming download of {file_name} with {sum(segments.values())} of {size} bytes already fetched")
+
+        fd = os.open(part_file, os.O_RDWR | os.O_CREAT)
+        try:
+            if not segments:
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except (AttributeError, OSError):
+                    os.ftruncate(fd, size)
+            done = sum(segments.values())
+            bar = tqdm(desc=desc, total=size, initial=done, unit='B', unit_scale=True, file=sys.stdout) if self.progress_bar else None
+            state = {'segments': segments, 'lock': Lock(), 'progress_file': progress_file, 'size': size, 'bar': bar,
+                     'saved_at': time()}
+            ranges = [(start, min(start + self.segment_size, size) - 1) for start in range(0, size, self.segment_size)]
+            try:
+                with ThreadPoolExecutor(self.connections) as executor:
+                    for future in [executor.submit(self.guarded, self._fetch_segment, url, fd, start, end, state)
+                                   for start, end in ranges]:
+                        future.result()
+            finally:
+                with state['lock']:
+                    self._save_progress(progress_file, size, segments)
+                if bar is not None:
+                    bar.close()
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(part_file, file_name)
+        os.remove(progress_file)
+
+    def _download_whole(self, url, file_name, size, desc):
+        """Downloads the media over one connection, from the start, for servers that don't serve ranges."""
+
+        part_file = file_name + '.part'
+        with self.session.get(url, stream=True) as r:
+            r.raise_for_status()
+            with open(part_file, 'wb') as f:
+                bar = tqdm(desc=desc, total=size, unit='B', unit_scale=True, file=sys.stdout) if self.progress_bar else None
+                try:
+                    for data in r.iter_content(self.chunk_size):
+                        f.write(data)
+                        if bar is not None:
+                            bar.update(len(data))
+                finally:
+                    if bar is not None:
+                        bar.close()
+        os.replace(part_file, file_name)
+
+    def download(self, url, file_name, desc=None):
+        """
+        Downloads the media at the URL into the file, over several connections when the server serves ranges.
+
+        The file only appears under its name once complete; until then the bytes are in a .part file next to a .progress map.
+
+        :param str url: URL of the media
+        :param str file_name: Filename of the file in local storage
+        :param str desc: Description shown by the progress bar (optional, the filename by default)
+        :return str: Filename of the file in local storage
+        """
+
+        size, ranged = self.guarded(self._probe, url)
+        log.info(f"Download for {file_name} has started ({size} bytes, {'ranged' if ranged else 'single connection'})")
+        start_time = time()
+        if ranged and size > self.segment_size:
+            self._download_ranges(url, file_name, size, desc or file_name)
+        else:
+            self.guarded(self._download_whole, url, file_name, size, desc or file_name)
+        log.info(f"Download for {file_name} has finished in {time() - start_time} seconds")
+        return file_name
@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+import hashlib
+import os
+from queue import Empty, LifoQueue
+from threading import Lock
+from time import time
+
+from apiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload, MediaUpload
+from httplib2 import Http
+from oauth2client import file, client, tools
+from oauth2client.clientsecrets import InvalidClientSecretsError
+
+from music2storage import log
+from music2storage.resilience import unguarded
+from music2storage.service import GuardedRequests, StorageService
+from music2storage.sessions import UploadSessionStore
+
+
+class StreamMediaUpload(MediaUpload):
+    """Resumable media body for Google Drive that reads from a non-seekable stream, such as the stdout of FFmpeg."""
+
+    def __init__(self, stream, mimetype='audio/mpeg', chunksize=4 * 1024 * 1024):
+        """
+        Creates a media body of unknown size that reads the stream one chunk at a time.
+
+        :param stream: File-like object with a read method
+        :param str mimetype: MIME type of the media
+        :param int chunksize: Number of bytes sent per request (must be a multiple of 256 KiB)
+        """
+
+        self._stream = stream
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._buffer = b''
+        self._buffer_start = 0
+        self.md5 = hashlib.md5()
+        self.total = 0
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def resumable(self):
+        return True
+
+    def getbytes(self, begin, length):
+        """
+        Returns length bytes starting at the begin offset. Bytes before begin are dropped, so a chunk can be sent again but not older ones.
+
+        :param int begin: Offset of the first byte
+        :param int length: Number of bytes wanted, fewer are returned at the end of the stream
+        :return bytes: Bytes of the media
+        """
+
+        if begin < self._buffer_start:
+            raise ValueError(f"Offset {begin} was already dropped from the stream buffer.")
+        self._buffer = self._buffer[begin - self._buffer_start:]
+        self._buffer_start = begin
+
+        while len(self._buffer) < length:
+            data = self._stream.read(length - len(self._buffer))
+            if not data:
+                break
+            self.md5.update(data)
+            self.total += len(data)
+            self._buffer += data
+
+        return self._buffer[:length]
+
+
+class DriveClientPool:
+    """
+    Pool of Google Drive API clients checked out per request.
+
+    Every client has its own httplib2.Http, which is not thread-safe, while the credentials are shared by the whole pool and
+    refreshed once when they expire instead of once per client.
+    """
+
+    def __init__(self, factory, size=4, credentials=None):
+        """
+        :param factory: Callable building a new client, called lazily until the pool holds size clients
+        :param int size: Maximum number of clients, and so of requests running at once
+        :param credentials: OAuth2 credentials shared by the clients (optional)
+        """
+
+        self.factory = factory
+        self.size = size
+        self.credentials = credentials
+        self.clients = LifoQueue()
+        self.created = 0
+        self.lock = Lock()
+        self.refresh_lock = Lock()
+
+    def _refresh(self):
+        """Refreshes the shared credentials if they expired, letting only one thread do it."""
+
+        if self.credentials is None or not self.credentials.access_token_expired:
+            return
+        with self.refresh_lock:
+            if self.credentials.access_token_expired:
+                log.info('Refreshing Google Drive credentials')
+                self.credentials.refresh(Http())
+
+    @contextmanager
+    def client(self):
+        """
+        Checks out a client for the duration of the block, waiting for one to be returned if all of them are in use.
+
+        :return: Google Drive API client
+        """
+
+        self._refresh()
+        try:
+            connection = self.clients.get_nowait()
+        except Empty:
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            connection = self.factory() if create else self.clients.get()
+        try:
+            yield connection
+        finally:
+            self.clients.put(connection)
+
+
+class DriveFolderIndex:
+    """
+    Names and IDs of the files in a Google Drive folder, listed page by page once and then kept up to date from the changes feed.
+
+    Uploads made through GoogleDrive are added as they finish, so the feed is only needed for changes made elsewhere.
+    """
+
+    def __init__(self, folder_id, refresh_interval=60, page_size=1000, guarded=unguarded):
+        """
+        :param str folder_id: ID of the folder in Google Drive
+        :param float refresh_interval: Seconds after which changes are pulled again before a lookup
+        :param int page_size: Number of files or changes requested per page
+        :param function guarded: Function sending a request through the guard of the service (optional, sent directly by default)
+        """
+
+        self.folder_id = folder_id
+        self.refresh_interval = refresh_interval
+        self.page_size = page_size
+        self.guarded = guarded
+        self.files = {}
+        self.names = {}
+        self.page_token = None
+        self.refreshed_at = None
+        self.lock = Lock()
+
+    def _load(self, connection):
+        """Lists every file of the folder, following the pages, and notes where the changes feed starts."""
+
+        self.page_token = self.guarded(connection.changes().getStartPageToken().execute)['startPageToken']
+        query = f"'{self.folder_id}' in parents and trashed=false"
+        request = connection.files().list(q=query, pageSize=self.page_size, fields='nextPageToken, files(id, name)')
+        while request is not None:
+            response = self.guarded(request.execute)
+            for item in response.get('files', []):
+                self._add(item['name'], item['id'])
+            request = connection.files().list_next(request, response)
+        log.info(f"Indexed {len(self.files)} files of the Google Drive folder")
+
+    def _pull_changes(self, connection):
+        """Applies the changes made since the last pull, following the pages of the changes feed."""
+
+        while self.page_token is not None:
+            response = self.guarded(connection.changes().list(
+                pageToken=self.page_token, pageSize=self.page_size,
+                fields='nextPageToken, newStartPageToken, changes(fileId, removed, file(name, parents, trashed))').execute)
+            for change in response.get('changes', []):
+                item = change.get('file') or {}
+                if change.get('removed') or item.get('trashed') or self.folder_id not in item.get('parents', []):
+                    self._remove(change['fileId'])
+                else:
+                    self._remove(change['fileId'])
+                    self._add(item['name'], change['fileId'])
+            if 'newStartPageToken' in response:
+                self.page_token = response['newStartPageToken']
+                break
+            self.page_token = response['nextPageToken']
+
+    def _add(self, name, file_id):
+        self.files[name] = file_id
+        self.names[file_id] = name
+
+    def _remove(self, file_id):
+        name = self.names.pop(file_id, None)
+        if name is not None and self.files.get(name) == file_id:
+            del self.files[name]
+
+    def refresh(self, connection, force=False):
+        """
+        Loads the index on first use, then pulls the changes if the refresh interval has passed.
+
+        :param connection: Google Drive API client
+        :param bool force: Pulls the changes even if the refresh interval hasn't passed
+        """
+
+        with self.lock:
+            if self.refreshed_at is None:
+                self._load(connection)
+            elif force or time() - self.refreshed_at >= self.refresh_interval:
+                self._pull_changes(connection)
+            else:
+                return
+            self.refreshed_at = time()
+
+    def get(self, name):
+        """
+        :param str name: Name of a file
+        :return str: ID of the file with that name in the folder, or None if there is none
+        """
+
+        with self.lock:
+            return self.files.get(name)
+
+    def add(self, name, file_id):
+        """
+        Records a file uploaded to the folder.
+
+        :param str name: Name of the file
+        :param str file_id: ID of the file in Google Drive
+        """
+
+        with self.lock:
+            self._add(name, file_id)
+
+
+class GoogleDrive(GuardedRequests, StorageService):
+    """Google Drive service class."""
+
+    FOLDER_QUERY = "name='Music' and mimeType='application/vnd.google-apps.folder' and trashed=false"
+
+    def __init__(self, pool_size=4, index_folder=False, existing=None, refresh_interval=60, chunk_size=8 * 1024 * 1024,
+                 sessions=None):
+        """
+        :param int pool_size: Number of API clients, and so of requests to Google Drive running at once
+        :param bool index_folder: Keeps an index of the files already in the Music folder, so existing names are known without a query
+        :param str existing: What to do when a file with the same name is already in the Music folder, 'skip' to keep it and not
+                             upload, 'version' to upload under a numbered name (needs index_folder, files are always uploaded otherwise)
+        :param float refresh_interval: Seconds after which the index pulls the changes made to the folder elsewhere
+        :param int chunk_size: Number of bytes sent per request by resumable uploads (must be a multiple of 256 KiB)
+        :param str sessions: Path to a SQLite file where the session URIs of resumable uploads are kept, so an upload interrupted by a
+                             restart continues where it stopped (optional, sessions are only resumed within an upload otherwise)
+        """
+
+        self.name = 'google drive'
+        self.pool = None
+        self.pool_size = pool_size
+        self.folder_id = None
+        self.folder_lock = Lock()
+        self.index = None
+        self.index_folder = index_folder
+        self.existing = existing
+        self.refresh_interval = refresh_interval
+        self.chunk_size = chunk_size
+        self.sessions = UploadSessionStore(sessions) if sessions else None
+
+    def connect(self):
+        """Creates the pool of connections to the Google Drive API used to make requests, and resolves the Music folder, creating it if it doesn't exist."""
+
+        SCOPES = 'https://www.googleapis.com/auth/drive'
+        store = file.Storage('drive_credentials.json')
+        creds = store.get()
+        if not creds or creds.invalid:
+            try:
+                flow = client.flow_from_clientsecrets('client_secret.json', SCOPES)
+            except InvalidClientSecretsError:
+                log.error('ERROR: Could not find client_secret.json in current directory, please obtain it from the API console.')
+                return
+            creds = tools.run_flow(flow, store)
+        self.pool = DriveClientPool(lambda: build('drive', 'v3', http=creds.authorize(Http())), size=self.pool_size,
+                                    credentials=creds)
+
+        with self.pool.client() as connection:
+            self._folder(connection)
+
+    def _folder(self, connection, stale=None):
+        """
+        Returns the ID of the Music folder, resolved once and cached until it turns out to be gone.
+
+        :param connection: Google Drive API client
+        :param str stale: Cached ID that was found to be gone, resolved again unless another thread already did it (optional)
+        :return str: ID of the Music folder
+        """
+
+        with self.folder_lock:
+            if self.folder_id is not None and self.folder_id != stale:
+                return self.folder_id
+
+            response = self.guarded(connection.files().list(q=self.FOLDER_QUERY).execute)
+            try:
+                self.folder_id = response.get('files', [])[0]['id']
+            except IndexError:
+                log.warning('Music folder is missing. Creating it.')
+                folder_metadata = {'name': 'Music', 'mimeType': 'application/vnd.google-apps.folder'}
+                self.folder_id = self.guarded(connection.files().create(body=folder_metadata, fields='id').execute)['id']
+            if self.index_folder:
+                self.index = DriveFolderIndex(self.folder_id, refresh_interval=self.refresh_interval, guarded=self.guarded)
+            return self.folder_id
+
+    def _target(self, connection, file_name):
+        """
+        Chooses the name a file is uploaded under, according to what is already in the Music folder.
+
+        :param connection: Google Drive API client
+        :param str file_name: Name of the file
+        :return tuple: Name to upload the file under, and ID of the existing file if the upload should be skipped
+        """
+
+        if self.index is None or self.existing not in ('skip', 'version'):
+            return file_name, None
+        self.index.refresh(connection)
+        existing_id = self.index.get(file_name)
+        if existing_id is None:
+            return file_name, None
+        if self.existing == 'skip':
+            return file_name, existing_id
+
+        base, extension = os.path.splitext(file_name)
+        version = 2
+        while self.index.get(f"{base} ({version}){extension}") is not None:
+            version += 1
+        return f"{base} ({version}){extension}", None
+
+    def _is_missing_folder(self, error):
+        """
+        :param HttpError error: Error raised by a request creating a file in the Music folder
+        :return bool: True if the request failed because the Music folder is gone
+        """
+
+        return isinstance(error, HttpError) and error.resp.status == 404
+
+    def _upload_resumable(self, connection, file_name, name, folder_id, resume=True):
+        """
+        Uploads the file through a resumable upload session, one chunk at a time, logging the throughput of every chunk.
+
+        Every chunk goes through the guard of the service, so a chunk interrupted by a connection error is retried from the last byte
+        Google Drive confirmed. If a session store is used, the session URI is kept there until the upload is done, so a session left
+        by a previous run is resumed as well. If that session has expired, the upload starts over once in a new session.
+
+        :param connection: Google Drive API client
+        :param str file_name: Filename of the file to be uploaded
+        :param str name: Name of the file in Google Drive
+        :param str folder_id: ID of the Music folder
+        :param bool resume: Whether to resume the session kept in the session store
+        :return dict: Response of Google Drive for the new file
+        """
+
+        media = MediaFileUpload(file_name, mimetype='audio/mpeg', chunksize=self.chunk_size, resumable=True)
+        request = connection.files().create(body={'name': name, 'parents': [folder_id]}, media_body=media, fields='id')
+        uri = self.sessions.get(file_name) if self.sessions and resume else None
+        resumed = uri is not None
+        if resumed:
+            # The next chunk then starts with a status query, which moves the offset to the last byte Google Drive confirmed
+            request.resumable_uri = uri
+            request._in_error_state = True
+            log.info(f"Resuming upload session for {file_name}")
+
+        response = None
+        while response is None:
+            offset, chunk_start = request.resumable_progress, time()
+            try:
+                _, response = self.guarded(request.next_chunk)
+            except HttpError as e:
+                if not resumed or e.resp.status not in (404, 410):
+                    raise
+                log.warning(f"Upload session for {file_name} expired, starting a new one")
+                self.sessions.remove(file_name)
+                return self._upload_resumable(connection, file_name, name, folder_id, resume=False)
+            finally:
+                if self.sessions and request.resumable_uri is not None and request.resumable_uri != uri:
+                    uri = request.resumable_uri
+                    self.sessions.add(file_name, uri)
+
+            sent = (media.size() if response is not None else request.resumable_progress) - offset
+            log.info(f"Upload for {file_name}: {offset + sent} of {media.size()} bytes sent, chunk of {sent} bytes at "
+                     f"{sent / max(time() - chunk_start, 1e-6) / 1e6:.2f} MB/s")
+
+        if self.sessions:
+            self.sessions.remove(file_name)
+        return response
+
+    def upload(self, file_name):
+        """
+        Uploads the file associated with the file_name passed to Google Drive in the Music folder, through a resumable upload.
+
+        :param str file_name: Filename of the file to be uploaded
+        :return str: ID of the new file in Google Drive, or of the existing one if the upload was skipped
+        """
+
+        with self.pool.client() as connection:
+            folder_id = self._folder(connection)
+            name, existing_id = self._target(connection, os.path.basename(file_name))
+            if existing_id is not None:
+                log.info(f"{file_name} is already in Google Drive, skipping upload")
+                return existing_id
+
+            log.info(f"Upload for {file_name} has started")
+            start_time = time()
+            try:
+                response = self._upload_resumable(connection, file_name, name, folder_id)
+            except HttpError as e:
+                if not self._is_missing_folder(e):
+                    raise
+                log.warning('Music folder is gone, resolving it again')
+                folder_id = self._folder(connection, stale=folder_id)
+                response = self._upload_resumable(connection, file_name, name, folder_id)
+            end_time = time()
+        if self.index is not None:
+            self.index.add(name, response['id'])
+        log.info(f"Upload for {file_name} has finished in {end_time - start_time} seconds")
+
+        return response['id']
+
+    def upload_stream(self, stream, file_name, chunk_size=None):
+        """
+        Uploads a file read from a stream to Google Drive in the Music folder, through a resumable upload session fed one chunk at a time.
+
+        Once the upload is done, its size and MD5 checksum are compared with the ones computed by Google Drive. A stream can't be read
+        twice, so if the Music folder turns out to be gone the upload fails, and only the next one goes to the folder resolved again.
+
+        :param stream: File-like object with a read method, read until it returns no bytes
+        :param str file_name: Filename of the file in Google Drive
+        :param int chunk_size: Number of bytes sent per request (must be a multiple of 256 KiB, chunk_size of the service by default)
+        :return str: ID of the new file in Google Drive (or of the existing one if the upload was skipped), or None if the checks failed
+        """
+
+        with self.pool.client() as connection:
+            folder_id = self._folder(connection)
+            name, existing_id = self._target(connection, os.path.basename(file_name))
+            if existing_id is not None:
+                log.info(f"{file_name} is already in Google Drive, skipping upload")
+                return existing_id
+            file_metadata = {'name': name, 'parents': [folder_id]}
+            media = StreamMediaUpload(stream, mimetype='audio/mpeg', chunksize=chunk_size or self.chunk_size)
+
+            log.info(f"Streaming upload for {file_name} has started")
+            start_time = time()
+            request = connection.files().create(body=file_metadata, media_body=media, fields='id,size,md5Checksum')
+            response = None
+            try:
+                while response is None:
+                    _, response = self.guarded(request.next_chunk, retry=False)
+            except HttpError as e:
+                if self._is_missing_folder(e):
+                    log.warning('Music folder is gone, resolving it again')
+                    self._folder(connection, stale=folder_id)
+                raise
+            end_time = time()
+
+            if int(response.get('size', -1)) != media.total or response.get('md5Checksum') != media.md5.hexdigest():
+                log.error(f"Streaming upload for {file_name} does not match what was sent, deleting it from Google Drive")
+                self.guarded(connection.files().delete(fileId=response['id']).execute)
+                return None
+        if self.index is not None:
+            self.index.add(name, response['id'])
+        log.info(f"Streaming upload for {file_name} has finished in {end_time - start_time} seconds after sending {media.total} bytes")
+
+        return response['id']
@@ -1,51 +1,357 @@
 # -*- coding: utf-8 -*-
 
+from functools import lru_cache
+import json
 import os
 import subprocess
-from time import time
-
-from ffmpy import FFmpeg, FFRuntimeError
+from threading import Lock, Thread
+from time import sleep, time
 
 from music2storage import log
 
 
-def convert_to_mp3(file_name, delete_queue):
+MP3_PRESETS = {
+    'v0': ['-codec:a', 'libmp3lame', '-q:a', '0'],
+    'v2': ['-codec:a', 'libmp3lame', '-q:a', '2'],
+    'v5': ['-codec:a', 'libmp3lame', '-q:a', '5'],
+    '128k': ['-codec:a', 'libmp3lame', '-b:a', '128k'],
+    '192k': ['-codec:a', 'libmp3lame', '-b:a', '192k'],
+    '320k': ['-codec:a', 'libmp3lame', '-b:a', '320k'],
+}
+"""FFmpeg options of the MP3 encoding presets, VBR quality levels (v0 to v5) or constant bitrates."""
+
+_transcode_speed = {'seconds_per_audio_second': None}
+_transcode_speed_lock = Lock()
+
+
+def ffmpeg_command(file_name, new_file_name, threads=None, output_format=None, options=None):
+    """
+    Builds the FFmpeg command converting file_name into new_file_name.
+
+    :param str file_name: Filename of the original file in local storage (or pipe:0 for stdin)
+    :param str new_file_name: Filename of the new file in local storage (or pipe:1 for stdout)
+    :param int threads: Number of threads FFmpeg may use (optional, FFmpeg decides by default)
+    :param str output_format: Format of the new file, needed when it can't be guessed from its name (optional)
+    :param list options: Output options such as codec and bitrate (optional)
+    :return list: FFmpeg command and its arguments
+    """
+
+    cmd = ['ffmpeg', '-y', '-i', file_name]
+    if threads:
+        cmd += ['-threads', str(threads)]
+    if options:
+        cmd += options
+    if output_format:
+        cmd += ['-f', output_format]
+    cmd.append(new_file_name)
+    return cmd
+
+
+def run_ffmpeg(cmd):
+    """
+    Runs an FFmpeg command and waits for it to finish.
+
+    :param list cmd: FFmpeg command and its arguments
+    :return float: CPU time (user and system) used by the FFmpeg process in seconds, or None if the platform can't report it
+    """
+
+    process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        cpu_time = usage.ru_utime + usage.ru_stime
+    else:
+        process.wait()
+        cpu_time = None
+
+    if process.returncode != 0:
+        from ffmpy import FFRuntimeError
+        raise FFRuntimeError(subprocess.list2cmdline(cmd), process.returncode, None, None)
+    return cpu_time
+
+
+@lru_cache(maxsize=1024)
+def _probe(file_name, size, mtime):
+    """
+    Runs FFprobe on the file. Cached by size and modification time, so a file that changed is probed again.
+
+    :param str file_name: Absolute filename of the file
+    :param int size: Size of the file in bytes
+    :param int mtime: Modification time of the file in nanoseconds
+    :return dict: Format and streams of the file as reported by FFprobe, or None if it could not be probed
+    """
+
+    cmd = ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', file_name]
+    try:
+        output = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+        return json.loads(output.decode())
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+
+def probe(file_name):
     """
-    Converts the file associated with the file_name passed into a MP3 file.
+    Returns the FFprobe description of the file, from a cache when the file didn't change since it was last probed.
+
+    :param str file_name: Filename of the file in local storage
+    :return dict: Format and streams of the file as reported by FFprobe, or None if it could not be probed
+    """
+
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return _probe(os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)
+
+
+def audio_info(file_name):
+    """
+    Returns the codec and duration of the first audio stream of the file.
+
+    :param str file_name: Filename of the file in local storage
+    :return tuple: Name of the audio codec and duration in seconds, each None if unknown
+    """
+
+    info = probe(file_name)
+    if not info:
+        return None, None
+    audio = next((stream for stream in info.get('streams', []) if stream.get('codec_type') == 'audio'), {})
+    duration = audio.get('duration') or info.get('format', {}).get('duration')
+    return audio.get('codec_name'), float(duration) if duration else None
+
+
+def conversion_path(file_name, codec=None):
+    """
+    Chooses the cheapest way to get a MP3 file out of the file.
+
+    MP3 files are kept as they are, MP3 audio inside another container is copied without re-encoding, and anything else is transcoded.
+    The file is only probed when the codec is not already known.
+
+    :param str file_name: Filename of the file in local storage
+    :param str codec: Audio codec of the file, if already known (optional)
+    :return tuple: Path ('skip', 'copy' or 'transcode') and duration of the audio in seconds (None if the file wasn't probed)
+    """
+
+    if os.path.splitext(file_name)[1] == '.mp3' and codec in (None, 'mp3'):
+        return 'skip', None
+
+    duration = None
+    if codec is None:
+        codec, duration = audio_info(file_name)
+    return ('copy' if codec == 'mp3' else 'transcode'), duration
+
+
+def conversion_plan(file_name, threads=None, codec=None, preset=None):
+    """
+    Plans the conversion of the file into a MP3 file, through the cheapest path available.
 
     :param str file_name: Filename of the original file in local storage
-    :param Queue delete_queue: Delete queue to add the original file to after conversion is done
-    :return str: Filename of the new file in local storage
+    :param int threads: Number of threads FFmpeg may use (optional, FFmpeg decides by default)
+    :param str codec: Audio codec of the file, if already known (optional, the file is probed otherwise)
+    :param str preset: Name of the MP3 encoding preset from MP3_PRESETS (optional, FFmpeg defaults otherwise)
+    :return tuple: Path ('skip', 'copy' or 'transcode'), duration of the audio in seconds (None if the file wasn't probed), filename
+                   of the new file and FFmpeg command (the original filename and None when the file is kept as it is)
     """
 
+    path, duration = conversion_path(file_name, codec=codec)
+    if path == 'skip':
+        return path, duration, file_name, None
 
-    file = os.path.splitext(file_name)
+    root = os.path.splitext(file_name)[0]
+    new_file_name = root + '.mp3'
+    if new_file_name == file_name:
+        new_file_name = root + '.converted.mp3'
+    options = ['-vn'] + (['-codec:a', 'copy'] if path == 'copy' else MP3_PRESETS.get(preset, []))
+    return path, duration, new_file_name, ffmpeg_command(file_name, new_file_name, threads=threads, options=options)
 
-    if file[1] == '.mp3':
+
+def convert_to_mp3(file_name, delete_queue, threads=None, retries=1, backoff=1, codec=None, preset=None):
+    """
+    Converts the file associated with the file_name passed into a MP3 file, through the cheapest path available.
+
+    A failed conversion is retried after an exponentially growing delay.
+
+    :param str file_name: Filename of the original file in local storage
+    :param Queue delete_queue: Delete queue to add the original file to after conversion is done
+    :param int threads: Number of threads FFmpeg may use (optional, FFmpeg decides by default)
+    :param int retries: Number of times a failed conversion is retried
+    :param float backoff: Seconds to wait before the first retry, doubled for every following one
+    :param str codec: Audio codec of the file, if already known (optional, the file is probed otherwise)
+    :param str preset: Name of the MP3 encoding preset from MP3_PRESETS (optional, FFmpeg defaults otherwise)
+    :return str: Filename of the new file in local storage, or None if the conversion failed
+    """
+
+    from ffmpy import FFRuntimeError
+
+    path, duration, new_file_name, cmd = conversion_plan(file_name, threads=threads, codec=codec, preset=preset)
+    if path == 'skip':
         log.info(f"{file_name} is already a MP3 file, no conversion needed.")
         return file_name
 
-    new_file_name = file[0] + '.mp3'
+    log.info(f"Conversion for {file_name} has started using the {path} path")
+    start_time = time()
+    for attempt in range(retries + 1):
+        try:
+            cpu_time = run_ffmpeg(cmd)
+        except (FFRuntimeError, OSError) as error:
+            if os.path.exists(new_file_name):
+                os.remove(new_file_name)
+            if attempt == retries:
+                log.error(f"Conversion for {file_name} has failed: {error}")
+                return None
+            delay = backoff * 2 ** attempt
+            log.warning(f"Conversion for {file_name} has failed, retrying in {delay} seconds")
+            sleep(delay)
+        else:
+            break
+    end_time = time()
+    log.info(f"Conversion for {file_name} has finished in {end_time - start_time} seconds using {cpu_time} seconds of CPU time")
+    _record_conversion(file_name, path, duration, end_time - start_time)
+
+    delete_queue.put(file_name)
+    return new_file_name
+
+
+def _record_conversion(file_name, path, duration, elapsed):
+    """
+    Keeps a moving average of the transcoding speed, and logs the time a stream copy saved compared to transcoding.
+
+    :param str file_name: Filename of the original file
+    :param str path: Path the conversion took ('copy' or 'transcode')
+    :param float duration: Duration of the audio in seconds (None if unknown)
+    :param float elapsed: Seconds the conversion took
+    """
+
+    if not duration:
+        return
+    with _transcode_speed_lock:
+        speed = _transcode_speed['seconds_per_audio_second']
+        if path == 'transcode':
+            rate = elapsed / duration
+            _transcode_speed['seconds_per_audio_second'] = rate if speed is None else speed + 0.2 * (rate - speed)
+    if path == 'copy' and speed is not None:
+        log.info(f"Stream copy for {file_name} saved about {max(0.0, speed * duration - elapsed):.1f} seconds of transcoding")
+
+
+def transcode_stream(chunks, new_file_name, threads=None, preset=None):
+    """
+    Converts media arriving as a stream of bytes into a MP3 file, by piping the chunks into FFmpeg as they arrive.
+
+    The source never touches local storage, and conversion overlaps with the download. Containers that need seeking to be read
+    (MP4 files with their index at the end) can't be streamed this way.
+
+    :param iterable chunks: Chunks of bytes of the original media
+    :param str new_file_name: Filename of the new file in local storage
+    :param int threads: Number of threads FFmpeg may use (optional, FFmpeg decides by default)
+    :param str preset: Name of the MP3 encoding preset from MP3_PRESETS (optional, FFmpeg defaults otherwise)
+    :return str: Filename of the new file in local storage, or None if the conversion failed
+    """
 
-    ff = FFmpeg(
-        inputs={file_name: None},
-        outputs={new_file_name: None}
-    )
+    cmd = ffmpeg_command('pipe:0', new_file_name, threads=threads, options=['-vn'] + MP3_PRESETS.get(preset, []))
 
-    log.info(f"Conversion for {file_name} has started")
+    log.info(f"Streaming conversion for {new_file_name} has started")
     start_time = time()
     try:
-        ff.run(stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except FFRuntimeError:
-        os.remove(new_file_name)
-        ff.run(stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as error:
+        log.error(f"Streaming conversion for {new_file_name} has failed: {error}")
+        return None
+
+    received = 0
+    error = None
+    try:
+        for chunk in chunks:
+            process.stdin.write(chunk)
+            received += len(chunk)
+    except BrokenPipeError:
+        pass
+    except Exception as download_error:
+        error = download_error
+        process.kill()
+    try:
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+    exit_code = process.wait()
+
+    if error is not None or exit_code != 0:
+        log.error(f"Streaming conversion for {new_file_name} has failed: {error or f'exit code {exit_code}'}")
+        if os.path.exists(new_file_name):
+            os.remove(new_file_name)
+        return None
     end_time = time()
-    log.info(f"Conversion for {file_name} has finished in {end_time - start_time} seconds")
+    log.info(f"Streaming conversion for {new_file_name} has finished in {end_time - start_time} seconds after receiving {received} bytes")
 
-    delete_queue.put(file_name)
     return new_file_name
 
 
+class TranscodedStream:
+    """MP3 output of an FFmpeg process read as a stream, so it can be uploaded while the conversion is still running."""
+
+    def __init__(self, source, threads=None, preset=None):
+        """
+        Starts FFmpeg on the source, writing the MP3 to its stdout.
+
+        :param source: Filename of the original file in local storage, or an iterable of chunks of its bytes (fed to FFmpeg from a thread)
+        :param int threads: Number of threads FFmpeg may use (optional, FFmpeg decides by default)
+        :param str preset: Name of the MP3 encoding preset from MP3_PRESETS (optional, FFmpeg defaults otherwise)
+        """
+
+        from_file = isinstance(source, str)
+        self.cmd = ffmpeg_command(source if from_file else 'pipe:0', 'pipe:1', threads=threads, output_format='mp3',
+                                  options=['-vn'] + MP3_PRESETS.get(preset, []))
+        self.feed_error = None
+        self.process = subprocess.Popen(self.cmd, stdin=subprocess.DEVNULL if from_file else subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if not from_file:
+            Thread(target=self._feed, args=(source,), daemon=True).start()
+
+    def _feed(self, chunks):
+        """
+        Writes the chunks to the stdin of FFmpeg, and kills it if the chunks can't be read so the stream doesn't end as if it was complete.
+
+        :param iterable chunks: Chunks of bytes of the original media
+        """
+
+        try:
+            for chunk in chunks:
+                self.process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        except Exception as error:
+            self.feed_error = error
+            self.process.kill()
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    def read(self, size=-1):
+        """
+        Reads MP3 bytes from FFmpeg.
+
+        :param int size: Maximum number of bytes to read (-1 reads until the end)
+        :return bytes: MP3 bytes, or no bytes once FFmpeg has successfully finished
+        :raise FFRuntimeError: If FFmpeg or the source failed, once the end of the stream is reached
+        """
+
+        data = self.process.stdout.read(size)
+        if not data:
+            exit_code = self.process.wait()
+            if self.feed_error is not None or exit_code != 0:
+                from ffmpy import FFRuntimeError
+                raise FFRuntimeError(subprocess.list2cmdline(self.cmd), exit_code, None, str(self.feed_error or '').encode())
+        return data
+
+    def close(self):
+        """Stops FFmpeg if it is still running and releases its pipes."""
+
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+
+
 def delete_local_file(file_name):
     """
     Deletes the file associated with the file_name passed from local storage.
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+from threading import Lock
+from time import time
+
+
+class TrackIndex:
+    """Persistent index of the tracks already stored, keyed by storage service and canonical track ID."""
+
+    def __init__(self, path):
+        """
+        Opens (or creates) the track index at the given path.
+
+        :param str path: Path to the SQLite database file
+        """
+
+        self.path = path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS tracks ('
+            'storage TEXT NOT NULL, track_id TEXT NOT NULL, location TEXT NOT NULL, stored_at REAL NOT NULL, '
+            'PRIMARY KEY (storage, track_id))'
+        )
+
+    def get(self, storage, track_id):
+        """
+        Looks up where a track was stored.
+
+        :param str storage: Name of the storage service
+        :param str track_id: Canonical ID of the track
+        :return str: Location of the stored track (Drive file ID or local path), or None if it was never stored
+        """
+
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT location FROM tracks WHERE storage = ? AND track_id = ?', (storage, track_id)
+            ).fetchone()
+        return row[0] if row else None
+
+    def add(self, storage, track_id, location):
+        """
+        Records where a track was stored.
+
+        :param str storage: Name of the storage service
+        :param str track_id: Canonical ID of the track
+        :param str location: Location of the stored track (Drive file ID or local path)
+        """
+
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?)', (storage, track_id, location, time())
+            )
+
+    def close(self):
+        """Closes the connection to the database."""
+
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+from threading import Event, Lock
+from time import monotonic, time
+from uuid import uuid4
+
+from music2storage import log
+
+
+STAGES = ('download', 'convert', 'upload', 'delete', 'done')
+
+
+class JobFailed(Exception):
+    """Raised when waiting for the result of a job that failed."""
+
+    def __init__(self, job):
+        """
+        :param Job job: Job that failed
+        """
+
+        super().__init__(f"{job.url} has failed: {job.error}")
+        self.job = job
+
+
+class Job:
+    """
+    Track that moves through the pipeline queues, from its URL to its stored location.
+
+    A job is also a handle on its outcome, like a future: its result can be waited for from any thread, or awaited from a coroutine.
+    """
+
+    def __init__(self, url, job_id=None, stage='download', file_name=None, track_id=None, priority=0, tenant=None):
+        """
+        Creates a job for the track at the given URL.
+
+        :param str url: URL to the music service track
+        :param str job_id: Identifier of the job (optional, a random one is generated when missing)
+        :param str stage: Stage of the pipeline the job is waiting for
+        :param str file_name: Filename of the intermediate file in local storage (optional)
+        :param str track_id: Canonical ID of the track, shared by every URL pointing to it (optional)
+        :param int priority: Priority of the job in every queue, higher priorities being taken first
+        :param str tenant: Key of the user or client the job belongs to, for the queues to share their workers fairly (optional)
+        """
+
+        self.id = job_id or uuid4().hex
+        self.url = url
+        self.stage = stage
+        self.file_name = file_name
+        self.track_id = track_id
+        self.priority = priority
+        self.tenant = tenant
+        self.location = None
+        self.codec = None
+        self.error = None
+        self.created_at = time()
+        self.finished_at = None
+        self.timings = {}
+        self._entered_at = monotonic()
+        self._finished = Event()
+        self._callbacks = []
+        self._lock = Lock()
+
+    def __repr__(self):
+        return f"<Job {self.id} {self.stage} {self.url}>"
+
+    def advance(self, stage):
+        """
+        Moves the job to the given stage, adding the time spent in the current one to its timings.
+
+        :param str stage: Next stage of the job, or 'failed'
+        """
+
+        now = monotonic()
+        self.timings[self.stage] = self.timings.get(self.stage, 0.0) + now - self._entered_at
+        self._entered_at = now
+        self.stage = stage
+
+    def finish(self, error=None):
+        """
+        Marks the job as finished, waking up whoever waits for its result and running its callbacks.
+
+        :param error: Exception or message explaining why the job failed (optional)
+        """
+
+        if error is not None:
+            self.error = error
+        with self._lock:
+            self.finished_at = time()
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._run(callback)
+
+    def done(self):
+        """
+        :return bool: Whether the job finished, stored or failed
+        """
+
+        return self._finished.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the job to finish and returns where the track was stored.
+
+        :param float timeout: Maximum number of seconds to wait (optional, waits as long as needed by default)
+        :return str: Location of the stored track
+        :raises JobFailed: If the job failed
+        :raises TimeoutError: If the job didn't finish in time
+        """
+
+        error = self.exception(timeout)
+        if error is not None:
+            raise error
+        return self.location
+
+    def exception(self, timeout=None):
+        """
+        Waits for the job to finish and returns why it failed.
+
+        :param float timeout: Maximum number of seconds to wait (optional, waits as long as needed by default)
+        :return JobFailed: Error of the job, caused by the original exception if there was one, or None if the track was stored
+        :raises TimeoutError: If the job didn't finish in time
+        """
+
+        if not self._finished.wait(timeout):
+            raise TimeoutError(f"{self.url} hasn't finished after {timeout} seconds")
+        if self.stage == 'done':
+            return None
+        error = JobFailed(self)
+        if isinstance(self.error, BaseException):
+            error.__cause__ = self.error
+        return error
+
+    def add_done_callback(self, callback):
+        """
+        Calls the callback with the job once it finishes, right away if it already has. Callbacks run in the thread finishing the job.
+
+        :param callback: Function taking the job as its only argument
+        """
+
+        with self._lock:
+            if not self._finished.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run(callback)
+
+    def _run(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            log.exception(f"Callback of the job for {self.url} has failed")
+
+    def __await__(self):
+        """Waits for the job from a coroutine, without blocking the event loop, and returns the location of the stored track."""
+
+        import asyncio  # Only loaded when jobs are awaited
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(job):
+            if future.cancelled():
+                return
+            error = job.exception(0)
+            if error is None:
+                future.set_result(job.location)
+            else:
+                future.set_exception(error)
+
+        self.add_done_callback(lambda job: loop.call_soon_threadsafe(resolve, job))
+        return future.__await__()
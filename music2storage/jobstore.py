@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+from threading import Lock
+from time import time
+
+from music2storage.job import Job
+
+
+ADDED_COLUMNS = {
+    'track_id': 'TEXT',
+    'location': 'TEXT',
+    'priority': 'INTEGER NOT NULL DEFAULT 0',
+    'tenant': 'TEXT',
+}
+"""Definitions of the columns added after the first version of the jobs table, added to older stores when they are opened."""
+
+
+class JobStore:
+    """Persists the stage and intermediate file of every job in SQLite so the pipeline can resume after a crash."""
+
+    def __init__(self, path, failed_ttl=7 * 24 * 3600):
+        """
+        Opens (or creates) the job store at the given path, adding the columns it lacks and pruning the jobs that failed long ago.
+
+        The database runs in WAL mode with relaxed syncing, so every write is a cheap append to the log instead of a full fsync.
+
+        :param str path: Path to the SQLite database file
+        :param float failed_ttl: Seconds failed jobs are kept for, for inspection (None keeps them until pruned)
+        """
+
+        self.path = path
+        self.failed_ttl = failed_ttl
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, url TEXT NOT NULL, stage TEXT NOT NULL, file_name TEXT, updated_at REAL NOT NULL, '
+            + ', '.join(f'{name} {definition}' for name, definition in ADDED_COLUMNS.items()) + ')'
+        )
+        columns = {row[1] for row in self.connection.execute('PRAGMA table_info(jobs)')}
+        for name, definition in ADDED_COLUMNS.items():
+            if name not in columns:  # Stores created by an older version
+                self.connection.execute(f'ALTER TABLE jobs ADD COLUMN {name} {definition}')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (stage)')
+        if failed_ttl is not None:
+            self.prune(failed_ttl)
+
+    def add(self, job):
+        """
+        Records a new job.
+
+        :param Job job: Job to be recorded
+        """
+
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO jobs (id, url, stage, file_name, track_id, location, updated_at, priority, tenant) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job.id, job.url, job.stage, job.file_name, job.track_id, job.location, time(), job.priority, job.tenant)
+            )
+
+    def add_many(self, jobs):
+        """
+        Records several new jobs in a single transaction.
+
+        :param list jobs: Jobs to be recorded
+        """
+
+        now = time()
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO jobs (id, url, stage, file_name, track_id, location, updated_at, priority, tenant) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(job.id, job.url, job.stage, job.file_name, job.track_id, job.location, now, job.priority, job.tenant)
+                     for job in jobs]
+                )
+
+    def update(self, job):
+        """
+        Records the current stage, intermediate file and stored location of a job. Jobs that reach the done stage are removed from the store.
+
+        :param Job job: Job to be updated
+        """
+
+        with self.lock:
+            if job.stage == 'done':
+                self.connection.execute('DELETE FROM jobs WHERE id = ?', (job.id,))
+            else:
+                self.connection.execute(
+                    'UPDATE jobs SET stage = ?, file_name = ?, location = ?, updated_at = ? WHERE id = ?',
+                    (job.stage, job.file_name, job.location, time(), job.id)
+                )
+
+    def pending(self):
+        """
+        Returns every job that has not finished the pipeline yet, oldest first.
+
+        :return list: Jobs that still have stages left to run
+        """
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, url, stage, file_name, track_id, location, priority, tenant FROM jobs WHERE stage != 'failed' ORDER BY updated_at"
+            ).fetchall()
+        jobs = []
+        for job_id, url, stage, file_name, track_id, location, priority, tenant in rows:
+            job = Job(url, job_id=job_id, stage=stage, file_name=file_name, track_id=track_id, priority=priority, tenant=tenant)
+            job.location = location
+            jobs.append(job)
+        return jobs
+
+    def prune(self, older_than=0):
+        """
+        Removes the failed jobs that haven't been updated for a while.
+
+        :param float older_than: Seconds since their last update after which failed jobs are removed (0 removes them all)
+        :return int: Number of jobs removed
+        """
+
+        with self.lock:
+            cursor = self.connection.execute("DELETE FROM jobs WHERE stage = 'failed' AND updated_at <= ?", (time() - older_than,))
+        return cursor.rowcount
+
+    def close(self):
+        """Closes the connection to the database."""
+
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import os
+import shutil
+from threading import Lock, Timer
+from time import time
+from uuid import uuid4
+
+from music2storage import log
+from music2storage.helpers import delete_local_file
+from music2storage.service import StorageService
+
+
+NO_FAST_COPY = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+"""Errors of copy_file_range and sendfile on file systems or kernels that don't support them."""
+
+
+def copy_file(source, destination, chunk_size=64 * 1024 * 1024):
+    """
+    Copies the content of a file into another inside the kernel, with copy_file_range where supported (which may share the blocks on
+    filesystems such as btrfs or XFS), then sendfile, and a plain read and write loop as a last resort.
+
+    :param str source: Path of the file copied
+    :param str destination: Path of the new file, which must not exist
+    :param int chunk_size: Maximum number of bytes copied by a single system call
+    :return int: Number of bytes copied
+    """
+
+    with open(source, 'rb') as src, open(destination, 'xb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        copied = 0
+        for copy in (_copy_file_range, _sendfile):
+            try:
+                while copied < size:
+                    count = copy(src.fileno(), dst.fileno(), copied, min(chunk_size, size - copied))
+                    if not count:
+                        break
+                    copied += count
+                return copied
+            except (AttributeError, OSError) as e:
+                if copied or isinstance(e, OSError) and e.errno not in NO_FAST_COPY:
+                    raise
+        shutil.copyfileobj(src, dst, chunk_size)
+        return size
+
+
+def _copy_file_range(src, dst, offset, count):
+    return os.copy_file_range(src, dst, count, offset, offset)
+
+
+def _sendfile(src, dst, offset, count):
+    os.lseek(dst, offset, os.SEEK_SET)
+    return os.sendfile(dst, src, offset, count)
+
+
+def fsync(path):
+    """
+    Flushes a file or folder to disk.
+
+    :param str path: Path of the file or folder
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def numbered(path, number):
+    """
+    :param str path: Path of a file
+    :param int number: Number of the copy, from 2
+    :return str: Path with the number before the extension, e.g. 'Title (2).mp3'
+    """
+
+    root, extension = os.path.splitext(path)
+    return f'{root} ({number}){extension}'
+
+
+class LocalStorage(StorageService):
+    """Local Storage service class."""
+
+    def __init__(self, custom_path=None, sync_every=64, sync_interval=2.0):
+        """
+        :param str custom_path: Custom path of the Music folder (optional, the Music folder of the user's home by default)
+        :param int sync_every: Number of stored files after which they are all flushed to disk with their folder at once (0 flushes
+                               every file as soon as it is stored, None leaves flushing to the operating system). The originals of
+                               files copied from another filesystem are kept until their batch is flushed
+        :param float sync_interval: Maximum number of seconds a stored file waits to be flushed to disk
+        """
+
+        self.name = 'local'
+        if os.path.exists(custom_path):
+            self.music_folder = custom_path
+        else:
+            log.warning(f"Custom path '{custom_path}' doesn't exist. Using default path.")
+            self.music_folder = None
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.unsynced = []
+        self.sync_lock = Lock()
+        self.sync_timer = None
+
+    def connect(self):
+        """Initializes the connection attribute with the path to the user home folder's Music folder, and creates it if it doesn't exist."""
+
+        if self.music_folder is None:
+            music_folder = os.path.join(os.path.expanduser('~'), 'Music')
+            if not os.path.exists(music_folder):
+                os.makedirs(music_folder)
+            self.music_folder = music_folder
+
+    def upload(self, file_name):
+        """
+        Moves the file associated with the file_name passed to the Music folder in the local storage.
+
+        The file is linked into place when the folder is on the same filesystem. Otherwise it is copied by the kernel into a hidden file
+        of the folder, which then takes its name, so a partial copy never shows up as a track. The original file is only removed once the
+        copy is flushed to disk with its batch, unless flushing is left to the operating system. A track already in the folder under the same name
+        is never overwritten, the file gets a numbered name instead.
+
+        :param str file_name: Filename of the file to be uploaded
+        :return str: Path of the file in the Music folder
+        """
+        
+        log.info(f"Upload for {file_name} has started")
+        start_time = time()
+        destination = os.path.join(self.music_folder, os.path.basename(file_name))
+        try:
+            destination = self._place(file_name, destination)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            temporary = self._temporary()
+            try:
+                copy_file(file_name, temporary)
+                destination = self._place(temporary, destination)
+            finally:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+            self._stored(destination, source=file_name)
+        else:
+            self._stored(destination)
+        end_time = time()
+        log.info(f"Upload for {file_name} has finished in {end_time - start_time} seconds")
+
+        return destination
+
+    def _temporary(self):
+        """
+        :return str: Path of a new hidden file in the Music folder, to be renamed once complete
+        """
+
+        return os.path.join(self.music_folder, f'.{uuid4().hex}.part')
+
+    def _place(self, source, destination):
+        """
+        Moves a file to the Music folder without replacing any file there, by hard linking it under the first free name, then removing
+        its old name. Rename would atomically replace a track with the same name instead.
+
+        :param str source: Path of the file
+        :param str destination: Path wanted for the file
+        :return str: Path the file was given
+        """
+
+        number = 1
+        path = destination
+        while True:
+            try:
+                os.link(source, path)
+                break
+            except FileExistsError:
+                number += 1
+                path = numbered(destination, number)
+            except OSError as e:
+                if e.errno == errno.EXDEV or not os.path.isfile(source):
+                    raise
+                # Filesystems without hard links: the check and the rename aren't atomic, but two uploads rarely race on a name
+                while os.path.exists(path):
+                    number += 1
+                    path = numbered(destination, number)
+                os.rename(source, path)
+                return path
+        os.remove(source)
+        return path
+
+    def _stored(self, path, source=None):
+        """
+        Flushes the stored file to disk, right away or with the next batch.
+
+        :param str path: Path of the file in the Music folder
+        :param str source: Path of the file it was copied from, removed once the copy is flushed (optional)
+        """
+
+        if self.sync_every is None:
+            if source is not None:
+                os.remove(source)
+            return
+        with self.sync_lock:
+            self.unsynced.append((path, source))
+            if len(self.unsynced) < self.sync_every:
+                if self.sync_timer is None:
+                    self.sync_timer = Timer(self.sync_interval, self.flush)
+                    self.sync_timer.daemon = True
+                    self.sync_timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        """
+        Flushes the files stored since the last flush, then their folders, to disk with one fsync per file and per folder. The files
+        they were copied from are removed afterwards.
+
+        :return int: Number of files flushed
+        """
+
+        with self.sync_lock:
+            stored, self.unsynced = self.unsynced, []
+            if self.sync_timer is not None:
+                self.sync_timer.cancel()
+                self.sync_timer = None
+        for path, _ in stored:
+            try:
+                fsync(path)
+            except FileNotFoundError:
+                continue
+        for folder in {os.path.dirname(path) for path, _ in stored}:
+            fsync(folder)
+        for _, source in stored:
+            if source is not None:
+                delete_local_file(source)
+        return len(stored)
+
+    def upload_stream(self, stream, file_name, chunk_size=1024 * 1024):
+        """
+        Writes a file read from a stream to the Music folder in the local storage. The file only appears under its name once complete,
+        and gets a numbered name rather than overwriting a track with the same name.
+
+        :param stream: File-like object with a read method, read until it returns no bytes
+        :param str file_name: Filename of the file in the Music folder
+        :param int chunk_size: Number of bytes read from the stream at a time
+        :return str: Path of the file in the Music folder
+        """
+
+        destination = os.path.join(self.music_folder, os.path.basename(file_name))
+        partial = self._temporary()
+
+        log.info(f"Streaming upload for {file_name} has started")
+        start_time = time()
+        try:
+            with open(partial, 'wb') as f:
+                for data in iter(lambda: stream.read(chunk_size), b''):
+                    f.write(data)
+            destination = self._place(partial, destination)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        self._stored(destination)
+        end_time = time()
+        log.info(f"Streaming upload for {file_name} has finished in {end_time - start_time} seconds")
+
+        return destination
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+from collections import defaultdict, deque
+from functools import wraps
+from threading import Lock, Thread
+from time import monotonic, perf_counter
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+"""Upper bounds in seconds of the buckets of the stage latency histograms."""
+
+
+class Histogram:
+    """Counts observations into fixed buckets, as Prometheus histograms do. Not thread-safe on its own."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        :param tuple buckets: Sorted upper bounds of the buckets, an infinite one is added after the last
+        """
+
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        :param float value: Observed value
+        """
+
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimates a quantile by interpolating inside the bucket it falls in.
+
+        :param float q: Quantile between 0 and 1
+        :return float: Estimated value, or None without observations
+        """
+
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def cumulative(self):
+        """
+        :return list: Upper bound and number of observations at or below it, for every bucket including the infinite one
+        """
+
+        total = 0
+        result = []
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), self.counts):
+            total += bucket_count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """Latency, throughput, error and utilisation metrics of the stages of the pipeline, and bytes transferred."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS, window=60):
+        """
+        :param tuple buckets: Upper bounds in seconds of the buckets of the latency histograms
+        :param float window: Seconds over which the recent throughput of each stage is measured
+        """
+
+        self.buckets = buckets
+        self.window = window
+        self.started_at = monotonic()
+        self.lock = Lock()
+        self.latency = defaultdict(lambda: Histogram(self.buckets))
+        self.errors = defaultdict(int)
+        self.active = defaultdict(int)
+        self.busy = defaultdict(float)
+        self.recent = defaultdict(deque)
+        self.bytes = defaultdict(int)
+
+    def timed(self, stage, func):
+        """
+        Wraps the function run by the workers of a stage so that every call is measured.
+
+        A call counts as an error if it raises, or returns None after marking its job as failed.
+
+        :param str stage: Name of the stage
+        :param func: Function run on each item of the stage
+        :return: Wrapped function
+        """
+
+        @wraps(func)
+        def wrapper(item):
+            self.start(stage)
+            start = perf_counter()
+            failed = True
+            try:
+                result = func(item)
+                failed = result is None and getattr(item, 'stage', None) == 'failed'
+                return result
+            finally:
+                self.observe(stage, perf_counter() - start, failed)
+
+        return wrapper
+
+    def start(self, stage):
+        """
+        Records an item entering a stage, until observe records it leaving.
+
+        :param str stage: Name of the stage
+        """
+
+        with self.lock:
+            self.active[stage] += 1
+
+    def observe(self, stage, seconds, failed=False):
+        """
+        Records an item that went through a stage.
+
+        :param str stage: Name of the stage
+        :param float seconds: Time the stage spent on the item
+        :param bool failed: Whether the item failed the stage
+        """
+
+        now = monotonic()
+        with self.lock:
+            self.active[stage] = max(0, self.active[stage] - 1)
+            self.busy[stage] += seconds
+            self.latency[stage].observe(seconds)
+            if failed:
+                self.errors[stage] += 1
+            recent = self.recent[stage]
+            recent.append(now)
+            while recent[0] < now - self.window:
+                recent.popleft()
+
+    def add_bytes(self, direction, count):
+        """
+        :param str direction: 'downloaded' or 'uploaded'
+        :param int count: Number of bytes transferred
+        """
+
+        with self.lock:
+            self.bytes[direction] += count
+
+    def stats(self, pools=None):
+        """
+        :param dict pools: Worker pools by stage, to compute the utilisation of their workers (optional)
+        :return dict: Metrics of every stage, and bytes transferred by direction
+        """
+
+        now = monotonic()
+        uptime = max(now - self.started_at, 1e-9)
+        stages = {}
+        with self.lock:
+            for stage, histogram in self.latency.items():
+                recent = sum(1 for t in self.recent[stage] if t >= now - self.window)
+                stages[stage] = {
+                    'count': histogram.count,
+                    'errors': self.errors[stage],
+                    'latency': {'mean': histogram.sum / histogram.count if histogram.count else None,
+                                'p50': histogram.quantile(0.5), 'p95': histogram.quantile(0.95), 'p99': histogram.quantile(0.99)},
+                    'items_per_second': histogram.count / uptime,
+                    'recent_items_per_second': recent / min(self.window, uptime),
+                    'busy_seconds': self.busy[stage],
+                    'active': self.active[stage],
+                }
+            transferred = dict(self.bytes)
+        for stage, pool in (pools or {}).items():
+            if stage in stages:
+                size = pool.size
+                stages[stage]['workers'] = size
+                stages[stage]['utilisation'] = stages[stage]['active'] / size if size > 0 else 0.0
+        return {'uptime': uptime, 'stages': stages, 'bytes': transferred}
+
+    def prometheus(self, queues=None, pools=None, services=None):
+        """
+        Renders the metrics in the Prometheus text exposition format.
+
+        :param dict queues: Queues by name, for their depth and wait time (optional)
+        :param dict pools: Worker pools by stage, for their size (optional)
+        :param dict services: Stats of every service, as returned by ConnectionHandler.stats (optional)
+        :return str: Metrics text
+        """
+
+        lines = ['# TYPE music2storage_stage_seconds histogram']
+        with self.lock:
+            for stage, histogram in sorted(self.latency.items()):
+                for bound, total in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f'music2storage_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {total}')
+                lines.append(f'music2storage_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'music2storage_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            lines.append('# TYPE music2storage_stage_errors_total counter')
+            lines.extend(f'music2storage_stage_errors_total{{stage="{stage}"}} {self.errors[stage]}' for stage in sorted(self.latency))
+            lines.append('# TYPE music2storage_stage_busy_seconds_total counter')
+            lines.extend(f'music2storage_stage_busy_seconds_total{{stage="{stage}"}} {self.busy[stage]}' for stage in sorted(self.latency))
+            lines.append('# TYPE music2storage_stage_active gauge')
+            lines.extend(f'music2storage_stage_active{{stage="{stage}"}} {self.active[stage]}' for stage in sorted(self.latency))
+            lines.append('# TYPE music2storage_bytes_total counter')
+            lines.extend(f'music2storage_bytes_total{{direction="{direction}"}} {count}' for direction, count in sorted(self.bytes.items()))
+
+        if queues:
+            lines.append('# TYPE music2storage_queue_depth gauge')
+            lines.extend(f'music2storage_queue_depth{{queue="{name}"}} {queue.qsize()}' for name, queue in sorted(queues.items()))
+            lines.append('# TYPE music2storage_queue_wait_seconds gauge')
+            lines.extend(f'music2storage_queue_wait_seconds{{queue="{name}"}} {queue.wait_time}' for name, queue in sorted(queues.items()))
+        if pools:
+            lines.append('# TYPE music2storage_workers gauge')
+            lines.extend(f'music2storage_workers{{stage="{stage}"}} {pool.size}' for stage, pool in sorted(pools.items()))
+        if services:
+            for metric, key in (('requests', 'calls'), ('retries', 'retries'), ('failures', 'failures')):
+                lines.append(f'# TYPE music2storage_service_{metric}_total counter')
+                lines.extend(f'music2storage_service_{metric}_total{{service="{name}"}} {stats[key]}'
+                             for name, stats in sorted(services.items()))
+            lines.append('# TYPE music2storage_service_circuit_open gauge')
+            lines.extend(f'music2storage_service_circuit_open{{service="{name}"}} {int(stats["breaker"]["state"] != "closed")}'
+                         for name, stats in sorted(services.items()))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(Thread):
+    """Thread serving the metrics in the Prometheus text format over HTTP, on every path."""
+
+    def __init__(self, render, host='127.0.0.1', port=9100):
+        """
+        :param render: Function returning the metrics text
+        :param str host: Address the server listens on
+        :param int port: Port the server listens on (0 picks a free one)
+        """
+
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # Only loaded when metrics are served
+
+        super().__init__(daemon=True)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        """Stops serving and closes the socket."""
+
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+from threading import Lock, Thread
+
+from music2storage import log
+from music2storage.worker import Worker
+
+
+class WorkerPool:
+    """Workers that run the same stage of the pipeline, which can grow or shrink while running."""
+
+    def __init__(self, name, func, in_queue, out_queue, stopper, workers, min_size=1, max_size=None, on_error=None):
+        """
+        Creates an empty pool for a stage of the pipeline.
+
+        :param str name: Name of the stage
+        :param function func: Function that does work on items from the input queue
+        :param Queue in_queue: Input queue
+        :param Queue out_queue: Output queue
+        :param threading.Event stopper: Event that signals that the threads should stop execution
+        :param list workers: List of all the worker threads, shared with the other pools and the signal handler
+        :param int min_size: Minimum number of workers in the pool
+        :param int max_size: Maximum number of workers in the pool (defaults to min_size)
+        :param function on_error: Function called with the item and the exception when func raises one (optional)
+        """
+
+        self.name = name
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.stopper = stopper
+        self.workers = workers
+        self.min_size = min_size
+        self.max_size = min_size if max_size is None else max_size
+        self.on_error = on_error
+        self.members = []
+        self.lock = Lock()
+
+    @property
+    def size(self):
+        """Number of workers currently in the pool, not counting the ones that were asked to retire."""
+
+        return sum(1 for worker in self.members if worker.is_alive()) - self.in_queue.stops
+
+    def start(self):
+        """Starts the minimum number of workers."""
+
+        self.resize(self.min_size)
+
+    def resize(self, size):
+        """
+        Grows or shrinks the pool to the given size, bounded by the minimum and maximum size.
+
+        Shrinking puts STOP sentinels in the input queue, so the first idle workers exit right away and busy ones after their current item.
+
+        :param int size: Wanted number of workers
+        :return int: Number of workers in the pool after resizing
+        """
+
+        size = max(self.min_size, min(self.max_size, size))
+        with self.lock:
+            for worker in [worker for worker in self.members if not worker.is_alive()]:
+                self.members.remove(worker)
+                if worker in self.workers:
+                    self.workers.remove(worker)
+
+            current = self.size
+            for _ in range(size - current):
+                worker = Worker(self.func, self.in_queue, self.out_queue, self.stopper, on_error=self.on_error)
+                self.members.append(worker)
+                self.workers.append(worker)
+                worker.start()
+            if current > size:
+                self.in_queue.stop(current - size)
+            return size
+
+
+class Autoscaler(Thread):
+    """Thread that periodically grows or shrinks worker pools based on the depth and wait time of their input queue."""
+
+    def __init__(self, pools, stopper, interval=5, max_wait=10):
+        """
+        Creates an autoscaler for the given pools.
+
+        :param list pools: Worker pools to scale
+        :param threading.Event stopper: Event that signals that the thread should stop execution
+        :param float interval: Seconds between two scaling decisions
+        :param float max_wait: Seconds an item may wait in an input queue before its pool is grown
+        """
+
+        super().__init__(daemon=True)
+        self.pools = pools
+        self.stopper = stopper
+        self.interval = interval
+        self.max_wait = max_wait
+
+    def run(self):
+        """Scales every pool at each interval until the stopper is set."""
+
+        while not self.stopper.wait(self.interval):
+            for pool in self.pools:
+                self.scale(pool)
+
+    def scale(self, pool):
+        """
+        Grows the pool by one worker if its input queue is backing up, or shrinks it by one if the queue is empty.
+
+        :param WorkerPool pool: Pool to scale
+        """
+
+        if pool.min_size == pool.max_size:
+            return
+
+        depth = pool.in_queue.qsize()
+        wait = pool.in_queue.oldest_wait() if hasattr(pool.in_queue, 'oldest_wait') else 0.0
+        size = pool.size
+
+        if depth > size or wait > self.max_wait:
+            new_size = pool.resize(size + 1)
+        elif depth == 0:
+            new_size = pool.resize(size - 1)
+        else:
+            return
+
+        if new_size != size:
+            log.info(f"Scaled {pool.name} workers from {size} to {new_size} (queue depth {depth}, oldest wait {wait:.1f} seconds)")
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+from heapq import heappop, heappush
+from itertools import count
+from queue import Empty, Queue
+from threading import Condition
+from time import monotonic, time
+
+
+STOP = object()
+"""Sentinel that makes the worker taking it out of a queue exit."""
+
+
+class StageQueue(Queue):
+    """
+    Queue between two stages of the pipeline that measures how long items wait in it.
+
+    Items are taken by priority, highest first, then shared between tenants by weighted fair queuing, so a tenant with a long backlog
+    can't hold back the items of the others. Items of the same tenant and priority come out in the order they were put in, unless an
+    order is given, so without priorities and tenants the queue is FIFO. The priority and tenant of an item are its priority and tenant
+    attributes, if any.
+    """
+
+    def __init__(self, maxsize=0, smoothing=0.2, weights=None, cap=None, sibling=None, order=None):
+        """
+        Creates a queue that timestamps every item put in it.
+
+        :param int maxsize: Maximum number of items in the queue (0 means unbounded)
+        :param float smoothing: Weight of the latest wait time in the moving average (between 0 and 1)
+        :param dict weights: Share of the queue of specific tenants relative to the others, e.g. {'radio': 3} (optional, 1 by default)
+        :param int cap: Maximum number of items of a tenant taken out of the queue and not released yet (optional, unlimited by
+                        default). Items without a tenant are never capped
+        :param StageQueue sibling: Queue whose cap is shared, so the items of a tenant taken out of either queue count together
+                                   (optional). Both queues then share a lock as well
+        :param order: Function returning the rank of an item among the items of the same tenant and priority, lowest first, when it is
+                      put in the queue, e.g. its size for shortest job first (optional, the order items were put in by default)
+        """
+
+        super().__init__(maxsize)
+        self.smoothing = smoothing
+        self.wait_time = 0.0
+        self.stops = 0
+        self.weights = weights or {}
+        self.cap = cap
+        self.order = order
+        self.siblings = [self]
+        if sibling is not None:
+            self.mutex = sibling.mutex
+            self.not_empty = Condition(self.mutex)
+            self.not_full = Condition(self.mutex)
+            self.all_tasks_done = Condition(self.mutex)
+            self.running = sibling.running
+            self.siblings = sibling.siblings
+            self.siblings.append(self)
+
+    def _init(self, maxsize):
+        self.tenants = {}
+        self.passes = {}
+        self.running = {}
+        self.virtual_time = 0.0
+        self.count = 0
+        self.sequence = count()
+
+    def _qsize(self):
+        # STOP sentinels aren't items: they neither count towards the depth nor take room from items
+        return self.count
+
+    def _put(self, item):
+        tenant = getattr(item, 'tenant', None)
+        heap = self.tenants.get(tenant)
+        if heap is None:
+            heap = self.tenants[tenant] = []
+            self.passes[tenant] = max(self.passes.get(tenant, 0.0), self.virtual_time)
+        rank = self.order(item) if self.order is not None else 0
+        heappush(heap, (-getattr(item, 'priority', 0), rank, next(self.sequence), time(), item))
+        self.count += 1
+
+    def _get(self):
+        if self.stops:
+            self.stops -= 1
+            return STOP
+        tenant, heap = self._next_tenant()
+        _, _, _, put_time, item = heappop(heap)
+        self.count -= 1
+
+        # Stride scheduling: every item taken moves the tenant forward in virtual time by the inverse of its weight, and tenants
+        # coming back from idle start at the current virtual time instead of catching up on the turns they didn't need
+        self.virtual_time = max(self.virtual_time, self.passes[tenant])
+        self.passes[tenant] += 1 / self.weights.get(tenant, 1)
+        if not heap:
+            del self.tenants[tenant]
+            if self.passes[tenant] <= self.virtual_time:
+                del self.passes[tenant]
+        if self.cap is not None and tenant is not None:
+            self.running[tenant] = self.running.get(tenant, 0) + 1
+
+        self.wait_time += self.smoothing * (time() - put_time - self.wait_time)
+        return item
+
+    def _next_tenant(self):
+        """
+        :return tuple: Tenant whose item is taken next and its items, the tenant with the highest priority item and then the earliest
+                       virtual time among the tenants under their cap, or None if no item can be taken
+        """
+
+        best, best_key = None, None
+        for tenant, heap in self.tenants.items():
+            if self.cap is not None and tenant is not None and self.running.get(tenant, 0) >= self.cap:
+                continue
+            key = (heap[0][0], self.passes[tenant], heap[0][2])
+            if best_key is None or key < best_key:
+                best, best_key = (tenant, heap), key
+        return best
+
+    def _ready(self):
+        return self.stops or (self.count and (self.cap is None or self._next_tenant() is not None))
+
+    def get(self, block=True, timeout=None):
+        """
+        Removes and returns the next item, waiting while every item left belongs to a tenant at its cap.
+
+        :param bool block: Whether to wait for an item
+        :param float timeout: Maximum number of seconds to wait (optional, waits as long as needed by default)
+        :return: Next item
+        :raises queue.Empty: If no item could be taken
+        """
+
+        with self.not_empty:
+            if not block:
+                if not self._ready():
+                    raise Empty
+            elif timeout is None:
+                while not self._ready():
+                    self.not_empty.wait()
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            else:
+                deadline = monotonic() + timeout
+                while not self._ready():
+                    remaining = deadline - monotonic()
+                    if remaining <= 0.0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+            item = self._get()
+            self.not_full.notify()
+            return item
+
+    def release(self, item):
+        """
+        Marks an item taken out of the queue as processed, letting another item of its tenant be taken if it was at its cap, from this
+        queue or its siblings.
+
+        :param item: Item that was taken out of the queue
+        """
+
+        tenant = getattr(item, 'tenant', None)
+        with self.mutex:
+            if tenant in self.running:
+                self.running[tenant] -= 1
+                if not self.running[tenant]:
+                    del self.running[tenant]
+                for queue in self.siblings:
+                    queue.not_empty.notify()
+
+    def stop(self, count=1):
+        """
+        Makes the next workers taking items out of the queue exit, ahead of the items already waiting and regardless of the queue capacity.
+
+        :param int count: Number of workers to stop
+        """
+
+        with self.not_empty:
+            self.stops += count
+            self.unfinished_tasks += count
+            self.not_empty.notify(count)
+
+    def oldest_wait(self):
+        """
+        Returns how long the item that has been in the queue the longest has been waiting.
+
+        :return float: Seconds since the oldest item was put in the queue, or 0 if the queue is empty
+        """
+
+        with self.mutex:
+            if not self.count:
+                return 0.0
+            return time() - min(put_time for heap in self.tenants.values() for _, _, _, put_time, _ in heap)
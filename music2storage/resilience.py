@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from email.utils import parsedate_to_datetime
+import random
+import sys
+from threading import Condition, Lock
+from time import monotonic, sleep, time
+from urllib.error import HTTPError as UrlHTTPError
+
+from music2storage import log
+
+
+TRANSIENT_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+def _is_instance(error, module, name):
+    """
+    Tells whether the error is an instance of a class of a client library, without importing the library.
+
+    An error can only be an instance of the class if its module was imported, so a module that isn't loaded yet is never imported here.
+
+    :param Exception error: Error raised by a request to a service
+    :param str module: Name of the module of the class
+    :param str name: Name of the class
+    :return bool: True if the module is loaded and the error is an instance of the class
+    """
+
+    cls = getattr(sys.modules.get(module), name, None)
+    return cls is not None and isinstance(error, cls)
+
+
+def error_status(error):
+    """
+    :param Exception error: Error raised by a request to a service
+    :return int: HTTP status of the response that caused the error, or None if there was no response
+    """
+
+    if _is_instance(error, 'requests.exceptions', 'HTTPError') and error.response is not None:
+        return error.response.status_code
+    if _is_instance(error, 'googleapiclient.errors', 'HttpError'):
+        return error.resp.status
+    if isinstance(error, UrlHTTPError):
+        return error.code
+    if _is_instance(error, 'aiohttp.client_exceptions', 'ClientResponseError'):
+        return error.status
+    return None
+
+
+def is_transient(error):
+    """
+    Tells whether a request that failed with the error may succeed if sent again later.
+
+    :param Exception error: Error raised by a request to a service
+    :return bool: True for throttling, server errors and connection errors
+    """
+
+    status = error_status(error)
+    if status is not None:
+        if status == 403 and _is_instance(error, 'googleapiclient.errors', 'HttpError'):
+            return b'rateLimitExceeded' in error.content or b'userRateLimitExceeded' in error.content
+        return status in TRANSIENT_STATUSES
+    if isinstance(error, (FileNotFoundError, PermissionError, IsADirectoryError, NotADirectoryError)):
+        return False
+    return (isinstance(error, OSError) or _is_instance(error, 'requests.exceptions', 'ConnectionError')
+            or _is_instance(error, 'requests.exceptions', 'ChunkedEncodingError')
+            or _is_instance(error, 'requests.exceptions', 'Timeout') or _is_instance(error, 'httplib2', 'HttpLib2Error')
+            or isinstance(error, asyncio.TimeoutError) or _is_instance(error, 'aiohttp.client_exceptions', 'ClientConnectionError')
+            or _is_instance(error, 'aiohttp.client_exceptions', 'ClientPayloadError'))
+
+
+def retry_after(error):
+    """
+    :param Exception error: Error raised by a request to a service
+    :return float: Seconds the service asked to wait through a Retry-After header, or None if it didn't
+    """
+
+    headers = {}
+    if _is_instance(error, 'requests.exceptions', 'HTTPError') and error.response is not None:
+        headers = error.response.headers
+    elif _is_instance(error, 'googleapiclient.errors', 'HttpError'):
+        headers = error.resp
+    elif isinstance(error, UrlHTTPError):
+        headers = error.headers or {}
+    elif _is_instance(error, 'aiohttp.client_exceptions', 'ClientResponseError'):
+        headers = error.headers or {}
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+        except (TypeError, ValueError):
+            return None
+
+
+def unguarded(func, *args, retry=True, **kwargs):
+    """
+    Sends a request directly, for services that have no guard.
+
+    :param func: Function making a request to the service
+    :param bool retry: Ignored, requests are never retried
+    :return: Result of func
+    """
+
+    return func(*args, **kwargs)
+
+
+class TokenBucket:
+    """Rate limiter letting through rate requests per second on average, and bursts of up to burst requests."""
+
+    def __init__(self, rate, burst=None):
+        """
+        :param float rate: Number of tokens added per second
+        :param int burst: Maximum number of tokens in the bucket (optional, one second worth of tokens by default)
+        """
+
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated_at = monotonic()
+        self.lock = Lock()
+        self.acquired = 0
+        self.waited = 0.0
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        """Takes a token out of the bucket, waiting for one to be added if it is empty."""
+
+        delay = self.reserve()
+        while delay:
+            sleep(delay)
+            delay = self.reserve()
+
+    def reserve(self):
+        """
+        Takes a token out of the bucket if there is one, without waiting.
+
+        :return float: 0 if a token was taken, otherwise seconds until the next token is added
+        """
+
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.acquired += 1
+                return 0
+            delay = (1 - self.tokens) / self.rate
+            self.waited += delay
+            return delay
+
+    def stats(self):
+        """
+        :return dict: Rate, burst, tokens left, tokens taken and total seconds spent waiting for tokens
+        """
+
+        with self.lock:
+            self._refill()
+            return {'rate': self.rate, 'burst': self.burst, 'tokens': round(self.tokens, 2), 'acquired': self.acquired,
+                    'waited_seconds': round(self.waited, 3)}
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, capped, and overridden by the Retry-After a service sends back."""
+
+    def __init__(self, retries=3, base=1, cap=60):
+        """
+        :param int retries: Number of times a failed request is sent again
+        :param float base: Upper bound in seconds of the delay before the first retry, doubled for every following one
+        :param float cap: Upper bound in seconds of any delay
+        """
+
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt, error=None):
+        """
+        :param int attempt: Number of retries already made
+        :param Exception error: Error the request failed with (optional)
+        :return float: Seconds to wait before the next retry
+        """
+
+        asked = retry_after(error) if error is not None else None
+        if asked is not None:
+            return min(self.cap, asked)
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class CircuitOpenError(Exception):
+    """Raised when a request is refused because the circuit breaker of its service is open."""
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a service after too many consecutive failures, for a cooldown period.
+
+    Once the cooldown is over, one trial request is let through: the circuit closes again if it succeeds, and reopens if it fails.
+    Callers wait for the circuit to close instead of failing, so the stage using the service pauses while it is failing.
+    """
+
+    def __init__(self, threshold=5, cooldown=30):
+        """
+        :param int threshold: Number of consecutive failures that opens the circuit
+        :param float cooldown: Seconds the circuit stays open before a trial request is let through
+        """
+
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self.condition = Condition()
+
+    def acquire(self, timeout=None):
+        """
+        Waits until a request may be sent: while the circuit is open, and while a trial request is running.
+
+        :param float timeout: Maximum number of seconds to wait (optional, waits as long as needed by default)
+        :raises CircuitOpenError: If the circuit is still open after the timeout
+        """
+
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.condition:
+            while True:
+                if self.state == 'closed':
+                    return
+                now = monotonic()
+                if self.state == 'open' and now >= self.opened_at + self.cooldown:
+                    self.state = 'half-open'
+                    log.info('Circuit breaker is half-open, sending a trial request')
+                    return
+                if deadline is not None and now >= deadline:
+                    raise CircuitOpenError('Circuit breaker is open')
+                wait = self.opened_at + self.cooldown - now if self.state == 'open' else None
+                if deadline is not None:
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self.condition.wait(wait)
+
+    def success(self):
+        """Records a successful request, closing the circuit."""
+
+        with self.condition:
+            self.failures = 0
+            if self.state != 'closed':
+                log.info('Circuit breaker is closed again')
+                self.state = 'closed'
+                self.condition.notify_all()
+
+    def failure(self):
+        """Records a failed request, opening the circuit if the trial request failed or there were too many failures in a row."""
+
+        with self.condition:
+            self.failures += 1
+            if self.state == 'half-open' or (self.state == 'closed' and self.failures >= self.threshold):
+                self.state = 'open'
+                self.opened_at = monotonic()
+                self.trips += 1
+                log.warning(f"Circuit breaker opened after {self.failures} failures, pausing for {self.cooldown} seconds")
+                self.condition.notify_all()
+
+    def release(self):
+        """Lets another request be tried if a trial request ended with an error that says nothing about the service."""
+
+        with self.condition:
+            if self.state == 'half-open':
+                self.state = 'open'
+                self.opened_at = monotonic() - self.cooldown
+                self.condition.notify_all()
+
+    def stats(self):
+        """
+        :return dict: State, consecutive failures and number of times the circuit opened
+        """
+
+        with self.condition:
+            return {'state': self.state, 'failures': self.failures, 'trips': self.trips}
+
+
+class ServiceGuard:
+    """Rate limiter, retry policy and circuit breaker every request to one service goes through."""
+
+    def __init__(self, name, rate=None, burst=None, retries=3, backoff=1, max_backoff=60, failure_threshold=5, cooldown=30):
+        """
+        :param str name: Name of the service
+        :param float rate: Maximum number of requests per second (optional, unlimited by default)
+        :param int burst: Number of requests that may be sent at once before the rate applies (optional)
+        :param int retries: Number of times a request failing with a transient error is sent again
+        :param float backoff: Upper bound in seconds of the delay before the first retry, doubled for every following one
+        :param float max_backoff: Upper bound in seconds of any delay between retries
+        :param int failure_threshold: Number of consecutive transient failures that pauses the service
+        :param float cooldown: Seconds the service is paused for
+        """
+
+        self.name = name
+        self.limiter = TokenBucket(rate, burst) if rate else None
+        self.retry = RetryPolicy(retries, backoff, max_backoff)
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+        self.lock = Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+
+    def call(self, func, *args, retry=True, **kwargs):
+        """
+        Calls func once the breaker and limiter let it, retrying it after a transient error.
+
+        :param func: Function making a request to the service
+        :param bool retry: Whether the call may be retried (False for calls consuming a stream, which can't be replayed)
+        :return: Result of func
+        :raises Exception: Error of the last attempt, or the first one that isn't transient
+        """
+
+        attempt = 0
+        while True:
+            self.breaker.acquire()
+            if self.limiter is not None:
+                self.limiter.acquire()
+            with self.lock:
+                self.calls += 1
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not is_transient(e):
+                    self.breaker.release()
+                    raise
+                self.breaker.failure()
+                with self.lock:
+                    self.failures += 1
+                if not retry or attempt >= self.retry.retries:
+                    raise
+                delay = self.retry.delay(attempt, e)
+                log.warning(f"Request to {self.name} failed ({e}), retrying in {delay:.1f} seconds")
+                with self.lock:
+                    self.retries += 1
+                sleep(delay)
+                attempt += 1
+            else:
+                self.breaker.success()
+                return result
+
+    async def call_async(self, func, *args, retry=True, **kwargs):
+        """
+        Coroutine counterpart of call, for requests made by coroutines: waiting for the breaker, the limiter and retries yields to the
+        event loop instead of blocking it.
+
+        :param func: Coroutine function making a request to the service
+        :param bool retry: Whether the call may be retried (False for calls consuming a stream, which can't be replayed)
+        :return: Result of func
+        :raises Exception: Error of the last attempt, or the first one that isn't transient
+        """
+
+        attempt = 0
+        while True:
+            while True:
+                try:
+                    self.breaker.acquire(timeout=0)
+                    break
+                except CircuitOpenError:
+                    await asyncio.sleep(min(1, self.breaker.cooldown))
+            delay = self.limiter.reserve() if self.limiter is not None else 0
+            while delay:
+                await asyncio.sleep(delay)
+                delay = self.limiter.reserve()
+            with self.lock:
+                self.calls += 1
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if not is_transient(e):
+                    self.breaker.release()
+                    raise
+                self.breaker.failure()
+                with self.lock:
+                    self.failures += 1
+                if not retry or attempt >= self.retry.retries:
+                    raise
+                delay = self.retry.delay(attempt, e)
+                log.warning(f"Request to {self.name} failed ({e}), retrying in {delay:.1f} seconds")
+                with self.lock:
+                    self.retries += 1
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                self.breaker.success()
+                return result
+
+    def stats(self):
+        """
+        :return dict: Calls, retries and transient failures, with the state of the limiter and breaker
+        """
+
+        with self.lock:
+            stats = {'calls': self.calls, 'retries': self.retries, 'failures': self.failures}
+        stats['limiter'] = self.limiter.stats() if self.limiter is not None else None
+        stats['breaker'] = self.breaker.stats()
+        return stats
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+import os
+from threading import Condition
+
+
+class ConversionScheduler:
+    """
+    Caps the number of FFmpeg processes running at once by the available cores, and shares the cores between them.
+
+    The order in which files are converted is up to the queue of the conversion stage, which takes the smallest files first.
+    """
+
+    def __init__(self, max_jobs=None, threads_per_job=None):
+        """
+        Creates a scheduler sized for the cores of the machine.
+
+        :param int max_jobs: Maximum number of conversions running at once (optional, defaults to the number of cores until fit is called)
+        :param int threads_per_job: Number of threads given to each FFmpeg process (optional, defaults to the cores divided between jobs)
+        """
+
+        self.cores = os.cpu_count() or 1
+        self.fixed_jobs = max_jobs
+        self.fixed_threads = threads_per_job
+        self.max_jobs = max_jobs or self.cores
+        self.threads_per_job = threads_per_job or max(1, self.cores // self.max_jobs)
+        self.running = 0
+        self.condition = Condition()
+
+    def fit(self, workers):
+        """
+        Sizes the scheduler for the number of workers converting files, unless max_jobs was given: every worker gets a slot, at most
+        one per core, and their FFmpeg processes share the cores.
+
+        :param int workers: Number of workers converting files
+        """
+
+        if self.fixed_jobs is not None:
+            return
+        with self.condition:
+            self.max_jobs = min(self.cores, max(1, workers))
+            self.threads_per_job = self.fixed_threads or max(1, self.cores // self.max_jobs)
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """
+        Waits until a conversion slot is free, then holds it.
+
+        :return int: Number of threads the FFmpeg process may use
+        """
+
+        with self.condition:
+            while self.running >= self.max_jobs:
+                self.condition.wait()
+            self.running += 1
+
+        try:
+            yield self.threads_per_job
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.condition.notify()
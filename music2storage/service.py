@@ -1,187 +1,172 @@
 # -*- coding: utf-8 -*-
 
 from abc import ABC, abstractmethod
-import os
-import sys
-from time import time
+from importlib import import_module
+from urllib.parse import urlparse
 
-from apiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from httplib2 import Http
-from oauth2client import file, client, tools
-from oauth2client.clientsecrets import InvalidClientSecretsError
-from pytube import YouTube
-from pytube.exceptions import RegexMatchError
-import requests
-from requests.exceptions import HTTPError
-import soundcloud
-from tqdm import tqdm
+from music2storage.resilience import unguarded
 
-from music2storage import log
 
+BACKENDS = {
+    'Youtube': 'music2storage.youtube',
+    'Soundcloud': 'music2storage.soundcloud',
+    'StreamMediaUpload': 'music2storage.googledrive',
+    'DriveClientPool': 'music2storage.googledrive',
+    'DriveFolderIndex': 'music2storage.googledrive',
+    'GoogleDrive': 'music2storage.googledrive',
+    'LocalStorage': 'music2storage.localstorage',
+}
+"""Module of every service backend, imported only when the backend is first used so their dependencies don't slow down startup."""
 
-class MusicService(ABC):
-    """Template for every music service."""
 
-    @abstractmethod
-    def download(self, url):
-        """Downloads a song file from the music service."""
+def __getattr__(name):
+    """Imports the backends that used to be defined in this module when they are looked up here, e.g. by old imports."""
 
+    if name in BACKENDS:
+        return getattr(import_module(BACKENDS[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-class StorageService(ABC):
-    """Template for every storage service."""
 
-    @abstractmethod
-    def connect(self):
-        """Connects to the storage service, sets connection attribute."""
+class GuardedRequests:
+    """
+    Mixin of the services that send each of their requests through their ServiceGuard, rather than having whole downloads and uploads
+    go through it. Rate limits then count requests, and a failed range or chunk is retried on its own.
+    """
+
+    guard = None
+    """ServiceGuard of the service, set by the connection handler (requests are sent directly until then)."""
+
+    def guarded(self, func, *args, retry=True, **kwargs):
+        """
+        Sends a request through the rate limiter, retry policy and circuit breaker of the service.
+
+        :param func: Function making one request to the service
+        :param bool retry: Whether the request may be retried after a transient error (False for requests consuming a stream)
+        :return: Result of func
+        """
+
+        if self.guard is None:
+            return unguarded(func, *args, **kwargs)
+        return self.guard.call(func, *args, retry=retry, **kwargs)
+
+
+class MusicService(ABC):
+    """Template for every music service."""
+
+    HOSTS = ()
+    """Hosts of the URLs the service downloads from, subdomains included."""
 
     @abstractmethod
-    def upload(self, file_name):
-        """Uploads a file to the storage."""
+    def download(self, url, directory=None):
+        """Downloads a song file from the music service, into the directory if one is given or else the current directory."""
 
+    def codec(self, file_name):
+        """
+        Returns the audio codec of a file downloaded by the service, if the service knows it without probing the file.
 
-class Youtube(MusicService):
-    """Youtube service class."""
+        :param str file_name: Filename of a file returned by download
+        :return str: Name of the audio codec (e.g. 'mp3', 'opus', 'mp4a.40.2'), or None if unknown
+        """
 
-    def __init__(self):
-        self.name = 'youtube'
+        return None
 
-    def download(self, url):
+    def handles(self, url):
         """
-        Downloads a MP4 or WebM file that is associated with the video at the URL passed.
+        Tells whether the URL points to the service, from its host.
 
-        :param str url: URL of the video to be downloaded
-        :return str: Filename of the file in local storage
+        :param str url: URL of a track
+        :return bool: True if the host of the URL is one of the service's hosts or a subdomain of one
         """
 
-        try:
-            yt = YouTube(url)
-        except RegexMatchError:
-            log.error(f"Cannot download file at {url}")
-        else:
-            stream = yt.streams.first()
-            log.info(f"Download for {stream.default_filename} has started")
-            start_time = time()
-            stream.download()
-            end_time = time()
-            log.info(f"Download for {stream.default_filename} has finished in {end_time - start_time} seconds")
-            return stream.default_filename
+        host = (urlparse(url).hostname or '').lower()
+        return any(host == known or host.endswith('.' + known) for known in self.HOSTS)
 
+    def is_playlist(self, url):
+        """
+        Tells whether the URL points to a playlist rather than to a track.
 
-class Soundcloud(MusicService):
-    """Soundcloud service class."""
+        :param str url: URL of a track or playlist
+        :return bool: True if the URL has to be expanded into the URLs of its tracks
+        """
 
-    def __init__(self, api_key=None):
-        self.name = 'soundcloud'
-        if api_key is None:
-            self.client_id = '81f430860ad96d8170e3bf1639d4e072'
-        else:
-            self.client_id = api_key
-        self.client = soundcloud.Client(client_id=self.client_id)
+        return False
 
-    def download(self, url):
+    def expand(self, url):
         """
-        Downloads a MP3 file that is associated with the track at the URL passed.
-        
-        :param str url: URL of the track to be downloaded
+        Yields the URLs of the tracks of the playlist at the URL passed, fetching the playlist one page at a time as they are consumed.
+
+        :param str url: URL of the playlist
+        :return generator: URLs of the tracks of the playlist, in order
         """
 
-        try:
-            track = self.client.get('/resolve', url=url)
-        except HTTPError:
-            log.error(f"{url} is not a Soundcloud URL.")
-            return
-        r = requests.get(self.client.get(track.stream_url, allow_redirects=False).location, stream=True)
-        total_size = int(r.headers['content-length'])
-        chunk_size = 1000000
-        file_name = track.title + '.mp3'
-        with open(file_name, 'wb') as f:
-            for data in tqdm(r.iter_content(chunk_size), desc=track.title, total=total_size / chunk_size, unit='MB', file=sys.stdout):
-                f.write(data)
-        return file_name
+        raise NotImplementedError(f"{self.name} does not support playlists.")
 
+    def set_pool_size(self, size):
+        """
+        Sizes the pool of HTTP connections of the service to the number of workers using it. Services without a pool ignore it.
 
-class GoogleDrive(StorageService):
-    """Google Drive service class."""
+        :param int size: Number of connections kept open per host
+        """
 
-    def __init__(self):
-        self.name = 'google drive'
-        self.connection = None
+    def open_stream(self, url):
+        """
+        Opens the media of the track at the URL passed as a stream of bytes, without writing it to local storage.
 
-    def connect(self):
-        """Creates connection to the Google Drive API, sets the connection attribute to make requests, and creates the Music folder if it doesn't exist."""
-
-        SCOPES = 'https://www.googleapis.com/auth/drive'
-        store = file.Storage('drive_credentials.json')
-        creds = store.get()
-        if not creds or creds.invalid:
-            try:
-                flow = client.flow_from_clientsecrets('client_secret.json', SCOPES)
-            except InvalidClientSecretsError:
-                log.error('ERROR: Could not find client_secret.json in current directory, please obtain it from the API console.')
-                return
-            creds = tools.run_flow(flow, store)
-        self.connection = build('drive', 'v3', http=creds.authorize(Http()))
-
-        response = self.connection.files().list(q="name='Music' and mimeType='application/vnd.google-apps.folder' and trashed=false").execute()
-        try:
-            folder_id = response.get('files', [])[0]['id']
-        except IndexError:
-            log.warning('Music folder is missing. Creating it.')
-            folder_metadata = {'name': 'Music', 'mimeType': 'application/vnd.google-apps.folder'}
-            folder = self.connection.files().create(body=folder_metadata, fields='id').execute()
+        :param str url: URL of the track
+        :return tuple: Filename of the track without extension, and an iterator over chunks of its bytes (or None if it can't be opened)
+        """
 
-    def upload(self, file_name):
+        raise NotImplementedError(f"{self.name} does not support streaming downloads.")
+
+    def locate(self, url, fresh=False):
+        """
+        Finds where the media of the track at the URL passed can be downloaded from over plain HTTP, for downloaders of their own such
+        as the one of the asyncio engine.
+
+        :param str url: URL of the track
+        :param bool fresh: Looks the location up again instead of using a cached one, e.g. after it was refused
+        :return tuple: URL of the media, filename to download it into and audio codec (None if unknown), or None if the track can't be
+                       downloaded
         """
-        Uploads the file associated with the file_name passed to Google Drive in the Music folder.
 
-        :param str file_name: Filename of the file to be uploaded
-        :return str: Original filename passed as an argument (in order for the worker to send it to the delete queue)
+        raise NotImplementedError(f"{self.name} does not give the location of its media.")
+
+    def track_id(self, url):
         """
+        Returns the canonical ID of the track at the URL passed, so that different URLs of the same track share one ID.
 
-        response = self.connection.files().list(q="name='Music' and mimeType='application/vnd.google-apps.folder' and trashed=false").execute()
-        folder_id = response.get('files', [])[0]['id']
-        file_metadata = {'name': file_name, 'parents': [folder_id]}
-        media = MediaFileUpload(file_name, mimetype='audio/mpeg')
-        
-        log.info(f"Upload for {file_name} has started")
-        start_time = time()
-        self.connection.files().create(body=file_metadata, media_body=media, fields='id').execute()
-        end_time = time()
-        log.info(f"Upload for {file_name} has finished in {end_time - start_time} seconds")
+        By default the URL is normalized by dropping its scheme, query string, fragment, "www."/"m." host prefixes and trailing slash.
 
-        return file_name
+        :param str url: URL of the track
+        :return str: Canonical ID of the track
+        """
 
+        parsed = urlparse(url)
+        host = parsed.netloc.lower()
+        for prefix in ('www.', 'm.'):
+            if host.startswith(prefix):
+                host = host[len(prefix):]
+        return f"{self.name}:{host}{parsed.path.rstrip('/')}"
 
-class LocalStorage(StorageService):
-    """Local Storage service class."""
 
-    def __init__(self, custom_path=None):
-        self.name = 'local'
-        if os.path.exists(custom_path):
-            self.music_folder = custom_path
-        else:
-            log.warning(f"Custom path '{custom_path}' doesn't exist. Using default path.")
-            self.music_folder = None
+class StorageService(ABC):
+    """Template for every storage service."""
 
+    @abstractmethod
     def connect(self):
-        """Initializes the connection attribute with the path to the user home folder's Music folder, and creates it if it doesn't exist."""
-
-        if self.music_folder is None:
-            music_folder = os.path.join(os.path.expanduser('~'), 'Music')
-            if not os.path.exists(music_folder):
-                os.makedirs(music_folder)
-            self.music_folder = music_folder
+        """Connects to the storage service, sets connection attribute."""
 
+    @abstractmethod
     def upload(self, file_name):
+        """Uploads a file to the storage and returns the location of the stored file."""
+
+    def upload_stream(self, stream, file_name):
         """
-        Moves the file associated with the file_name passed to the Music folder in the local storage.
-        
-        :param str file_name: Filename of the file to be uploaded
+        Uploads a file read from a stream to the storage, without it ever being written to local storage.
+
+        :param stream: File-like object with a read method, read until it returns no bytes
+        :param str file_name: Filename of the file in the storage
+        :return str: Location of the stored file
         """
-        
-        log.info(f"Upload for {file_name} has started")
-        start_time = time()
-        os.rename(file_name, os.path.join(self.music_folder, file_name))
-        end_time = time()
-        log.info(f"Upload for {file_name} has finished in {end_time - start_time} seconds")
+
+        raise NotImplementedError(f"{self.name} does not support streaming uploads.")
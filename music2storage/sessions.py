@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+from threading import Lock
+from time import time
+
+
+class UploadSessionStore:
+    """Persistent store of resumable upload session URIs, keyed by the file being uploaded."""
+
+    def __init__(self, path):
+        """
+        Opens (or creates) the session store at the given path.
+
+        :param str path: Path to the SQLite database file
+        """
+
+        self.path = path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL, uri TEXT NOT NULL, updated_at REAL NOT NULL)'
+        )
+
+    @staticmethod
+    def _key(file_name):
+        """
+        :param str file_name: Filename of the file being uploaded
+        :return tuple: Absolute path, size and modification time of the file, so a session is never resumed for a file that changed
+        """
+
+        stat = os.stat(file_name)
+        return os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns
+
+    def get(self, file_name):
+        """
+        Looks up the session of an upload of the file.
+
+        :param str file_name: Filename of the file being uploaded
+        :return str: Session URI, or None if there is none or the file changed since it was started
+        """
+
+        path, size, mtime = self._key(file_name)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT uri FROM sessions WHERE path = ? AND size = ? AND mtime = ?', (path, size, mtime)
+            ).fetchone()
+        return row[0] if row else None
+
+    def add(self, file_name, uri):
+        """
+        Records the session of an upload of the file.
+
+        :param str file_name: Filename of the file being uploaded
+        :param str uri: Session URI
+        """
+
+        path, size, mtime = self._key(file_name)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)', (path, size, mtime, uri, time()))
+
+    def remove(self, file_name):
+        """
+        Forgets the session of an upload of the file, once it is done or can't be resumed.
+
+        :param str file_name: Filename of the file being uploaded
+        """
+
+        with self.lock:
+            self.connection.execute('DELETE FROM sessions WHERE path = ?', (os.path.abspath(file_name),))
+
+    def close(self):
+        """Closes the connection to the database."""
+
+        with self.lock:
+            self.connection.close()
@@ -30,7 +30,10 @@ class SignalHandler:
         log.info('Gracefully killing the threads...')
         self.stopper.set()
 
-        for worker in self.workers:
+        for worker in list(self.workers):
+            worker.stop()
+
+        for worker in list(self.workers):
             worker.join(1)
 
         sys.exit(0)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+import os
+from urllib.parse import urlparse
+
+import requests
+from requests.exceptions import HTTPError
+
+from music2storage import log
+from music2storage.cache import TTLCache
+from music2storage.downloader import RangedDownloader, resize_session
+from music2storage.service import GuardedRequests, MusicService
+
+
+class Soundcloud(GuardedRequests, MusicService):
+    """Soundcloud service class."""
+
+    HOSTS = ('soundcloud.com', 'snd.sc')
+
+    API_URL = 'https://api.soundcloud.com'
+
+    def __init__(self, api_key=None, pool_size=10, resolve_ttl=3600, stream_ttl=120, connections=4, page_size=200):
+        """
+        Creates the service with its pool of HTTP connections and its caches.
+
+        :param str api_key: Client ID of the Soundcloud API (optional, a default one is used otherwise)
+        :param int pool_size: Number of downloads sharing the pool of HTTP connections, resized to the number of download workers
+        :param float resolve_ttl: Seconds the metadata of a resolved track is cached
+        :param float stream_ttl: Seconds the location of a track's stream is cached (the locations are signed and expire)
+        :param int connections: Number of connections used by one download
+        :param int page_size: Number of tracks fetched by one request when expanding a set
+        """
+
+        self.name = 'soundcloud'
+        if api_key is None:
+            self.client_id = '81f430860ad96d8170e3bf1639d4e072'
+        else:
+            self.client_id = api_key
+        self.session = requests.Session()
+        self.downloader = RangedDownloader(self.session, connections=connections, guarded=self.guarded)
+        self.set_pool_size(pool_size)
+        self.resolved = TTLCache(resolve_ttl)
+        self.locations = TTLCache(stream_ttl)
+        self.chunk_size = 1000000
+        self.page_size = page_size
+
+    def set_pool_size(self, size):
+        """
+        Sizes the pool of HTTP connections of the session shared by every request of the service, downloads using several connections.
+
+        :param int size: Number of downloads running at once
+        """
+
+        resize_session(self.session, size * self.downloader.connections)
+
+    def _get(self, url, **kwargs):
+        """
+        Sends a GET request through the guard of the service.
+
+        :param str url: URL of the request
+        :param kwargs: Arguments of Session.get
+        :return Response: Response of the request
+        :raises HTTPError: If the response has an error status
+        """
+
+        def get():
+            r = self.session.get(url, **kwargs)
+            if not r.ok:
+                r.close()
+            r.raise_for_status()
+            return r
+
+        return self.guarded(get)
+
+    def resolve(self, url):
+        """
+        Resolves the URL of a track into its metadata, from the cache when it was resolved recently.
+
+        Resolving a set caches the metadata of each of its tracks too, so downloading them afterwards needs no resolve request.
+
+        :param str url: URL of the track or set
+        :return dict: Metadata of the track or set
+        :raises HTTPError: If the URL can't be resolved
+        """
+
+        key = self.track_id(url)
+        track = self.resolved.get(key)
+        if track is None:
+            r = self._get(f"{self.API_URL}/resolve", params={'url': url, 'client_id': self.client_id},
+                          headers={'Accept': 'application/json'})
+            track = r.json()
+            for item in track.get('tracks', []):
+                if item.get('permalink_url') and item.get('stream_url'):
+                    self.resolved.set(self.track_id(item['permalink_url']), item)
+            self.resolved.set(key, track)
+        return track
+
+    def is_playlist(self, url):
+        """
+        Tells whether the URL points to a set, whose path is /<user>/sets/<set>.
+
+        :param str url: URL of a track or set
+        :return bool: True for set URLs
+        """
+
+        path = urlparse(url).path.strip('/').split('/')
+        return len(path) >= 3 and path[1] == 'sets'
+
+    def expand(self, url):
+        """
+        Yields the URLs of the tracks of the set at the URL passed, one page at a time.
+
+        The tracks the set was resolved with come first; the rest are paged in from the API only as the URLs are consumed. The metadata of
+        every track is cached, so downloading them afterwards needs no resolve request.
+
+        :param str url: URL of the set
+        :return generator: URLs of the tracks of the set, in order
+        :raises HTTPError: If the set can't be resolved or a page can't be fetched
+        """
+
+        playlist = self.resolve(url)
+        count = 0
+        for track in playlist.get('tracks', []):
+            if not (track.get('permalink_url') and track.get('stream_url')):
+                break
+            count += 1
+            yield track['permalink_url']
+        if count >= playlist.get('track_count', count):
+            return
+
+        next_href = f"{self.API_URL}/playlists/{playlist['id']}/tracks"
+        params = {'client_id': self.client_id, 'linked_partitioning': 'true', 'limit': self.page_size, 'offset': count}
+        while next_href:
+            page = self._get(next_href, params=params, headers={'Accept': 'application/json'}).json()
+            for track in page.get('collection', []):
+                self.resolved.set(self.track_id(track['permalink_url']), track)
+                yield track['permalink_url']
+            next_href = page.get('next_href')
+            params = {'client_id': self.client_id}
+
+    def _stream_location(self, track):
+        """
+        :param dict track: Metadata of the track
+        :return str: Signed location of the MP3 stream of the track, from the cache when it was looked up recently
+        """
+
+        location = self.locations.get(track['stream_url'])
+        if location is None:
+            r = self._get(track['stream_url'], params={'client_id': self.client_id}, allow_redirects=False)
+            location = r.headers['location']
+            self.locations.set(track['stream_url'], location)
+        return location
+
+    def _open(self, url):
+        """
+        Opens the MP3 stream of the track at the URL passed. A cached stream location that was refused is looked up again once.
+
+        :param str url: URL of the track
+        :return tuple: Metadata of the track and the streamed response, or None if the URL can't be resolved
+        """
+
+        try:
+            track = self.resolve(url)
+        except HTTPError:
+            log.error(f"{url} is not a Soundcloud URL.")
+            return None
+        try:
+            r = self._get(self._stream_location(track), stream=True)
+        except HTTPError as e:
+            if e.response is None or e.response.status_code not in (401, 403, 404, 410):
+                raise
+            self.locations.pop(track['stream_url'])
+            r = self._get(self._stream_location(track), stream=True)
+        return track, r
+
+    def download(self, url, directory=None):
+        """
+        Downloads a MP3 file that is associated with the track at the URL passed, over several connections.
+        
+        :param str url: URL of the track to be downloaded
+        :param str directory: Directory the file is downloaded into (optional, the current directory by default)
+        """
+
+        try:
+            track = self.resolve(url)
+        except HTTPError:
+            log.error(f"{url} is not a Soundcloud URL.")
+            return
+        file_name = os.path.join(directory or '', track['title'] + '.mp3')
+        try:
+            return self.downloader.download(self._stream_location(track), file_name, desc=track['title'])
+        except HTTPError as e:
+            if e.response is None or e.response.status_code not in (401, 403, 404, 410):
+                raise
+            self.locations.pop(track['stream_url'])
+            return self.downloader.download(self._stream_location(track), file_name, desc=track['title'])
+
+    def locate(self, url, fresh=False):
+        """
+        Returns where to download the MP3 stream of the track at the URL passed from.
+
+        :param str url: URL of the track
+        :param bool fresh: Looks the signed location up again instead of using the cached one, e.g. after it was refused
+        :return tuple: Signed location of the stream, filename of the track and its codec, or None if the URL can't be resolved
+        """
+
+        try:
+            track = self.resolve(url)
+        except HTTPError:
+            log.error(f"{url} is not a Soundcloud URL.")
+            return None
+        if fresh:
+            self.locations.pop(track['stream_url'])
+        return self._stream_location(track), track['title'] + '.mp3', 'mp3'
+
+    def codec(self, file_name):
+        """
+        Returns the audio codec of the files downloaded from Soundcloud, which are always MP3.
+
+        :param str file_name: Filename of a file returned by download
+        :return str: Name of the audio codec
+        """
+
+        return 'mp3'
+
+    def open_stream(self, url):
+        """
+        Opens the MP3 stream of the track at the URL passed as a stream of bytes.
+
+        :param str url: URL of the track
+        :return tuple: Title of the track, and an iterator over chunks of its bytes (or None if it can't be opened)
+        """
+
+        opened = self._open(url)
+        if opened is None:
+            return None
+        track, r = opened
+        return track['title'], r.iter_content(self.chunk_size)
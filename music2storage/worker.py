@@ -3,11 +3,14 @@
 import queue
 from threading import Thread
 
+from music2storage import log
+from music2storage.queues import STOP
+
 
 class Worker(Thread):
     """Worker that processes items from an input queue and puts the result into an output queue."""
 
-    def __init__(self, func, in_queue, out_queue, stopper):
+    def __init__(self, func, in_queue, out_queue, stopper, put_timeout=1, on_error=None):
         """
         Builds a worker by taking a function that does work on items from the input queue to be put in the output queue.
 
@@ -15,6 +18,8 @@ class Worker(Thread):
         :param Queue in_queue: Input queue
         :param Queue out_queue: Output queue
         :param threading.Event stopper: Event that signals that the thread should stop execution
+        :param float put_timeout: Seconds between two checks of the stopper while waiting for room in a full output queue
+        :param function on_error: Function called with the item and the exception when func raises one, e.g. to fail the job (optional)
         """
         
         super().__init__()
@@ -22,23 +27,64 @@ class Worker(Thread):
         self.in_queue = in_queue
         self.out_queue = out_queue
         self.stopper = stopper
+        self.put_timeout = put_timeout
+        self.on_error = on_error
+
+    def stop(self):
+        """Wakes up a worker blocked on the input queue so that it exits right away."""
+
+        self.in_queue.stop()
 
     def run(self):
         """
         Method that gets run when the Worker thread is started.
 
-        When there's an item in in_queue, it takes it out, passes it to func as an argument, and puts the result in out_queue.
+        Blocks until there's an item in in_queue, takes it out, passes it to func as an argument, and puts the result in out_queue.
+        A result of None means the item was dropped, so nothing is put in out_queue. An exception raised by func is logged and passed to
+        on_error along with the item, which is dropped, and the worker goes on with the next item. The worker exits when it takes the
+        STOP sentinel.
         """
         
         while not self.stopper.is_set():
-            try:
-                item = self.in_queue.get(timeout=5)
-            except queue.Empty:
-                continue
+            item = self.in_queue.get()
+            if item is STOP:
+                break
 
             try:
                 result = self.func(item)
-            except TypeError:
+            except Exception as e:
+                log.exception(f"Worker has failed to process {item}")
+                self._error(item, e)
+            else:
+                if result is not None:
+                    self._put(result)
+
+    def _error(self, item, error):
+        """
+        Passes an item that func failed to process to on_error, if any, logging any exception it raises in turn.
+
+        :param item: Item taken out of in_queue
+        :param Exception error: Exception raised by func
+        """
+
+        if self.on_error is None:
+            return
+        try:
+            self.on_error(item, error)
+        except Exception:
+            log.exception(f"Error handler has failed for {item}")
+
+    def _put(self, result):
+        """
+        Puts the result in out_queue, waiting for room if it is full, unless the stopper gets set in the meantime.
+
+        :param result: Result of func to be put in out_queue
+        """
+
+        while not self.stopper.is_set():
+            try:
+                self.out_queue.put(result, timeout=self.put_timeout)
+            except queue.Full:
                 continue
             else:
-                self.out_queue.put(result)
+                return
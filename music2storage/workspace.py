@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import shutil
+from threading import Condition, Thread
+from time import monotonic, time
+
+from music2storage import log
+
+
+class Workspace:
+    """
+    Scratch directory where every job downloads and converts its files in a directory of its own, within a budget of disk space.
+
+    Jobs are only admitted once the space taken by the workspace is under the budget, so downloads wait for the files of finished jobs
+    to be removed instead of filling the disk. The directory of a job is named after its track, so a job that failed can leave its
+    partial download behind for the next job for the same track to resume. Directories left behind by failures and crashes are
+    reclaimed by the sweeper.
+    """
+
+    def __init__(self, root, budget=None, orphan_age=3600, usage_ttl=1):
+        """
+        Creates the root directory of the workspace if it doesn't exist.
+
+        :param str root: Directory of the workspace, which may be on a tmpfs such as /dev/shm to keep scratch files in memory
+        :param int budget: Maximum number of bytes taken by the workspace before jobs wait to be admitted (optional, unlimited by default)
+        :param float orphan_age: Seconds since their last modification after which directories of unknown jobs are swept
+        :param float usage_ttl: Seconds the measured disk usage is reused before the workspace is walked again
+        """
+
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        self.budget = budget
+        self.orphan_age = orphan_age
+        self.usage_ttl = usage_ttl
+        self.active = set()
+        self.condition = Condition()
+        self.measured = None
+        self.measured_at = 0.0
+        self.swept = 0
+
+    @staticmethod
+    def key(job):
+        """
+        Returns the name of the directory of the job, the same for every job for the same track.
+
+        :param Job job: Job in the pipeline
+        :return str: Digest of the track ID of the job, or of its URL if the track ID is unknown
+        """
+
+        return hashlib.sha1((job.track_id or job.url).encode()).hexdigest()[:20]
+
+    def directory(self, job):
+        """
+        Returns the directory of the job, creating it on first use.
+
+        :param Job job: Job in the pipeline
+        :return str: Absolute path of the directory of the job
+        """
+
+        key = self.key(job)
+        path = os.path.join(self.root, key)
+        os.makedirs(path, exist_ok=True)
+        with self.condition:
+            self.active.add(key)
+        return path
+
+    def usage(self, fresh=False):
+        """
+        Returns the space taken by the files of the workspace, walking it at most once per usage_ttl.
+
+        Allocated blocks are counted rather than file sizes, so preallocated downloads count in full from the start.
+
+        :param bool fresh: Walks the workspace even if it was walked recently
+        :return int: Number of bytes allocated to the files of the workspace
+        """
+
+        with self.condition:
+            if not fresh and self.measured is not None and monotonic() - self.measured_at < self.usage_ttl:
+                return self.measured
+        total = self._allocated(self.root)
+        with self.condition:
+            self.measured = total
+            self.measured_at = monotonic()
+        return total
+
+    @staticmethod
+    def _allocated(path):
+        """
+        :param str path: Directory to walk
+        :return int: Number of bytes allocated to the files under the directory
+        """
+
+        total = 0
+        for directory, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(directory, name)).st_blocks * 512
+                except OSError:
+                    pass
+        return total
+
+    def evict(self, spare=None):
+        """
+        Removes the directories kept by failed jobs, oldest first, until the workspace is under its budget. Directories of jobs in the
+        pipeline are left alone.
+
+        :param str spare: Key of a directory to leave alone as well, e.g. the one of the job being admitted, so it can resume its files
+        :return int: Number of directories removed
+        """
+
+        removed = 0
+        with self.condition:
+            kept = []
+            for entry in os.scandir(self.root):
+                try:
+                    if entry.name not in self.active and entry.name != spare and entry.is_dir(follow_symlinks=False):
+                        kept.append((entry.stat(follow_symlinks=False).st_mtime, entry.path))
+                except OSError:
+                    continue
+            used = self.usage(fresh=True)
+            for _, path in sorted(kept):
+                if used < self.budget:
+                    break
+                used -= self._allocated(path)
+                shutil.rmtree(path, ignore_errors=True)
+                log.info(f"Evicted kept scratch directory {path} to stay within the budget of {self.budget} bytes")
+                removed += 1
+            if removed:
+                self.measured = None
+                self.condition.notify_all()
+        return removed
+
+    def admit(self, job, stopper=None, block=True):
+        """
+        Waits until the workspace is under its budget, then gives the job its directory.
+
+        A job is always admitted when no other job is in the workspace, so a single file larger than the budget can't wait forever. The
+        directories kept by failed jobs are evicted before the job waits for jobs in the pipeline to free space.
+
+        :param Job job: Job about to download its files
+        :param threading.Event stopper: Event that stops the wait when set (optional)
+        :param bool block: Whether to wait for space, rather than return None right away when the workspace is over its budget
+        :return str: Directory of the job, or None if the job wasn't admitted without waiting
+        """
+
+        if self.budget is not None:
+            waited = False
+            with self.condition:
+                while (self.active - {self.key(job)}) and self.usage() >= self.budget:
+                    if stopper is not None and stopper.is_set():
+                        break
+                    if self.evict(spare=self.key(job)):
+                        continue
+                    if not block:
+                        return None
+                    if not waited:
+                        log.info(f"Workspace is over its budget of {self.budget} bytes, {job.url} waits for space")
+                        waited = True
+                    self.condition.wait(self.usage_ttl)
+        return self.directory(job)
+
+    def remove(self, job, keep=False):
+        """
+        Removes the directory of the job and its files, and lets waiting jobs in.
+
+        :param Job job: Job that finished or failed
+        :param bool keep: Leaves the files of the job, e.g. a partial download, for the next job for the same track to resume. The
+                          sweeper removes them once they are orphan_age old
+        """
+
+        key = self.key(job)
+        if not keep:
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+        with self.condition:
+            self.active.discard(key)
+            self.measured = None
+            self.condition.notify_all()
+
+    def keep(self, job):
+        """
+        Marks the directory of a job resumed from the job store as in use, so the sweeper leaves its files alone.
+
+        :param Job job: Job resumed after a restart
+        """
+
+        with self.condition:
+            self.active.add(self.key(job))
+
+    def sweep(self):
+        """
+        Removes the directories and files of the workspace that belong to no job in the pipeline and weren't modified for orphan_age.
+
+        :return int: Number of entries removed
+        """
+
+        removed = 0
+        now = time()
+        with self.condition:
+            active = set(self.active)
+        for entry in os.scandir(self.root):
+            try:
+                if entry.name in active or now - entry.stat(follow_symlinks=False).st_mtime < self.orphan_age:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+            log.info(f"Swept orphaned scratch entry {entry.path}")
+            removed += 1
+        if removed:
+            with self.condition:
+                self.swept += removed
+                self.measured = None
+                self.condition.notify_all()
+        return removed
+
+    def stats(self):
+        """
+        :return dict: Bytes taken by the workspace, its budget, number of jobs with a directory and number of orphans swept
+        """
+
+        used = self.usage()
+        with self.condition:
+            return {'root': self.root, 'used': used, 'budget': self.budget, 'jobs': len(self.active), 'swept': self.swept}
+
+
+class Sweeper(Thread):
+    """Thread that periodically sweeps the orphaned files out of a workspace."""
+
+    def __init__(self, workspace, stopper, interval=300):
+        """
+        :param Workspace workspace: Workspace to sweep
+        :param threading.Event stopper: Event that signals that the thread should stop execution
+        :param float interval: Seconds between two sweeps, the first one running right away
+        """
+
+        super().__init__(daemon=True)
+        self.workspace = workspace
+        self.stopper = stopper
+        self.interval = interval
+
+    def run(self):
+        """Sweeps the workspace at each interval until the stopper is set."""
+
+        while True:
+            try:
+                self.workspace.sweep()
+            except OSError:
+                log.exception(f"Sweep of {self.workspace.root} has failed")
+            if self.stopper.wait(self.interval):
+                break
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import os
+from urllib.parse import urlparse, parse_qs
+
+from pytube import Playlist, YouTube, request
+from pytube.exceptions import RegexMatchError
+import requests
+
+from music2storage import log
+from music2storage.downloader import RangedDownloader, resize_session
+from music2storage.service import GuardedRequests, MusicService
+
+
+class Youtube(GuardedRequests, MusicService):
+    """Youtube service class."""
+
+    HOSTS = ('youtube.com', 'youtu.be', 'youtube-nocookie.com')
+
+    def __init__(self, max_abr=None, min_abr=None, connections=4, pool_size=10):
+        """
+        Creates the service with the bounds used to pick the audio-only stream of each video.
+
+        :param int max_abr: Highest audio bitrate to download in kbps (optional, the best available by default)
+        :param int min_abr: Lowest acceptable audio bitrate in kbps; when set, the smallest stream above it is picked (optional)
+        :param int connections: Number of connections used by one download
+        :param int pool_size: Number of downloads sharing the pool of HTTP connections, resized to the number of download workers
+        """
+
+        self.name = 'youtube'
+        self.max_abr = max_abr
+        self.min_abr = min_abr
+        self.codecs = {}
+        self.downloader = RangedDownloader(requests.Session(), connections=connections, guarded=self.guarded)
+        self.set_pool_size(pool_size)
+
+    def set_pool_size(self, size):
+        """
+        Sizes the pool of HTTP connections shared by the downloads, which each use several connections.
+
+        :param int size: Number of downloads running at once
+        """
+
+        resize_session(self.downloader.session, size * self.downloader.connections)
+
+    def select_stream(self, yt):
+        """
+        Picks the audio-only stream to download, so no video frames are downloaded only to be discarded by FFmpeg.
+
+        Without a min_abr, the best stream under max_abr is picked; with one, the smallest stream meeting it (and under max_abr) is picked.
+        When no stream meets min_abr, the best stream under max_abr is picked instead. Falls back to the smallest audio-only stream when
+        none is under max_abr, and to the first stream when there is no audio-only one.
+
+        :param YouTube yt: Video to pick a stream from
+        :return Stream: Stream to download
+        """
+
+        def abr(stream):
+            try:
+                return int(stream.abr.rstrip('kbps'))
+            except (AttributeError, ValueError):
+                return 0
+
+        audio_streams = sorted(yt.streams.filter(only_audio=True), key=abr)
+        if not audio_streams:
+            return yt.streams.first()
+
+        candidates = [stream for stream in audio_streams if self.max_abr is None or abr(stream) <= self.max_abr]
+        meeting_floor = [stream for stream in candidates if self.min_abr is None or abr(stream) >= self.min_abr]
+        if self.min_abr is not None and meeting_floor:
+            return meeting_floor[0]
+        return candidates[-1] if candidates else audio_streams[0]
+
+    def codec(self, file_name):
+        """
+        Returns the audio codec of the stream downloaded into the file. The codec is forgotten once returned.
+
+        :param str file_name: Filename of a file returned by download
+        :return str: Name of the audio codec (e.g. 'opus', 'mp4a.40.2'), or None if unknown
+        """
+
+        return self.codecs.pop(file_name, None)
+
+    def download(self, url, directory=None):
+        """
+        Downloads the audio-only MP4 or WebM file that is associated with the video at the URL passed, over several connections.
+
+        :param str url: URL of the video to be downloaded
+        :param str directory: Directory the file is downloaded into (optional, the current directory by default)
+        :return str: Filename of the file in local storage
+        """
+
+        media = self.locate(url)
+        if media is None:
+            return None
+        media_url, name, codec = media
+        file_name = os.path.join(directory or '', name)
+        self.downloader.download(media_url, file_name)
+        self.codecs[file_name] = codec
+        return file_name
+
+    def locate(self, url, fresh=False):
+        """
+        Picks the audio-only stream of the video at the URL passed and returns where to download it from.
+
+        :param str url: URL of the video
+        :param bool fresh: Ignored, streams are always looked up again
+        :return tuple: Signed URL of the stream, its filename and its audio codec, or None if the URL isn't a video
+        """
+
+        try:
+            yt = YouTube(url)
+        except RegexMatchError:
+            log.error(f"Cannot download file at {url}")
+            return None
+        stream = self.guarded(self.select_stream, yt)
+        log.info(f"Picked the {stream.audio_codec} stream at {stream.abr} for {stream.default_filename}")
+        return stream.url, stream.default_filename, stream.audio_codec
+
+    def open_stream(self, url):
+        """
+        Opens the audio-only MP4 or WebM stream of the video at the URL passed as a stream of bytes.
+
+        :param str url: URL of the video
+        :return tuple: Filename of the video without extension, and an iterator over chunks of its bytes (or None if it can't be opened)
+        """
+
+        try:
+            yt = YouTube(url)
+        except RegexMatchError:
+            log.error(f"Cannot download file at {url}")
+            return None
+        stream = self.guarded(self.select_stream, yt)
+        return os.path.splitext(stream.default_filename)[0], request.stream(stream.url)
+
+    def is_playlist(self, url):
+        """
+        Tells whether the URL points to a playlist page. A video watched from a playlist is a track, even with a list parameter.
+
+        :param str url: URL of a video or playlist
+        :return bool: True for playlist URLs
+        """
+
+        parsed = urlparse(url)
+        return parsed.path.rstrip('/') == '/playlist' and 'list' in parse_qs(parsed.query)
+
+    def expand(self, url):
+        """
+        Yields the URLs of the videos of the playlist at the URL passed, fetching the next page of the playlist only once the videos
+        of the previous one are consumed.
+
+        :param str url: URL of the playlist
+        :return generator: URLs of the videos of the playlist, in order
+        """
+
+        yield from Playlist(url).url_generator()
+
+    def track_id(self, url):
+        """
+        Returns the canonical ID of the video at the URL passed, which is its YouTube video ID.
+
+        :param str url: URL of the video
+        :return str: Canonical ID of the video
+        """
+
+        parsed = urlparse(url)
+        host = parsed.netloc.lower()
+        path = parsed.path.strip('/').split('/')
+        if host.endswith('youtu.be') and path[0]:
+            return f"youtube:{path[0]}"
+        video_ids = parse_qs(parsed.query).get('v')
+        if video_ids:
+            return f"youtube:{video_ids[0]}"
+        if len(path) > 1 and path[0] in ('embed', 'shorts', 'v', 'live'):
+            return f"youtube:{path[1]}"
+        return super().track_id(url)
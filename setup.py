@@ -20,11 +20,13 @@ setup(name='music2storage',
           'google-api-python-client',
           'pytube',
           'requests',
-          'tqdm',
-          'soundcloud'
+          'tqdm'
       ],
+      extras_require={
+          'async': ['aiohttp']
+      },
       include_package_data=True,
-      python_requires=">=3.6",
+      python_requires=">=3.7",
       zip_safe=False,
       test_suite='nose.collector',
       tests_require=['nose'],
@@ -32,6 +34,6 @@ setup(name='music2storage',
           'Intended Audience :: Developers',
           'Natural Language :: English',
           'Programming Language :: Python',
-          'Programming Language :: Python :: 3.6',
+          'Programming Language :: Python :: 3.7',
           'Programming Language :: Python :: Implementation :: CPython'
       ])
@@ -1,19 +1,226 @@
 # -*- coding: utf-8 -*-
 
+import os
 import queue
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 
 from music2storage import Music2Storage
+from music2storage.job import Job, JobFailed
+from music2storage.service import GuardedRequests
+from music2storage.workspace import Workspace
+
+
+def use_mocked_services(mocked_handler):
+    """Routes every URL to the current music service of a mocked ConnectionHandler, and makes its guards call what they are given."""
+
+    handler = mocked_handler.return_value
+    handler.music_for.return_value = handler.current_music
+    handler.current_music.handles.return_value = False
+    handler.current_music.is_playlist.return_value = False
+    handler.guard.return_value.call.side_effect = lambda func, *args, retry=True: func(*args)
 
 
 class TestMusic2Storage(TestCase):
+    @patch('music2storage.ConnectionHandler')
+    def test_add_to_queue_expands_playlist_with_backpressure(self, mocked_handler):
+        use_mocked_services(mocked_handler)
+        music = mocked_handler.return_value.current_music
+        music.is_playlist.side_effect = lambda url: url.endswith('playlist')
+        music.track_id.side_effect = lambda url: url
+        expanded = []
+
+        def expand(url):
+            for i in range(5):
+                expanded.append(i)
+                yield f"http://example.com/{i}"
+        music.expand.side_effect = expand
+
+        m2s = Music2Storage(queue_sizes={'download': 2})
+        jobs = m2s.add_to_queue('http://example.com/playlist')
+        m2s.wait_for_expansions(timeout=0.2)
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(len(expanded), 3)
+
+        taken = [m2s.queues['download'].get() for _ in range(3)]
+        m2s.wait_for_expansions()
+        self.assertEqual([job.url for job in jobs], [f"http://example.com/{i}" for i in range(5)])
+        self.assertEqual(taken, jobs[:3])
+        self.assertEqual(m2s.expanders, [])
+
+    @patch('music2storage.ConnectionHandler')
+    def test_finished_expansions_are_dropped(self, mocked_handler):
+        use_mocked_services(mocked_handler)
+        music = mocked_handler.return_value.current_music
+        music.is_playlist.return_value = True
+        music.expand.return_value = iter([])
+
+        m2s = Music2Storage()
+        m2s.add_to_queue('http://example.com/playlist')
+        for expander in list(m2s.expanders):
+            expander.join()
+        self.assertEqual(m2s.expanders, [])
+
     @patch('music2storage.ConnectionHandler')
     def test_add_to_queue_with_drive_service(self, mocked_handler):
+        use_mocked_services(mocked_handler)
         m2s = Music2Storage()
         m2s.add_to_queue('http://example.com/')
         self.assertEqual(m2s.queues['download'].qsize(), 1)
-        self.assertEqual(m2s.queues['download'].get_nowait(), 'http://example.com/')
+        self.assertEqual(m2s.queues['download'].get_nowait().url, 'http://example.com/')
+
+    @patch('music2storage.JobStore')
+    @patch('music2storage.ConnectionHandler')
+    def test_add_to_queue_with_job_store(self, mocked_handler, mocked_store):
+        use_mocked_services(mocked_handler)
+        m2s = Music2Storage(job_store='jobs.db')
+        job = m2s.add_to_queue('http://example.com/')
+        mocked_store.assert_called_with('jobs.db')
+        mocked_store.return_value.add.assert_called_with(job)
+        self.assertEqual(m2s.queues['download'].get_nowait(), job)
+
+    @patch('music2storage.TrackIndex')
+    @patch('music2storage.ConnectionHandler')
+    def test_add_to_queue_already_stored(self, mocked_handler, mocked_index):
+        use_mocked_services(mocked_handler)
+        mocked_index.return_value.get.return_value = 'file-id'
+        m2s = Music2Storage(track_index='index.db')
+        job = m2s.add_to_queue('http://example.com/')
+        self.assertEqual(job.stage, 'done')
+        self.assertEqual(job.location, 'file-id')
+        self.assertEqual(m2s.queues['download'].qsize(), 0)
+        self.assertEqual(m2s.completions.recent(), [job])
+        self.assertEqual(job.result(0), 'file-id')
+
+    @patch('music2storage.ConnectionHandler')
+    def test_add_to_queue_with_priority_and_tenant(self, mocked_handler):
+        use_mocked_services(mocked_handler)
+        mocked_handler.return_value.current_music.track_id.side_effect = lambda url: url
+        m2s = Music2Storage()
+        bulk = [m2s.add_to_queue(f'http://example.com/bulk/{i}', tenant='bulk') for i in range(3)]
+        user = m2s.add_to_queue('http://example.com/user', tenant='user')
+        urgent = m2s.add_to_queue('http://example.com/urgent', priority=1, tenant='bulk')
+        self.assertEqual((user.tenant, urgent.priority), ('user', 1))
+        self.assertEqual([m2s.queues['download'].get_nowait() for _ in range(5)], [urgent, user, bulk[0], bulk[1], bulk[2]])
+
+    @patch('music2storage.pool.Worker')
+    @patch('music2storage.ConnectionHandler')
+    def test_tenant_caps_released_after_stage(self, mocked_handler, mocked_worker):
+        use_mocked_services(mocked_handler)
+        mocked_handler.return_value.current_music.download.return_value = 'filename.mp3'
+        mocked_handler.return_value.current_music.track_id.side_effect = lambda url: url
+        m2s = Music2Storage(tenant_caps={'download': 1})
+        self.assertEqual(m2s.queues['download'].cap, 1)
+        self.assertIsNone(m2s.queues['convert'].cap)
+        self.assertEqual(m2s._new_queue('download:youtube').cap, 1)
+        self.assertIs(m2s._new_queue('download:youtube').running, m2s.queues['download'].running)
+        self.assertIsNot(Music2Storage(tenant_caps={'download:youtube': 2})._new_queue('download:youtube').running,
+                         m2s.queues['download'].running)
+        m2s.start_workers(1)
+
+        first, second = [m2s.add_to_queue(f'http://example.com/{i}', tenant='bulk') for i in range(2)]
+        self.assertIs(m2s.queues['download'].get_nowait(), first)
+        self.assertRaises(queue.Empty, m2s.queues['download'].get_nowait)
+        m2s.pools['download'].func(first)
+        self.assertIs(m2s.queues['download'].get_nowait(), second)
+
+    @patch('music2storage.ConnectionHandler')
+    def test_add_to_queue_coalesces_same_track(self, mocked_handler):
+        use_mocked_services(mocked_handler)
+        mocked_handler.return_value.current_music.track_id.return_value = 'youtube:id'
+        m2s = Music2Storage()
+        first = m2s.add_to_queue('http://example.com/1')
+        second = m2s.add_to_queue('http://example.com/2')
+        self.assertEqual(m2s.queues['download'].qsize(), 1)
+        first.stage = 'delete'
+        first.file_name = 'filename.mp3'
+        first.location = 'file-id'
+        with patch('music2storage.delete_local_file'):
+            m2s._delete(first)
+        self.assertEqual(m2s.completions.recent(), [first, second])
+        self.assertEqual(second.result(0), 'file-id')
+        self.assertEqual(second.stage, 'done')
+        self.assertEqual(second.location, 'file-id')
+        self.assertEqual(m2s.in_flight, {})
+
+    @patch('music2storage.os.path.getsize')
+    @patch('music2storage.ConnectionHandler')
+    def test_smallest_files_converted_first(self, mocked_handler, mocked_getsize):
+        use_mocked_services(mocked_handler)
+        mocked_getsize.side_effect = lambda file_name: {'big.mp4': 300, 'small.mp4': 100}[file_name]
+        m2s = Music2Storage()
+        big, small, urgent = Job('http://example.com/1', file_name='big.mp4'), Job('http://example.com/2', file_name='small.mp4'), \
+            Job('http://example.com/3', file_name='big.mp4', priority=1)
+        for job in (big, small, urgent):
+            m2s.queues['convert'].put(job)
+        self.assertEqual([m2s.queues['convert'].get_nowait() for _ in range(3)], [urgent, small, big])
+
+    @patch('music2storage.scheduler.os.cpu_count', return_value=8)
+    def test_conversions_sized_by_convert_workers(self, mocked_cpu_count):
+        m2s = Music2Storage()
+        m2s.start_workers(pool_sizes={'convert': (2, 4)})
+        self.assertEqual(m2s.converter.max_jobs, 4)
+        self.assertEqual(m2s.converter.threads_per_job, 2)
+        m2s.stopper.set()
+        for worker in m2s.workers:
+            worker.stop()
+
+    def test_guarded_service_sends_its_own_requests(self):
+        class Service(GuardedRequests):
+            name = 'youtube'
+
+        m2s = Music2Storage()
+        service = m2s.connection_handler.music_services['youtube'] = Service()
+        m2s.limit_service('youtube', rate=100)
+        self.assertIs(service.guard, m2s.connection_handler.guards['youtube'])
+
+        self.assertEqual(m2s._request(service, lambda url: url, 'http://example.com/'), 'http://example.com/')
+        self.assertEqual(service.guard.stats()['calls'], 0)
+        self.assertEqual(service.guarded(lambda: 'response'), 'response')
+        self.assertEqual(service.guard.stats()['calls'], 1)
+
+    def make_routed(self):
+        m2s = Music2Storage()
+        m2s.connection_handler.current_storage = MagicMock()
+        for name, hosts in (('youtube', ('youtube.com', 'youtu.be')), ('soundcloud', ('soundcloud.com',))):
+            service = MagicMock()
+            service.name = name
+            service.handles.side_effect = lambda url, hosts=hosts: any(host in url for host in hosts)
+            service.track_id.side_effect = lambda url: url
+            service.is_playlist.return_value = False
+            m2s.connection_handler.music_services[name] = service
+        m2s.connection_handler.current_music = m2s.connection_handler.music_services['soundcloud']
+        return m2s
+
+    def test_add_to_queue_routes_by_host(self):
+        m2s = self.make_routed()
+        m2s.add_to_queue('https://youtu.be/DhHGDOgjie4')
+        m2s.add_to_queue('https://soundcloud.com/artist/track')
+        m2s.add_to_queue('https://example.com/track')
+        self.assertEqual(m2s.queues['download:youtube'].get_nowait().url, 'https://youtu.be/DhHGDOgjie4')
+        self.assertEqual(m2s.queues['download:soundcloud'].get_nowait().url, 'https://soundcloud.com/artist/track')
+        self.assertEqual(m2s.queues['download'].get_nowait().url, 'https://example.com/track')
+
+    @patch('music2storage.pool.Worker')
+    @patch('music2storage.SignalHandler')
+    @patch('music2storage.signal.signal')
+    def test_start_workers_download_pool_per_music_service(self, mocked_signal_signal, mocked_signal_handler, mocked_worker):
+        m2s = self.make_routed()
+        m2s.start_workers(1, pool_sizes={'download': 3, 'download:soundcloud': 1})
+        self.assertEqual(m2s.pools['download:youtube'].size, 3)
+        self.assertEqual(m2s.pools['download:soundcloud'].size, 1)
+        self.assertEqual(m2s.pools['download:youtube'].in_queue, m2s.queues['download:youtube'])
+        m2s.connection_handler.music_services['youtube'].set_pool_size.assert_called_with(3)
+
+        service = MagicMock()
+        service.name = 'bandcamp'
+        service.handles.return_value = True
+        service.is_playlist.return_value = False
+        m2s.connection_handler.music_services = {'bandcamp': service}
+        m2s.add_to_queue('https://artist.bandcamp.com/track/title')
+        self.assertEqual(m2s.pools['download:bandcamp'].size, 3)
+        self.assertEqual(m2s.queues['download:bandcamp'].qsize(), 1)
 
     @patch('music2storage.ConnectionHandler')
     def test_add_to_queue_without_drive_service(self, mocked_handler):
@@ -36,7 +243,7 @@ class TestMusic2Storage(TestCase):
         m2s.connect_storage_service('google drive')
         mocked_handler.return_value.connect_storage_service.assert_called_with('google drive')
 
-    @patch('music2storage.Worker')
+    @patch('music2storage.pool.Worker')
     @patch('music2storage.SignalHandler')
     @patch('music2storage.signal.signal')
     @patch('music2storage.signal.SIGINT')
@@ -44,14 +251,64 @@ class TestMusic2Storage(TestCase):
         m2s = Music2Storage()
         num_of_queues = len(m2s.queues.items())
         m2s.start_workers(2)
-        self.assertEqual(len(m2s.workers), num_of_queues*2 - 2)
-        self.assertEqual(len(mocked_worker.mock_calls), 2*(num_of_queues*2 - 2))
+        self.assertEqual(len(m2s.workers), num_of_queues*2)
+        self.assertEqual(len(mocked_worker.mock_calls), 2*(num_of_queues*2))
         self.assertTrue(mocked_signal_handler)
         mocked_signal_handler.assert_called_with(m2s.workers, m2s.stopper)
         mocked_signal_signal.assert_called_with(mocked_signal_sigint, mocked_signal_handler.return_value)
-        self.assertEqual(len(mocked_worker.return_value.start.mock_calls), num_of_queues*2 - 2)
+        self.assertEqual(len(mocked_worker.return_value.start.mock_calls), num_of_queues*2)
 
-    @patch('music2storage.Worker')
+    @patch('music2storage.pool.Worker')
+    @patch('music2storage.SignalHandler')
+    @patch('music2storage.signal.signal')
+    @patch('music2storage.Autoscaler')
+    def test_start_workers_pool_sizes(self, mocked_autoscaler, mocked_signal_signal, mocked_signal_handler, mocked_worker):
+        m2s = Music2Storage()
+        m2s.start_workers(1, pool_sizes={'convert': 4, 'upload': (2, 8)})
+        self.assertEqual(m2s.pools['download'].size, 1)
+        self.assertEqual(m2s.pools['convert'].size, 4)
+        self.assertEqual(m2s.pools['upload'].size, 2)
+        self.assertEqual(m2s.pools['upload'].max_size, 8)
+        self.assertEqual(m2s.pools['delete'].size, 1)
+        self.assertEqual(len(m2s.workers), 8)
+        mocked_autoscaler.return_value.start.assert_called()
+
+    @patch('music2storage.pool.Worker')
+    @patch('music2storage.SignalHandler')
+    @patch('music2storage.signal.signal')
+    @patch('music2storage.JobStore')
+    @patch('music2storage.ConnectionHandler')
+    def test_start_workers_resumes_pending_jobs(self, mocked_handler, mocked_store, mocked_signal_signal, mocked_signal_handler, mocked_worker):
+        pending = [Job('http://example.com/1', stage='convert', file_name='1.mp4'), Job('http://example.com/2', stage='upload', file_name='2.mp3')]
+        mocked_store.return_value.pending.return_value = pending
+        m2s = Music2Storage(job_store='jobs.db')
+        m2s.start_workers(1)
+        m2s.wait_for_expansions()
+        self.assertEqual(m2s.queues['convert'].get_nowait(), pending[0])
+        self.assertEqual(m2s.queues['upload'].get_nowait(), pending[1])
+
+    @patch('music2storage.pool.Worker')
+    @patch('music2storage.SignalHandler')
+    @patch('music2storage.signal.signal')
+    @patch('music2storage.JobStore')
+    @patch('music2storage.ConnectionHandler')
+    def test_start_workers_resumes_into_bounded_queue_without_blocking(self, mocked_handler, mocked_store, mocked_signal_signal,
+                                                                       mocked_signal_handler, mocked_worker):
+        use_mocked_services(mocked_handler)
+        pending = [Job(f"http://example.com/{i}", stage='convert', file_name=f"{i}.mp4") for i in range(5)]
+        mocked_store.return_value.pending.return_value = pending
+        m2s = Music2Storage(job_store='jobs.db', queue_sizes={'convert': 2})
+        m2s.start_workers(1)
+        m2s.wait_for_expansions(timeout=0.2)
+        self.assertEqual(m2s.queues['convert'].qsize(), 2)
+        self.assertEqual(len(m2s.in_flight), 5)
+
+        taken = [m2s.queues['convert'].get() for _ in range(5)]
+        m2s.wait_for_expansions()
+        self.assertEqual(taken, pending)
+        self.assertEqual(m2s.expanders, [])
+
+    @patch('music2storage.pool.Worker')
     @patch('music2storage.SignalHandler')
     def test_start_workers_already_started(self, mocked_signal_handler, mocked_worker):
         m2s = Music2Storage()
@@ -62,36 +319,235 @@ class TestMusic2Storage(TestCase):
         self.assertFalse(mocked_signal_handler.called)
         self.assertFalse(mocked_worker.return_value.start.called)
 
-    @patch('music2storage.download_from_youtube', return_value='filename.mp4')
-    def test_download_sucess(self, mocked_download_from_youtube):
+    @patch('music2storage.ConnectionHandler')
+    def test_download_sucess(self, mocked_handler):
+        use_mocked_services(mocked_handler)
+        mocked_handler.return_value.current_music.download.return_value = 'filename.mp4'
         m2s = Music2Storage()
-        result = m2s._download('http://example.com/')
-        mocked_download_from_youtube.assert_called_with('http://example.com/')
-        self.assertEqual(result, 'filename.mp4')
+        job = Job('http://example.com/')
+        result = m2s._download(job)
+        mocked_handler.return_value.current_music.download.assert_called_with('http://example.com/')
+        self.assertEqual(result, job)
+        self.assertEqual(job.stage, 'convert')
+        self.assertEqual(job.file_name, 'filename.mp4')
+        self.assertEqual(job.codec, mocked_handler.return_value.current_music.codec.return_value)
+
+    @patch('music2storage.ConnectionHandler')
+    def test_download_into_workspace(self, mocked_handler):
+        use_mocked_services(mocked_handler)
+        with TemporaryDirectory() as directory:
+            m2s = Music2Storage(workspace=directory)
+            job = Job('http://example.com/')
+
+            def download(url, job_directory):
+                file_name = os.path.join(job_directory, 'title.mp4')
+                open(file_name, 'wb').close()
+                return file_name
+            mocked_handler.return_value.current_music.download.side_effect = download
+
+            m2s._download(job)
+            self.assertEqual(job.file_name, os.path.join(directory, Workspace.key(job), 'title.mp4'))
+            self.assertTrue(os.path.exists(job.file_name))
+            self.assertEqual(m2s.stats()['workspace']['jobs'], 1)
+
+            m2s._advance(job, 'failed')
+            m2s._finish(job)
+            self.assertTrue(os.path.exists(job.file_name))
+            self.assertEqual(m2s.stats()['workspace']['jobs'], 0)
+
+            retry = Job('http://example.com/')
+            m2s._download(retry)
+            self.assertEqual(retry.file_name, job.file_name)
+            m2s._advance(retry, 'done')
+            m2s._finish(retry)
+            self.assertEqual(os.listdir(directory), [])
+
+    @patch('music2storage.ConnectionHandler')
+    def test_download_failure(self, mocked_handler):
+        use_mocked_services(mocked_handler)
+        mocked_handler.return_value.current_music.download.return_value = None
+        m2s = Music2Storage()
+        job = Job('http://example.com/')
+        self.assertIsNone(m2s._download(job))
+        self.assertEqual(job.stage, 'failed')
+        self.assertEqual(m2s.completions.recent(), [job])
+        self.assertRaises(JobFailed, job.result, 0)
+
+    @patch('music2storage.ConnectionHandler')
+    @patch('music2storage.convert_to_mp3', side_effect=KeyError('bitrate'))
+    def test_stage_exception_fails_job(self, mocked_convert, mocked_handler):
+        use_mocked_services(mocked_handler)
+        mocked_handler.return_value.current_music.download.return_value = 'filename.mp4'
+        m2s = Music2Storage()
+        m2s.start_workers(1)
+        job = m2s.add_to_queue('http://example.com/')
+        self.assertRaises(JobFailed, job.result, 1)
+        self.assertEqual(job.stage, 'failed')
+        self.assertIsInstance(job.error, KeyError)
+        self.assertEqual(m2s.in_flight, {})
+        self.assertTrue(all(worker.is_alive() for worker in m2s.workers))
+        m2s.stopper.set()
+        for worker in m2s.workers:
+            worker.stop()
+
+    @patch('music2storage.ConnectionHandler')
+    def test_download_error_is_kept_on_job(self, mocked_handler):
+        use_mocked_services(mocked_handler)
+        error = ConnectionError()
+        mocked_handler.return_value.current_music.download.side_effect = error
+        m2s = Music2Storage()
+        callback = MagicMock()
+        m2s.on_completion(callback)
+        job = Job('http://example.com/')
+        m2s._download(job)
+        callback.assert_called_once_with(job)
+        self.assertIs(job.exception(0).__cause__, error)
+        self.assertIn('download', job.timings)
+
+    @patch('music2storage.transcode_stream', return_value='title.mp3')
+    @patch('music2storage.ConnectionHandler')
+    def test_stream_sucess(self, mocked_handler, mocked_transcode_stream):
+        use_mocked_services(mocked_handler)
+        chunks = iter([b'bytes'])
+        mocked_handler.return_value.current_music.open_stream.return_value = ('title', chunks)
+        m2s = Music2Storage(streaming=True, max_conversions=1)
+        job = Job('http://example.com/')
+        with m2s.converter.slot():
+            result = m2s._stream(job)  # Paced by the download, so it doesn't wait for a conversion slot
+        mocked_transcode_stream.assert_called_with(chunks, 'title.mp3', threads=1, preset=None)
+        self.assertEqual(result, job)
+        self.assertEqual(job.stage, 'upload')
+        self.assertEqual(job.file_name, 'title.mp3')
+
+    @patch('music2storage.transcode_stream')
+    @patch('music2storage.ConnectionHandler')
+    def test_stream_bad_url(self, mocked_handler, mocked_transcode_stream):
+        use_mocked_services(mocked_handler)
+        mocked_handler.return_value.current_music.open_stream.return_value = None
+        m2s = Music2Storage(streaming=True)
+        job = Job('http://example.com/')
+        self.assertIsNone(m2s._stream(job))
+        self.assertFalse(mocked_transcode_stream.called)
+        self.assertEqual(job.stage, 'failed')
+
+    @patch('music2storage.pool.Worker')
+    @patch('music2storage.SignalHandler')
+    @patch('music2storage.signal.signal')
+    def test_start_workers_streaming(self, mocked_signal_signal, mocked_signal_handler, mocked_worker):
+        m2s = Music2Storage(streaming=True)
+        m2s.start_workers(1)
+        self.assertEqual(m2s.pools['download'].func, m2s._stream)
+        self.assertEqual(m2s.pools['download'].out_queue, m2s.queues['upload'])
+
+    def test_stage_plan_streaming_options(self):
+        m2s = Music2Storage(streaming=True, streaming_upload=True)
+        self.assertEqual(m2s._stage_plan()['download'], (m2s._stream_upload, 'delete'))
+        m2s = Music2Storage(streaming_upload=True)
+        self.assertEqual(m2s._stage_plan()['download'], (m2s._download, 'convert'))
+        self.assertEqual(m2s._stage_plan()['convert'], (m2s._convert_upload, 'delete'))
+
+    @patch('music2storage.TranscodedStream')
+    @patch('music2storage.ConnectionHandler')
+    def test_convert_upload_sucess(self, mocked_handler, mocked_stream):
+        use_mocked_services(mocked_handler)
+        mocked_handler.return_value.current_storage.upload_stream.return_value = 'file-id'
+        m2s = Music2Storage(streaming_upload=True)
+        job = Job('http://example.com/', stage='convert', file_name='filename.mp4')
+        result = m2s._convert_upload(job)
+        mocked_stream.assert_called_with('filename.mp4', threads=1, preset=None)
+        mocked_handler.return_value.current_storage.upload_stream.assert_called_with(mocked_stream.return_value, 'filename.mp3')
+        mocked_stream.return_value.close.assert_called()
+        self.assertEqual(result, job)
+        self.assertEqual(job.stage, 'delete')
+        self.assertEqual(job.file_name, 'filename.mp4')
+        self.assertEqual(job.location, 'file-id')
+
+    @patch('music2storage.TranscodedStream')
+    @patch('music2storage.ConnectionHandler')
+    def test_convert_upload_failure(self, mocked_handler, mocked_stream):
+        use_mocked_services(mocked_handler)
+        mocked_handler.return_value.current_storage.upload_stream.side_effect = OSError()
+        m2s = Music2Storage(streaming_upload=True)
+        job = Job('http://example.com/', stage='convert', file_name='filename.mp4')
+        self.assertIsNone(m2s._convert_upload(job))
+        self.assertEqual(job.stage, 'failed')
+        mocked_stream.return_value.close.assert_called()
 
     @patch('music2storage.convert_to_mp3', return_value='filename.mp3')
     def test_convert_sucess(self, mocked_convert_to_mp3):
         m2s = Music2Storage()
-        result = m2s._convert('filename.mp4')
-        mocked_convert_to_mp3.assert_called_with('filename.mp4', m2s.queues['delete'])
-        self.assertEqual(result, 'filename.mp3')
+        job = Job('http://example.com/', stage='convert', file_name='filename.mp4')
+        result = m2s._convert(job)
+        mocked_convert_to_mp3.assert_called_with('filename.mp4', m2s.queues['delete'], threads=m2s.converter.threads_per_job,
+                                                 codec=None, preset=None)
+        self.assertEqual(result, job)
+        self.assertEqual(job.file_name, 'filename.mp3')
+
+    @patch('music2storage.resilience.sleep')
+    def test_upload_failure_marks_job_failed(self, mocked_sleep):
+        m2s = Music2Storage()
+        m2s.connection_handler.current_storage = MagicMock()
+        m2s.connection_handler.current_storage.name = 'google drive'
+        m2s.connection_handler.current_storage.upload.side_effect = OSError('connection reset')
+        m2s.limit_service('google drive', retries=1, failure_threshold=10)
+        job = Job('http://example.com/', stage='upload', file_name='filename.mp3')
+        self.assertIsNone(m2s._upload(job))
+        self.assertEqual(job.stage, 'failed')
+        self.assertEqual(m2s.connection_handler.current_storage.upload.call_count, 2)
+        self.assertEqual(m2s.stats()['services']['google drive']['retries'], 1)
+
+    @patch('music2storage.ConnectionHandler')
+    def test_upload_sucess(self, mocked_handler):
+        use_mocked_services(mocked_handler)
+        m2s = Music2Storage()
+        job = Job('http://example.com/', stage='upload', file_name='filename.mp3')
+        result = m2s._upload(job)
+        mocked_handler.return_value.current_storage.upload.assert_called_with('filename.mp3')
+        self.assertEqual(result, job)
+        self.assertEqual(job.location, mocked_handler.return_value.current_storage.upload.return_value)
+        self.assertEqual(job.stage, 'delete')
+
+    @patch('music2storage.os.path.getsize', return_value=1000)
+    @patch('music2storage.ConnectionHandler')
+    def test_stats_with_metrics(self, mocked_handler, mocked_getsize):
+        use_mocked_services(mocked_handler)
+        mocked_handler.return_value.stats.return_value = {}
+        m2s = Music2Storage(metrics=True)
+        m2s.pool_sizes = {'upload': 2}
+        m2s.pools['upload'] = pool = m2s._make_pool('upload', m2s._upload, 'delete')
+        pool.func(Job('http://example.com/', stage='upload', file_name='filename.mp3'))
 
-    @patch('music2storage.upload_to_drive', return_value='filename.mp3')
-    def test_upload_sucess(self, mocked_upload_to_drive):
+        stats = m2s.stats()
+        self.assertEqual(stats['stages']['upload']['count'], 1)
+        self.assertEqual(stats['stages']['upload']['errors'], 0)
+        self.assertEqual(stats['bytes'], {'uploaded': 1000})
+        self.assertEqual(stats['queues']['upload']['depth'], 0)
+        self.assertEqual(stats['workers'], {'upload': 0})
+        self.assertIn('music2storage_stage_seconds_count{stage="upload"} 1', m2s.metrics_text())
+
+    @patch('music2storage.ConnectionHandler')
+    def test_stats_without_metrics(self, mocked_handler):
+        mocked_handler.return_value.stats.return_value = {}
         m2s = Music2Storage()
-        m2s.drive_service = MagicMock()
-        result = m2s._upload('filename.mp3')
-        mocked_upload_to_drive.assert_called_with(m2s.connection_handler.storage_service, 'filename.mp3')
-        self.assertEqual(result, 'filename.mp3')
+        stats = m2s.stats()
+        self.assertNotIn('stages', stats)
+        self.assertEqual(stats['queues']['download']['depth'], 0)
 
+    @patch('music2storage.ConnectionHandler')
     @patch('music2storage.delete_local_file', return_value='filename.mp3')
-    def test_delete_sucess(self, mocked_delete_local_file):
+    def test_delete_sucess(self, mocked_delete_local_file, mocked_handler):
         m2s = Music2Storage()
-        result = m2s._delete('filename.mp3')
+        job = Job('http://example.com/', stage='delete', file_name='filename.mp3')
+        result = m2s._delete(job)
         mocked_delete_local_file.assert_called_with('filename.mp3')
-        self.assertEqual(result, 'filename.mp3')
+        self.assertIsNone(result)
+        self.assertEqual(job.stage, 'done')
+        self.assertTrue(job.done())
+        self.assertEqual(m2s.completions.recent(), [job])
 
-    def test_notify_sucess(self):
+    @patch('music2storage.delete_local_file', return_value='filename.mp4')
+    def test_delete_intermediate_file(self, mocked_delete_local_file):
         m2s = Music2Storage()
-        m2s._notify()
-        # TODO
+        result = m2s._delete('filename.mp4')
+        mocked_delete_local_file.assert_called_with('filename.mp4')
+        self.assertIsNone(result)
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import re
+import shutil
+import tempfile
+from threading import Event, Lock
+from time import sleep
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from requests.exceptions import HTTPError
+
+from music2storage.aio import AsyncMusic2Storage, AsyncRangedDownloader, convert_to_mp3, run_ffmpeg
+from music2storage.job import Job, JobFailed
+from tests import use_mocked_services
+
+
+class FakeContent:
+    def __init__(self, data):
+        self.data = data
+
+    async def iter_chunked(self, size):
+        for start in range(0, len(self.data), size):
+            await asyncio.sleep(0)
+            yield self.data[start:start + size]
+
+
+class FakeResponse:
+    def __init__(self, status, data=b'', headers=None):
+        self.status = status
+        self.headers = headers or {}
+        self.content = FakeContent(data)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise HTTPError(response=Mock(status_code=self.status))
+
+
+class FakeSession:
+    """Serves the media at its URLs, with ranges unless ranged is False, and refuses the URLs in refused with a 403."""
+
+    def __init__(self, media, ranged=True, refused=()):
+        self.media = media
+        self.ranged = ranged
+        self.refused = set(refused)
+        self.requests = []
+
+    def get(self, url, headers=None):
+        self.requests.append((url, (headers or {}).get('Range')))
+        if url in self.refused:
+            return FakeResponse(403)
+        data = self.media[url]
+        match = re.match(r'bytes=(\d+)-(\d+)', (headers or {}).get('Range', ''))
+        if not self.ranged or match is None:
+            return FakeResponse(200, data, {'Content-Length': str(len(data))})
+        start, end = int(match.group(1)), int(match.group(2))
+        return FakeResponse(206, data[start:end + 1], {'Content-Range': f"bytes {start}-{end}/{len(data)}"})
+
+
+class TestAsyncRangedDownloader(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'track.webm')
+        self.data = bytes(range(256)) * 40
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.directory)
+
+    def test_download_in_ranges(self):
+        session = FakeSession({'http://media/': self.data})
+        downloader = AsyncRangedDownloader(session, segment_size=1000, chunk_size=300)
+        self.assertEqual(self.loop.run_until_complete(downloader.download('http://media/', self.file_name)), self.file_name)
+        with open(self.file_name, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['track.webm'])
+        self.assertEqual(len(session.requests), 1 + 11)
+
+    def test_download_resumed_from_progress(self):
+        session = FakeSession({'http://media/': self.data})
+        downloader = AsyncRangedDownloader(session, segment_size=1000)
+        with open(self.file_name + '.part', 'wb') as f:
+            f.write(self.data[:1000] + bytes(len(self.data) - 1000))
+        downloader._save_progress(self.file_name + '.progress', len(self.data), {0: 1000})
+        self.loop.run_until_complete(downloader.download('http://media/', self.file_name))
+        with open(self.file_name, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertNotIn(('http://media/', 'bytes=0-999'), session.requests)
+
+    def test_download_without_ranges(self):
+        session = FakeSession({'http://media/': self.data}, ranged=False)
+        downloader = AsyncRangedDownloader(session, segment_size=1000)
+        self.loop.run_until_complete(downloader.download('http://media/', self.file_name))
+        with open(self.file_name, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(session.requests[-1], ('http://media/', None))
+
+
+class TestAsyncConversion(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    @staticmethod
+    def process(returncode):
+        process = Mock()
+
+        async def wait():
+            return returncode
+        process.wait.side_effect = wait
+        return process
+
+    def test_run_ffmpeg_as_subprocess(self):
+        with patch('asyncio.create_subprocess_exec') as mocked_exec:
+            async def create(*cmd, **kwargs):
+                return self.process(0)
+            mocked_exec.side_effect = create
+            self.loop.run_until_complete(run_ffmpeg(['ffmpeg', '-i', 'a.webm', 'a.mp3']))
+        self.assertEqual(mocked_exec.call_args[0], ('ffmpeg', '-i', 'a.webm', 'a.mp3'))
+
+    def test_run_ffmpeg_failure(self):
+        from ffmpy import FFRuntimeError
+        with patch('asyncio.create_subprocess_exec') as mocked_exec:
+            async def create(*cmd, **kwargs):
+                return self.process(1)
+            mocked_exec.side_effect = create
+            with self.assertRaises(FFRuntimeError):
+                self.loop.run_until_complete(run_ffmpeg(['ffmpeg']))
+
+    @patch('music2storage.aio._record_conversion')
+    @patch('music2storage.aio.conversion_plan', return_value=('transcode', 10, 'a.mp3', ['ffmpeg', '-i', 'a.webm', 'a.mp3']))
+    @patch('music2storage.aio.run_ffmpeg')
+    def test_convert_retried(self, mocked_run, mocked_plan, mocked_record):
+        from ffmpy import FFRuntimeError
+        attempts = []
+
+        async def run(cmd):
+            attempts.append(cmd)
+            if len(attempts) == 1:
+                raise FFRuntimeError('ffmpeg', 1, None, None)
+        mocked_run.side_effect = run
+        self.assertEqual(self.loop.run_until_complete(convert_to_mp3('a.webm', backoff=0)), 'a.mp3')
+        self.assertEqual(len(attempts), 2)
+        mocked_record.assert_called_once()
+
+    @patch('music2storage.aio.conversion_plan', return_value=('skip', None, 'a.mp3', None))
+    @patch('music2storage.aio.run_ffmpeg')
+    def test_mp3_not_converted(self, mocked_run, mocked_plan):
+        self.assertEqual(self.loop.run_until_complete(convert_to_mp3('a.mp3')), 'a.mp3')
+        mocked_run.assert_not_called()
+
+
+async def converted(file_name, *args, **kwargs):
+    return 'filename.mp3'
+
+
+@patch('music2storage.delete_local_file')
+@patch('music2storage.aio.convert_to_mp3', side_effect=converted)
+@patch('music2storage.ConnectionHandler')
+class TestAsyncMusic2Storage(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.engines = []
+
+    def tearDown(self):
+        for m2s in self.engines:
+            self.loop.run_until_complete(m2s.close())
+        self.loop.close()
+
+    def make(self, mocked_handler, **options):
+        use_mocked_services(mocked_handler)
+        handler = mocked_handler.return_value
+
+        async def call_async(func, *args, retry=True):
+            return await func(*args)
+        handler.guard.return_value.call_async.side_effect = call_async
+        handler.current_music.track_id.side_effect = lambda url: url
+        handler.current_music.locate.side_effect = NotImplementedError
+        handler.current_music.download.return_value = 'filename.mp4'
+        handler.current_storage.upload.return_value = 'file-id'
+        m2s = AsyncMusic2Storage(loop=self.loop, **options)
+        self.engines.append(m2s)
+        return m2s
+
+    def test_job_awaited(self, mocked_handler, mocked_convert, mocked_delete):
+        m2s = self.make(mocked_handler)
+        job = self.loop.run_until_complete(m2s.add_to_queue('http://example.com/', tenant='user'))
+        self.assertEqual(self.loop.run_until_complete(job), 'file-id')
+        self.assertEqual(job.stage, 'done')
+        self.assertEqual(set(job.timings), {'download', 'convert', 'upload', 'delete'})
+        m2s.run_until_complete()
+        mocked_delete.assert_any_call('filename.mp3')
+        mocked_delete.assert_any_call('filename.mp4')
+        self.assertEqual(m2s.jobs, set())
+
+    def test_located_media_downloaded_by_coroutine(self, mocked_handler, mocked_convert, mocked_delete):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        session = FakeSession({'http://media/new': b'audio'}, refused=['http://media/old'])
+        m2s = self.make(mocked_handler, session=session, workspace=directory)
+        music = mocked_handler.return_value.current_music
+        music.locate.side_effect = lambda url, fresh=False: ('http://media/new' if fresh else 'http://media/old', 'track.webm', 'opus')
+        job = self.loop.run_until_complete(m2s.add_to_queue('http://example.com/'))
+        self.assertEqual(self.loop.run_until_complete(job), 'file-id')
+        music.download.assert_not_called()
+        self.assertEqual(job.codec, 'opus')
+        self.assertEqual(os.path.basename(mocked_convert.call_args[0][0]), 'track.webm')
+        self.assertEqual(session.requests[-1][0], 'http://media/new')
+
+    def test_failure_does_not_stop_other_jobs(self, mocked_handler, mocked_convert, mocked_delete):
+        m2s = self.make(mocked_handler)
+
+        def download(url):
+            if url.endswith('bad'):
+                raise ValueError()
+            return 'filename.mp4'
+        mocked_handler.return_value.current_music.download.side_effect = download
+        bad = self.loop.run_until_complete(m2s.add_to_queue('http://example.com/bad'))
+        good = self.loop.run_until_complete(m2s.add_to_queue('http://example.com/good'))
+        m2s.run_until_complete()
+        self.assertIsInstance(bad.exception(0), JobFailed)
+        self.assertIsInstance(bad.exception(0).__cause__, ValueError)
+        self.assertEqual(good.result(0), 'file-id')
+
+    @patch('music2storage.TrackIndex')
+    def test_uses_track_index(self, mocked_index, mocked_handler, mocked_convert, mocked_delete):
+        mocked_index.return_value.get.return_value = 'stored-id'
+        m2s = self.make(mocked_handler, track_index='index.db')
+        job = self.loop.run_until_complete(m2s.add_to_queue('http://example.com/'))
+        self.assertEqual(self.loop.run_until_complete(job), 'stored-id')
+        mocked_handler.return_value.current_music.download.assert_not_called()
+
+    def test_concurrency_limits_stages(self, mocked_handler, mocked_convert, mocked_delete):
+        m2s = self.make(mocked_handler, concurrency={'download': 3, 'pending': 5})
+        lock = Lock()
+        running = {'now': 0, 'peak': 0}
+
+        def download(url):
+            with lock:
+                running['now'] += 1
+                running['peak'] = max(running['peak'], running['now'])
+            sleep(0.01)
+            with lock:
+                running['now'] -= 1
+            return 'filename.mp4'
+        mocked_handler.return_value.current_music.download.side_effect = download
+
+        async def add():
+            for i in range(10):
+                await m2s.add_to_queue(f"http://example.com/{i}")
+        self.loop.run_until_complete(add())
+        m2s.run_until_complete()
+        self.assertEqual(running['peak'], 3)
+        self.assertEqual(m2s.pipeline.queues['download'].maxsize, 5)
+        self.assertEqual(m2s.completions.count, 10)
+
+    def test_add_to_queue_waits_without_blocking_loop(self, mocked_handler, mocked_convert, mocked_delete):
+        m2s = self.make(mocked_handler, concurrency={'download': 1, 'pending': 2})
+        release = Event()
+        mocked_handler.return_value.current_music.download.side_effect = lambda url: release.wait(5) and 'filename.mp4'
+        ticks = []
+
+        async def scenario():
+            adding = asyncio.ensure_future(asyncio.gather(*(m2s.add_to_queue(f"http://example.com/{i}") for i in range(6))))
+            for _ in range(20):
+                ticks.append(m2s.pipeline.queues['download'].qsize())
+                await asyncio.sleep(0.01)
+            self.assertFalse(adding.done())
+            release.set()
+            return await adding
+        jobs = self.loop.run_until_complete(scenario())
+        m2s.run_until_complete()
+        self.assertEqual(len(ticks), 20)
+        self.assertEqual(max(ticks), 2)
+        self.assertTrue(all(job.result(0) == 'file-id' for job in jobs))
+
+    @patch('music2storage.JobStore')
+    def test_pending_jobs_resumed(self, mocked_store, mocked_handler, mocked_convert, mocked_delete):
+        pending = [Job('http://example.com/1', stage='convert', file_name='1.mp4'), Job('http://example.com/2', stage='upload', file_name='2.mp3')]
+        mocked_store.return_value.pending.return_value = pending
+        m2s = self.make(mocked_handler, job_store='jobs.db')
+        job = self.loop.run_until_complete(m2s.add_to_queue('http://example.com/3'))
+        m2s.run_until_complete()
+        self.assertEqual([job.result(0) for job in pending + [job]], ['file-id'] * 3)
+        self.assertIn('1.mp4', [call[0][0] for call in mocked_convert.call_args_list])
+        self.assertEqual(mocked_convert.call_count, 2)
+
+    def test_playlist_tracks_joined(self, mocked_handler, mocked_convert, mocked_delete):
+        m2s = self.make(mocked_handler)
+        music = mocked_handler.return_value.current_music
+        music.is_playlist.side_effect = lambda url: url.endswith('playlist')
+        music.expand.return_value = (f"http://example.com/{i}" for i in range(5))
+        jobs = self.loop.run_until_complete(m2s.add_to_queue('http://example.com/playlist'))
+        m2s.run_until_complete()
+        self.assertEqual([job.url for job in jobs], [f"http://example.com/{i}" for i in range(5)])
+        self.assertTrue(all(job.stage == 'done' for job in jobs))
+
+    def test_add_to_queue_without_music_service(self, mocked_handler, mocked_convert, mocked_delete):
+        m2s = self.make(mocked_handler)
+        mocked_handler.return_value.music_for.return_value = None
+        self.assertIsNone(self.loop.run_until_complete(m2s.add_to_queue('http://example.com/')))
+        self.assertEqual(m2s.jobs, set())
+
+    def test_streaming_rejected(self, mocked_handler, mocked_convert, mocked_delete):
+        with self.assertRaises(ValueError):
+            AsyncMusic2Storage(loop=self.loop, streaming=True)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from music2storage.cache import TTLCache
+
+
+class TestTTLCache(TestCase):
+    @patch('music2storage.cache.monotonic')
+    def test_entries_expire(self, mocked_monotonic):
+        mocked_monotonic.return_value = 100
+        cache = TTLCache(10)
+        cache.set('key', 'value')
+        cache.set('short', 'value', ttl=1)
+        mocked_monotonic.return_value = 105
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertIsNone(cache.get('short'))
+        mocked_monotonic.return_value = 110
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_least_recently_used_dropped_when_full(self):
+        cache = TTLCache(60, maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
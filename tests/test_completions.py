@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from music2storage.completions import Completions
+from music2storage.job import Job
+
+
+class TestCompletions(TestCase):
+    def test_keeps_latest_jobs(self):
+        completions = Completions(size=2)
+        jobs = [Job(f'http://example.com/{i}') for i in range(3)]
+        for job in jobs:
+            completions.put(job)
+        self.assertEqual(completions.recent(), jobs[1:])
+        self.assertEqual(completions.stats(), {'finished': 3, 'kept': 2})
+
+    def test_follow_from_now(self):
+        completions = Completions()
+        completions.put(Job('http://example.com/old'))
+        jobs = [Job(f'http://example.com/{i}') for i in range(3)]
+        followed = completions.follow(timeout=0.05)
+        thread = Thread(target=lambda: [completions.put(job) for job in jobs])
+        thread.start()
+        self.assertEqual(list(followed), jobs)
+        thread.join()
+
+    def test_follow_replay(self):
+        completions = Completions()
+        job = Job('http://example.com/')
+        completions.put(job)
+        self.assertEqual(list(completions.follow(timeout=0, replay=True)), [job])
+        self.assertEqual(list(completions.follow(timeout=0)), [])
+
+    def test_slow_follower_skips_dropped_jobs(self):
+        completions = Completions(size=2)
+        followed = completions.follow(timeout=0)
+        first = Job('http://example.com/first')
+        completions.put(first)
+        self.assertEqual(next(followed), first)
+        jobs = [Job(f'http://example.com/{i}') for i in range(3)]
+        for job in jobs:
+            completions.put(job)
+        self.assertEqual(list(followed), jobs[1:])
+
+    def test_callbacks(self):
+        completions = Completions()
+        callback = MagicMock()
+        completions.subscribe(MagicMock(side_effect=ValueError()))
+        completions.subscribe(callback)
+        job = Job('http://example.com/')
+        completions.put(job)
+        callback.assert_called_once_with(job)
+        completions.unsubscribe(callback)
+        completions.put(Job('http://example.com/'))
+        callback.assert_called_once()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import re
+from tempfile import TemporaryDirectory
+from threading import Lock, Thread
+from unittest import TestCase
+from unittest.mock import patch
+
+from music2storage.downloader import RangedDownloader
+from music2storage.resilience import ServiceGuard
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves the data of the server, in ranges if it serves them, dropping the connection halfway through the first failing ranges."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        data = self.server.data
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        with self.server.lock:
+            self.server.ranges.append(self.headers.get('Range'))
+        if match and self.server.serves_ranges:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{len(data)}")
+        else:
+            start, body = 0, data
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        with self.server.lock:
+            fail = start in self.server.fail_at
+            self.server.fail_at.discard(start)
+        if fail:
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestRangedDownloader(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.daemon_threads = True
+        self.server.data = os.urandom(10 * 1000 + 7)
+        self.server.serves_ranges = True
+        self.server.ranges = []
+        self.server.fail_at = set()
+        self.server.lock = Lock()
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/track"
+        self.directory = TemporaryDirectory()
+        self.file_name = os.path.join(self.directory.name, 'track.mp3')
+        self.downloader = RangedDownloader(connections=3, segment_size=1000, chunk_size=100, progress_bar=False)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def read(self):
+        with open(self.file_name, 'rb') as f:
+            return f.read()
+
+    def test_download_in_ranges(self):
+        self.assertEqual(self.downloader.download(self.url, self.file_name), self.file_name)
+        self.assertEqual(self.read(), self.server.data)
+        self.assertEqual(len(self.server.ranges), 1 + 11)
+        self.assertEqual(os.listdir(self.directory.name), ['track.mp3'])
+
+    def test_download_without_ranges(self):
+        self.server.serves_ranges = False
+        self.downloader.download(self.url, self.file_name)
+        self.assertEqual(self.read(), self.server.data)
+        self.assertEqual(self.server.ranges, ['bytes=0-0', None])
+
+    @patch('music2storage.resilience.sleep')
+    def test_dropped_range_resumes(self, mocked_sleep):
+        guard = ServiceGuard('test', retries=1)
+        self.downloader.guarded = guard.call
+        self.server.fail_at = {3000}
+        self.downloader.download(self.url, self.file_name)
+        self.assertEqual(self.read(), self.server.data)
+        self.assertIn('bytes=3500-3999', self.server.ranges)
+        self.assertEqual(guard.stats()['calls'], len(self.server.ranges))
+        self.assertEqual(guard.stats()['retries'], 1)
+
+    def test_interrupted_download_resumes_from_progress_map(self):
+        with open(self.file_name + '.part', 'wb') as f:
+            f.write(self.server.data[:2500] + bytes(len(self.server.data) - 2500))
+        segments = {'0': 1000, '1000': 1000, '2000': 500}
+        with open(self.file_name + '.progress', 'w') as f:
+            json.dump({'size': len(self.server.data), 'segment_size': 1000, 'segments': segments}, f)
+
+        self.downloader.download(self.url, self.file_name)
+        self.assertEqual(self.read(), self.server.data)
+        self.assertNotIn('bytes=0-999', self.server.ranges)
+        self.assertNotIn('bytes=1000-1999', self.server.ranges)
+        self.assertIn('bytes=2500-2999', self.server.ranges)
+        self.assertFalse(os.path.exists(self.file_name + '.progress'))
+
+    def test_failed_download_keeps_progress_map(self):
+        self.server.fail_at = {5000}
+        with self.assertRaises(Exception):
+            self.downloader.download(self.url, self.file_name)
+        with open(self.file_name + '.progress') as f:
+            progress = json.load(f)
+        self.assertEqual(progress['segments']['5000'], 500)
+        self.assertFalse(os.path.exists(self.file_name))
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import io
+import os
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import MagicMock, patch, PropertyMock
+
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpMockSequence
+from httplib2 import Response
+
+from music2storage.googledrive import DriveClientPool, DriveFolderIndex, GoogleDrive, StreamMediaUpload
+from music2storage.resilience import ServiceGuard
+
+
+class TestStreamMediaUpload(TestCase):
+    def test_getbytes_reads_chunks_and_checksum(self):
+        media = StreamMediaUpload(io.BytesIO(b'abcdefghij'), chunksize=4)
+        self.assertIsNone(media.size())
+        self.assertTrue(media.resumable())
+        self.assertEqual(media.getbytes(0, 4), b'abcd')
+        self.assertEqual(media.getbytes(0, 4), b'abcd')
+        self.assertEqual(media.getbytes(4, 4), b'efgh')
+        self.assertEqual(media.getbytes(8, 4), b'ij')
+        self.assertEqual(media.total, 10)
+        self.assertEqual(media.md5.hexdigest(), hashlib.md5(b'abcdefghij').hexdigest())
+        with self.assertRaises(ValueError):
+            media.getbytes(0, 4)
+
+
+class TestGoogleDrive(TestCase):
+    def make_drive(self, response):
+        drive = GoogleDrive()
+        connection = MagicMock()
+        drive.pool = DriveClientPool(lambda: connection, size=1)
+        files = connection.files.return_value
+        files.list.return_value.execute.return_value = {'files': [{'id': 'folder'}]}
+        files.create.return_value.next_chunk.return_value = (None, response)
+        files.create.return_value.resumable_progress = 0
+        return drive, files
+
+    @patch('music2storage.googledrive.StreamMediaUpload')
+    def test_upload_stream_checksum_matches(self, mocked_media):
+        mocked_media.return_value.total = 3
+        mocked_media.return_value.md5.hexdigest.return_value = 'md5'
+        drive, files = self.make_drive({'id': 'file-id', 'size': '3', 'md5Checksum': 'md5'})
+        self.assertEqual(drive.upload_stream(io.BytesIO(b'abc'), 'filename.mp3'), 'file-id')
+        files.create.assert_called_with(body={'name': 'filename.mp3', 'parents': ['folder']}, media_body=mocked_media.return_value,
+                                        fields='id,size,md5Checksum')
+        self.assertFalse(files.delete.called)
+
+    @patch('music2storage.googledrive.StreamMediaUpload')
+    def test_upload_stream_checksum_mismatch(self, mocked_media):
+        mocked_media.return_value.total = 3
+        mocked_media.return_value.md5.hexdigest.return_value = 'md5'
+        drive, files = self.make_drive({'id': 'file-id', 'size': '3', 'md5Checksum': 'other'})
+        self.assertIsNone(drive.upload_stream(io.BytesIO(b'abc'), 'filename.mp3'))
+        files.delete.assert_called_with(fileId='file-id')
+
+
+    @patch('music2storage.googledrive.MediaFileUpload')
+    def test_upload_resolves_folder_once(self, mocked_media):
+        mocked_media.return_value.size.return_value = 3
+        drive, files = self.make_drive({'id': 'file-id'})
+        self.assertEqual(drive.upload('a.mp3'), 'file-id')
+        self.assertEqual(drive.upload('b.mp3'), 'file-id')
+        self.assertEqual(files.list.call_count, 1)
+        files.create.assert_called_with(body={'name': 'b.mp3', 'parents': ['folder']}, media_body=mocked_media.return_value, fields='id')
+
+    @patch('music2storage.googledrive.MediaFileUpload')
+    def test_upload_resolves_missing_folder_again(self, mocked_media):
+        mocked_media.return_value.size.return_value = 3
+        drive, files = self.make_drive({})
+        drive.folder_id = 'gone'
+        files.create.return_value.next_chunk.side_effect = [HttpError(Response({'status': 404}), b'not found'), (None, {'id': 'file-id'})]
+        self.assertEqual(drive.upload('a.mp3'), 'file-id')
+        self.assertEqual(drive.folder_id, 'folder')
+        files.create.assert_called_with(body={'name': 'a.mp3', 'parents': ['folder']}, media_body=mocked_media.return_value, fields='id')
+
+    def make_indexed_drive(self, existing):
+        drive, files = self.make_drive({})
+        drive.index_folder = True
+        drive.existing = existing
+        files.list.return_value.execute.side_effect = [{'files': [{'id': 'folder'}]},
+                                                       {'files': [{'id': 'old-a', 'name': 'a.mp3'}, {'id': 'old-a2', 'name': 'a (2).mp3'}]}]
+        files.list_next.return_value = None
+        files.create.return_value.next_chunk.return_value = (None, {'id': 'file-id'})
+        return drive, files
+
+    @patch('music2storage.googledrive.MediaFileUpload')
+    def test_upload_skips_existing_name(self, mocked_media):
+        mocked_media.return_value.size.return_value = 3
+        drive, files = self.make_indexed_drive('skip')
+        self.assertEqual(drive.upload('a.mp3'), 'old-a')
+        self.assertFalse(files.create.called)
+        self.assertEqual(drive.upload('b.mp3'), 'file-id')
+        self.assertEqual(drive.upload('b.mp3'), 'file-id')
+        self.assertEqual(files.create.call_count, 1)
+
+    @patch('music2storage.googledrive.MediaFileUpload')
+    def test_upload_versions_existing_name(self, mocked_media):
+        mocked_media.return_value.size.return_value = 3
+        drive, files = self.make_indexed_drive('version')
+        drive.upload('a.mp3')
+        files.create.assert_called_with(body={'name': 'a (3).mp3', 'parents': ['folder']}, media_body=mocked_media.return_value,
+                                        fields='id')
+
+
+class FailingHttpMockSequence(HttpMockSequence):
+    """HttpMockSequence raising the exceptions found in its sequence, like a dropped connection would."""
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=1, connection_type=None):
+        if isinstance(self._iterable[0], Exception):
+            raise self._iterable.pop(0)
+        return super().request(uri, method, body, headers, redirections, connection_type)
+
+
+class TestGoogleDriveResumableUpload(TestCase):
+    def make_drive(self, directory, responses, retries=0):
+        drive = GoogleDrive(chunk_size=256 * 1024, sessions=os.path.join(directory, 'sessions.db'))
+        drive.guard = ServiceGuard(drive.name, retries=retries)
+        drive.folder_id = 'folder'
+        http = FailingHttpMockSequence(responses)
+        drive.pool = DriveClientPool(lambda: build_from_document(get_static_doc('drive', 'v3'), http=http), size=1)
+        file_name = os.path.join(directory, 'filename.mp3')
+        with open(file_name, 'wb') as f:
+            f.write(os.urandom(300 * 1024))
+        return drive, file_name
+
+    def test_interrupted_upload_keeps_session(self):
+        with TemporaryDirectory() as directory:
+            drive, file_name = self.make_drive(directory, [({'status': '200', 'location': 'https://upload/session'}, b''), OSError()])
+            with self.assertRaises(OSError):
+                drive.upload(file_name)
+            self.assertEqual(drive.sessions.get(file_name), 'https://upload/session')
+
+    def test_upload_resumes_stored_session(self):
+        with TemporaryDirectory() as directory:
+            drive, file_name = self.make_drive(directory, [({'status': '308', 'range': 'bytes=0-262143'}, b''),
+                                                           ({'status': '200'}, b'{"id": "file-id"}')])
+            drive.sessions.add(file_name, 'https://upload/session')
+            self.assertEqual(drive.upload(file_name), 'file-id')
+            self.assertIsNone(drive.sessions.get(file_name))
+
+    @patch('music2storage.resilience.sleep')
+    def test_upload_resumes_after_connection_error(self, mocked_sleep):
+        with TemporaryDirectory() as directory:
+            drive, file_name = self.make_drive(directory, [
+                ({'status': '200', 'location': 'https://upload/session'}, b''),
+                ({'status': '308', 'range': 'bytes=0-262143'}, b''),
+                OSError(),
+                ({'status': '308', 'range': 'bytes=0-262143'}, b''),
+                ({'status': '200'}, b'{"id": "file-id"}'),
+            ], retries=1)
+            self.assertEqual(drive.upload(file_name), 'file-id')
+            mocked_sleep.assert_called_once()
+            self.assertEqual(drive.guard.stats()['calls'], 3)
+            self.assertIsNone(drive.sessions.get(file_name))
+
+    def test_expired_session_starts_new_one(self):
+        with TemporaryDirectory() as directory:
+            drive, file_name = self.make_drive(directory, [
+                ({'status': '404'}, b'session expired'),
+                ({'status': '200', 'location': 'https://upload/new-session'}, b''),
+                ({'status': '308', 'range': 'bytes=0-262143'}, b''),
+                ({'status': '200'}, b'{"id": "file-id"}'),
+            ])
+            drive.sessions.add(file_name, 'https://upload/session')
+            self.assertEqual(drive.upload(file_name), 'file-id')
+
+    def test_new_session_expiring_is_not_restarted(self):
+        with TemporaryDirectory() as directory:
+            drive, file_name = self.make_drive(directory, [
+                ({'status': '404'}, b'session expired'),
+                ({'status': '200', 'location': 'https://upload/new-session'}, b''),
+                ({'status': '404'}, b'session expired'),
+                ({'status': '200', 'location': 'https://upload/other-session'}, b''),
+            ])
+            drive.sessions.add(file_name, 'https://upload/session')
+            with self.assertRaises(HttpError), drive.pool.client() as connection:
+                drive._upload_resumable(connection, file_name, 'filename.mp3', 'folder')
+            self.assertEqual(drive.sessions.get(file_name), 'https://upload/new-session')
+
+
+class TestDriveFolderIndex(TestCase):
+    def test_refresh_pages_listing_then_pulls_changes(self):
+        connection = MagicMock()
+        connection.changes.return_value.getStartPageToken.return_value.execute.return_value = {'startPageToken': '1'}
+        first_page, second_page = MagicMock(), MagicMock()
+        first_page.execute.return_value = {'files': [{'id': 'a', 'name': 'a.mp3'}], 'nextPageToken': 'p2'}
+        second_page.execute.return_value = {'files': [{'id': 'b', 'name': 'b.mp3'}]}
+        connection.files.return_value.list.return_value = first_page
+        connection.files.return_value.list_next.side_effect = [second_page, None]
+        index = DriveFolderIndex('folder', refresh_interval=0)
+        index.refresh(connection)
+        self.assertEqual(index.get('a.mp3'), 'a')
+        self.assertEqual(index.get('b.mp3'), 'b')
+
+        connection.changes.return_value.list.return_value.execute.side_effect = [
+            {'changes': [{'fileId': 'a', 'removed': True}], 'nextPageToken': '2'},
+            {'changes': [{'fileId': 'b', 'file': {'name': 'c.mp3', 'parents': ['folder']}},
+                         {'fileId': 'd', 'file': {'name': 'd.mp3', 'parents': ['elsewhere']}}], 'newStartPageToken': '3'},
+        ]
+        index.refresh(connection)
+        self.assertIsNone(index.get('a.mp3'))
+        self.assertIsNone(index.get('b.mp3'))
+        self.assertEqual(index.get('c.mp3'), 'b')
+        self.assertIsNone(index.get('d.mp3'))
+        self.assertEqual(index.page_token, '3')
+
+    def test_refresh_waits_for_interval(self):
+        connection = MagicMock()
+        connection.files.return_value.list_next.return_value = None
+        index = DriveFolderIndex('folder', refresh_interval=60)
+        index.refresh(connection)
+        index.refresh(connection)
+        self.assertFalse(connection.changes.return_value.list.called)
+
+
+class TestDriveClientPool(TestCase):
+    def test_clients_are_reused_up_to_size(self):
+        factory = MagicMock(side_effect=lambda: object())
+        pool = DriveClientPool(factory, size=2)
+        with pool.client() as first:
+            with pool.client() as second:
+                self.assertIsNot(first, second)
+        with pool.client() as third:
+            self.assertIn(third, (first, second))
+        self.assertEqual(factory.call_count, 2)
+
+    def test_client_waits_when_all_are_checked_out(self):
+        pool = DriveClientPool(object, size=1)
+        checked_out = []
+        with pool.client() as first:
+            thread = Thread(target=lambda: checked_out.append(pool.client().__enter__()))
+            thread.start()
+            thread.join(0.1)
+            self.assertTrue(thread.is_alive())
+        thread.join(1)
+        self.assertEqual(checked_out, [first])
+
+    @patch('music2storage.googledrive.Http')
+    def test_expired_credentials_refreshed_once(self, mocked_http):
+        credentials = MagicMock()
+        type(credentials).access_token_expired = PropertyMock(side_effect=[True, True, False, False])
+        pool = DriveClientPool(object, size=2, credentials=credentials)
+        with pool.client():
+            pass
+        with pool.client():
+            pass
+        credentials.refresh.assert_called_once_with(mocked_http.return_value)
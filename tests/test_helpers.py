@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+from queue import Queue
+from unittest import TestCase
+from unittest.mock import patch, call
+
+from ffmpy import FFRuntimeError
+
+from music2storage.helpers import audio_info, conversion_path, convert_to_mp3, delete_local_file, ffmpeg_command, transcode_stream, \
+    TranscodedStream
+
+
+class TestHelpers(TestCase):
+    def test_ffmpeg_command_threads(self):
+        self.assertEqual(ffmpeg_command('a.mp4', 'a.mp3'), ['ffmpeg', '-y', '-i', 'a.mp4', 'a.mp3'])
+        self.assertEqual(ffmpeg_command('a.mp4', 'a.mp3', threads=2), ['ffmpeg', '-y', '-i', 'a.mp4', '-threads', '2', 'a.mp3'])
+
+    @patch('music2storage.helpers.run_ffmpeg', return_value=1.5)
+    def test_convert_to_mp3_sucess(self, mocked_run_ffmpeg):
+        delete_queue = Queue()
+        file_name = convert_to_mp3('filename.mp4', delete_queue, threads=2)
+        mocked_run_ffmpeg.assert_called_with(['ffmpeg', '-y', '-i', 'filename.mp4', '-threads', '2', '-vn', 'filename.mp3'])
+        self.assertEqual(delete_queue.get_nowait(), 'filename.mp4')
+        self.assertEqual(file_name, 'filename.mp3')
+
+    @patch('music2storage.helpers.run_ffmpeg', return_value=0.1)
+    def test_convert_to_mp3_copies_mp3_audio(self, mocked_run_ffmpeg):
+        delete_queue = Queue()
+        self.assertEqual(convert_to_mp3('filename.m4a', delete_queue, codec='mp3'), 'filename.mp3')
+        mocked_run_ffmpeg.assert_called_with(['ffmpeg', '-y', '-i', 'filename.m4a', '-vn', '-codec:a', 'copy', 'filename.mp3'])
+
+    @patch('music2storage.helpers.run_ffmpeg', return_value=1.5)
+    def test_convert_to_mp3_preset(self, mocked_run_ffmpeg):
+        convert_to_mp3('filename.webm', Queue(), codec='opus', preset='v0')
+        mocked_run_ffmpeg.assert_called_with(['ffmpeg', '-y', '-i', 'filename.webm', '-vn', '-codec:a', 'libmp3lame', '-q:a', '0',
+                                              'filename.mp3'])
+
+    @patch('music2storage.helpers.probe')
+    def test_conversion_path(self, mocked_probe):
+        mocked_probe.return_value = {'streams': [{'codec_type': 'video', 'codec_name': 'h264'},
+                                                 {'codec_type': 'audio', 'codec_name': 'mp3', 'duration': '200.5'}]}
+        self.assertEqual(conversion_path('filename.mp4'), ('copy', 200.5))
+        mocked_probe.return_value = {'streams': [{'codec_type': 'audio', 'codec_name': 'aac'}], 'format': {'duration': '10'}}
+        self.assertEqual(conversion_path('filename.mp4'), ('transcode', 10.0))
+        self.assertEqual(conversion_path('filename.mp3'), ('skip', None))
+        self.assertEqual(conversion_path('filename.webm', codec='opus'), ('transcode', None))
+        self.assertEqual(mocked_probe.call_count, 2)
+
+    @patch('music2storage.helpers.probe', return_value=None)
+    def test_audio_info_unprobed(self, mocked_probe):
+        self.assertEqual(audio_info('filename.mp4'), (None, None))
+
+    @patch('music2storage.helpers.run_ffmpeg')
+    def test_convert_to_mp3_already_mp3(self, mocked_run_ffmpeg):
+        delete_queue = Queue()
+        self.assertEqual(convert_to_mp3('filename.mp3', delete_queue), 'filename.mp3')
+        self.assertFalse(mocked_run_ffmpeg.called)
+        self.assertTrue(delete_queue.empty())
+
+    @patch('music2storage.helpers.sleep')
+    @patch('music2storage.helpers.os.path.exists', return_value=True)
+    @patch('music2storage.helpers.os.remove')
+    @patch('music2storage.helpers.run_ffmpeg')
+    def test_convert_to_mp3_retries_with_backoff(self, mocked_run_ffmpeg, mocked_remove, mocked_exists, mocked_sleep):
+        mocked_run_ffmpeg.side_effect = [FFRuntimeError('ffmpeg', 1, None, None), 1.5]
+        delete_queue = Queue()
+        self.assertEqual(convert_to_mp3('filename.mp4', delete_queue, backoff=2), 'filename.mp3')
+        mocked_remove.assert_called_with('filename.mp3')
+        mocked_sleep.assert_called_once_with(2)
+        self.assertEqual(delete_queue.get_nowait(), 'filename.mp4')
+
+    @patch('music2storage.helpers.sleep')
+    @patch('music2storage.helpers.os.path.exists', return_value=False)
+    @patch('music2storage.helpers.run_ffmpeg')
+    def test_convert_to_mp3_fails_after_retries(self, mocked_run_ffmpeg, mocked_exists, mocked_sleep):
+        mocked_run_ffmpeg.side_effect = FFRuntimeError('ffmpeg', 1, None, None)
+        delete_queue = Queue()
+        self.assertIsNone(convert_to_mp3('filename.mp4', delete_queue, retries=2, backoff=1))
+        self.assertEqual(mocked_sleep.call_args_list, [call(1), call(2)])
+        self.assertTrue(delete_queue.empty())
+
+    @patch('music2storage.helpers.subprocess.Popen')
+    def test_transcode_stream_sucess(self, mocked_popen):
+        mocked_popen.return_value.wait.return_value = 0
+        file_name = transcode_stream(iter([b'ab', b'cd']), 'filename.mp3', threads=2)
+        self.assertEqual(mocked_popen.call_args[0][0], ['ffmpeg', '-y', '-i', 'pipe:0', '-threads', '2', '-vn', 'filename.mp3'])
+        mocked_popen.return_value.stdin.write.assert_has_calls([call(b'ab'), call(b'cd')])
+        mocked_popen.return_value.stdin.close.assert_called()
+        self.assertEqual(file_name, 'filename.mp3')
+
+    @patch('music2storage.helpers.os.path.exists', return_value=True)
+    @patch('music2storage.helpers.os.remove')
+    @patch('music2storage.helpers.subprocess.Popen')
+    def test_transcode_stream_download_error(self, mocked_popen, mocked_remove, mocked_exists):
+        def chunks():
+            yield b'ab'
+            raise ConnectionError()
+        mocked_popen.return_value.wait.return_value = -9
+        self.assertIsNone(transcode_stream(chunks(), 'filename.mp3'))
+        mocked_popen.return_value.kill.assert_called()
+        mocked_remove.assert_called_with('filename.mp3')
+
+    @patch('music2storage.helpers.os.path.exists', return_value=False)
+    @patch('music2storage.helpers.subprocess.Popen')
+    def test_transcode_stream_ffmpeg_error(self, mocked_popen, mocked_exists):
+        mocked_popen.return_value.stdin.write.side_effect = BrokenPipeError()
+        mocked_popen.return_value.wait.return_value = 1
+        self.assertIsNone(transcode_stream(iter([b'ab']), 'filename.mp3'))
+
+    def test_ffmpeg_command_output_format(self):
+        self.assertEqual(ffmpeg_command('pipe:0', 'pipe:1', output_format='mp3'), ['ffmpeg', '-y', '-i', 'pipe:0', '-f', 'mp3', 'pipe:1'])
+
+    @patch('music2storage.helpers.ffmpeg_command', return_value=['cat'])
+    def test_transcoded_stream_from_chunks(self, mocked_ffmpeg_command):
+        stream = TranscodedStream(iter([b'ab', b'cd']))
+        data = b''.join(iter(lambda: stream.read(1), b''))
+        stream.close()
+        mocked_ffmpeg_command.assert_called_with('pipe:0', 'pipe:1', threads=None, output_format='mp3', options=['-vn'])
+        self.assertEqual(data, b'abcd')
+
+    @patch('music2storage.helpers.ffmpeg_command', return_value=['cat'])
+    def test_transcoded_stream_source_error(self, mocked_ffmpeg_command):
+        def chunks():
+            yield b'ab'
+            raise ConnectionError()
+        stream = TranscodedStream(chunks())
+        with self.assertRaises(FFRuntimeError):
+            while stream.read(1):
+                pass
+        stream.close()
+
+    @patch('music2storage.helpers.ffmpeg_command', return_value=['false'])
+    def test_transcoded_stream_ffmpeg_error(self, mocked_ffmpeg_command):
+        stream = TranscodedStream('filename.mp4')
+        with self.assertRaises(FFRuntimeError):
+            stream.read()
+        stream.close()
+
+    @patch('music2storage.helpers.os.remove')
+    def test_delete_local_file_oserror(self, mocked_remove):
+        mocked_remove.side_effect = OSError()
+        self.assertIsNone(delete_local_file('filename.mp3'))
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from music2storage.index import TrackIndex
+
+
+class TestTrackIndex(TestCase):
+    def test_add_and_get_after_reopen(self):
+        with TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'index.db')
+            index = TrackIndex(path)
+            self.assertIsNone(index.get('google drive', 'youtube:DhHGDOgjie4'))
+            index.add('google drive', 'youtube:DhHGDOgjie4', 'file-id')
+            index.close()
+
+            index = TrackIndex(path)
+            self.assertEqual(index.get('google drive', 'youtube:DhHGDOgjie4'), 'file-id')
+            self.assertIsNone(index.get('local', 'youtube:DhHGDOgjie4'))
+            index.close()
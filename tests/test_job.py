@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from threading import Timer
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from music2storage.job import Job, JobFailed
+
+
+class TestJob(TestCase):
+    def test_advance_records_timings(self):
+        job = Job('http://example.com/')
+        job.advance('convert')
+        job.advance('upload')
+        self.assertEqual(job.stage, 'upload')
+        self.assertEqual(set(job.timings), {'download', 'convert'})
+        self.assertTrue(all(seconds >= 0 for seconds in job.timings.values()))
+
+    def test_result(self):
+        job = Job('http://example.com/')
+        job.location = 'file-id'
+        job.advance('done')
+        self.assertFalse(job.done())
+        job.finish()
+        self.assertTrue(job.done())
+        self.assertEqual(job.result(0), 'file-id')
+        self.assertIsNone(job.exception(0))
+        self.assertIsNotNone(job.finished_at)
+
+    def test_result_of_failed_job(self):
+        job = Job('http://example.com/')
+        job.advance('failed')
+        error = OSError('disk full')
+        job.finish(error)
+        with self.assertRaises(JobFailed) as context:
+            job.result(0)
+        self.assertIs(context.exception.job, job)
+        self.assertIs(context.exception.__cause__, error)
+        self.assertIs(job.error, error)
+
+    def test_result_waits(self):
+        job = Job('http://example.com/')
+        with self.assertRaises(TimeoutError):
+            job.result(0.01)
+        job.location = 'file-id'
+        job.advance('done')
+        Timer(0.01, job.finish).start()
+        self.assertEqual(job.result(1), 'file-id')
+
+    def test_done_callbacks(self):
+        job = Job('http://example.com/')
+        before, after = MagicMock(), MagicMock()
+        failing = MagicMock(side_effect=ValueError())
+        job.add_done_callback(failing)
+        job.add_done_callback(before)
+        before.assert_not_called()
+        job.advance('done')
+        job.finish()
+        before.assert_called_once_with(job)
+        job.add_done_callback(after)
+        after.assert_called_once_with(job)
+
+    def test_await(self):
+        job = Job('http://example.com/')
+        job.location = 'file-id'
+        job.advance('done')
+
+        async def wait():
+            Timer(0.01, job.finish).start()
+            return await job
+
+        self.assertEqual(asyncio.run(wait()), 'file-id')
+
+    def test_await_failed_job(self):
+        job = Job('http://example.com/')
+        job.advance('failed')
+        job.finish('Conversion has failed')
+
+        async def wait():
+            return await job
+
+        with self.assertRaises(JobFailed):
+            asyncio.run(wait())
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from music2storage.job import Job
+from music2storage.jobstore import JobStore
+
+
+class TestJobStore(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'jobs.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_pending_after_reopen(self):
+        store = JobStore(self.path)
+        job = Job('http://example.com/')
+        store.add(job)
+        job.stage = 'upload'
+        job.file_name = 'filename.mp3'
+        store.update(job)
+        store.close()
+
+        store = JobStore(self.path)
+        pending = store.pending()
+        store.close()
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(pending[0].id, job.id)
+        self.assertEqual(pending[0].url, 'http://example.com/')
+        self.assertEqual(pending[0].stage, 'upload')
+        self.assertEqual(pending[0].file_name, 'filename.mp3')
+
+    def test_done_and_failed_jobs_are_not_pending(self):
+        store = JobStore(self.path)
+        jobs = [Job('http://example.com/1'), Job('http://example.com/2'), Job('http://example.com/3')]
+        store.add_many(jobs)
+        jobs[0].stage = 'done'
+        store.update(jobs[0])
+        jobs[1].stage = 'failed'
+        store.update(jobs[1])
+        self.assertEqual([job.id for job in store.pending()], [jobs[2].id])
+        store.close()
+
+    def test_priority_and_tenant_are_kept(self):
+        store = JobStore(self.path)
+        store.add(Job('http://example.com/1', priority=5, tenant='radio'))
+        store.add_many([Job('http://example.com/2', tenant='user')])
+        pending = {job.url: job for job in store.pending()}
+        store.close()
+        self.assertEqual((pending['http://example.com/1'].priority, pending['http://example.com/1'].tenant), (5, 'radio'))
+        self.assertEqual((pending['http://example.com/2'].priority, pending['http://example.com/2'].tenant), (0, 'user'))
+
+    def test_store_without_priorities_is_upgraded(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute(
+            'CREATE TABLE jobs ('
+            'id TEXT PRIMARY KEY, url TEXT NOT NULL, stage TEXT NOT NULL, file_name TEXT, track_id TEXT, location TEXT, updated_at REAL NOT NULL)'
+        )
+        connection.execute("INSERT INTO jobs VALUES ('old', 'http://example.com/', 'upload', 'filename.mp3', NULL, NULL, 0)")
+        connection.commit()
+        connection.close()
+
+        store = JobStore(self.path)
+        store.add(Job('http://example.com/new', tenant='user'))
+        pending = store.pending()
+        store.close()
+        self.assertEqual([(job.id, job.priority, job.tenant) for job in pending][0], ('old', 0, None))
+        self.assertEqual(pending[1].tenant, 'user')
+
+    def test_first_version_store_is_upgraded(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute('CREATE TABLE jobs (id TEXT PRIMARY KEY, url TEXT NOT NULL, stage TEXT NOT NULL, file_name TEXT, '
+                           'updated_at REAL NOT NULL)')
+        connection.execute("INSERT INTO jobs VALUES ('old', 'http://example.com/', 'upload', 'filename.mp3', 0)")
+        connection.commit()
+        connection.close()
+
+        store = JobStore(self.path)
+        job = Job('http://example.com/new', track_id='youtube:id')
+        store.add(job)
+        job.location = 'file-id'
+        job.stage = 'delete'
+        store.update(job)
+        pending = store.pending()
+        store.close()
+        self.assertEqual([(job.id, job.track_id, job.location) for job in pending][0], ('old', None, None))
+        self.assertEqual((pending[1].track_id, pending[1].location), ('youtube:id', 'file-id'))
+
+    def test_old_failed_jobs_are_pruned(self):
+        store = JobStore(self.path)
+        old, recent, running = Job('http://example.com/1'), Job('http://example.com/2'), Job('http://example.com/3')
+        store.add_many([old, recent, running])
+        old.stage = recent.stage = 'failed'
+        store.update(old)
+        store.update(recent)
+        store.connection.execute('UPDATE jobs SET updated_at = 0 WHERE id IN (?, ?)', (old.id, running.id))
+        store.close()
+
+        store = JobStore(self.path, failed_ttl=3600)
+        ids = {row[0] for row in store.connection.execute('SELECT id FROM jobs')}
+        self.assertEqual(ids, {recent.id, running.id})
+        self.assertEqual(store.prune(), 1)
+        self.assertEqual([job.id for job in store.pending()], [running.id])
+        store.close()
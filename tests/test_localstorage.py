@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import io
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from music2storage.localstorage import LocalStorage, copy_file
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def cross_device(real_link):
+    """Hard links fail like they do between two filesystems for files outside of the Music folder."""
+
+    def link(source, destination):
+        if os.path.basename(source).startswith('.'):
+            return real_link(source, destination)
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    return link
+
+
+class TestCopyFile(TestCase):
+    def test_copies_in_chunks(self):
+        with TemporaryDirectory() as directory:
+            data = os.urandom(10000)
+            write(os.path.join(directory, 'source'), data)
+            self.assertEqual(copy_file(os.path.join(directory, 'source'), os.path.join(directory, 'copy'), chunk_size=4096), 10000)
+            self.assertEqual(read(os.path.join(directory, 'copy')), data)
+
+    def test_falls_back_without_kernel_copy(self):
+        unsupported = OSError(errno.ENOSYS, 'Function not implemented')
+        with TemporaryDirectory() as directory, \
+                patch('music2storage.localstorage.os.copy_file_range', side_effect=unsupported, create=True), \
+                patch('music2storage.localstorage.os.sendfile', side_effect=unsupported):
+            write(os.path.join(directory, 'source'), b'abc')
+            copy_file(os.path.join(directory, 'source'), os.path.join(directory, 'copy'))
+            self.assertEqual(read(os.path.join(directory, 'copy')), b'abc')
+
+    def test_never_overwrites(self):
+        with TemporaryDirectory() as directory:
+            write(os.path.join(directory, 'source'), b'abc')
+            write(os.path.join(directory, 'copy'), b'old')
+            with self.assertRaises(FileExistsError):
+                copy_file(os.path.join(directory, 'source'), os.path.join(directory, 'copy'))
+
+
+class TestLocalStorage(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.music = os.path.join(self.directory.name, 'music')
+        os.makedirs(self.music)
+        self.source = os.path.join(self.directory.name, 'scratch', 'filename.mp3')
+        os.makedirs(os.path.dirname(self.source))
+        write(self.source, b'abc')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_upload_moves_file(self):
+        storage = LocalStorage(custom_path=self.music)
+        self.assertEqual(storage.upload(self.source), os.path.join(self.music, 'filename.mp3'))
+        self.assertEqual(read(os.path.join(self.music, 'filename.mp3')), b'abc')
+        self.assertFalse(os.path.exists(self.source))
+
+    def test_upload_keeps_existing_tracks(self):
+        write(os.path.join(self.music, 'filename.mp3'), b'old')
+        write(os.path.join(self.music, 'filename (2).mp3'), b'older')
+        storage = LocalStorage(custom_path=self.music)
+        self.assertEqual(storage.upload(self.source), os.path.join(self.music, 'filename (3).mp3'))
+        self.assertEqual(read(os.path.join(self.music, 'filename.mp3')), b'old')
+        self.assertEqual(read(os.path.join(self.music, 'filename (3).mp3')), b'abc')
+
+    def test_upload_copies_across_filesystems(self):
+        write(os.path.join(self.music, 'filename.mp3'), b'old')
+        storage = LocalStorage(custom_path=self.music)
+        with patch('music2storage.localstorage.os.link', side_effect=cross_device(os.link)):
+            location = storage.upload(self.source)
+        self.assertEqual(location, os.path.join(self.music, 'filename (2).mp3'))
+        self.assertEqual(read(location), b'abc')
+        self.assertEqual(sorted(os.listdir(self.music)), ['filename (2).mp3', 'filename.mp3'])
+        storage.flush()
+        self.assertFalse(os.path.exists(self.source))
+
+    def test_copy_flushed_before_source_removed(self):
+        storage = LocalStorage(custom_path=self.music)
+        synced = []
+
+        def fsync(path):
+            self.assertTrue(os.path.exists(self.source))
+            synced.append(path)
+
+        with patch('music2storage.localstorage.os.link', side_effect=cross_device(os.link)), \
+                patch('music2storage.localstorage.fsync', side_effect=fsync):
+            location = storage.upload(self.source)
+            self.assertEqual(synced, [])
+            self.assertTrue(os.path.exists(self.source))
+            storage.flush()
+        self.assertEqual(synced, [location, self.music])
+        self.assertFalse(os.path.exists(self.source))
+        self.assertEqual(storage.unsynced, [])
+
+    @patch('music2storage.localstorage.os.fsync')
+    def test_copies_across_filesystems_are_batched(self, fsync):
+        storage = LocalStorage(custom_path=self.music, sync_every=3, sync_interval=60)
+        sources = [os.path.join(self.directory.name, f'{i}.mp3') for i in range(3)]
+        with patch('music2storage.localstorage.os.link', side_effect=cross_device(os.link)):
+            for source in sources[:2]:
+                write(source, b'abc')
+                storage.upload(source)
+            fsync.assert_not_called()
+            self.assertTrue(all(os.path.exists(source) for source in sources[:2]))
+            write(sources[2], b'abc')
+            storage.upload(sources[2])
+        self.assertEqual(fsync.call_count, 4)  # Three copies and their folder
+        self.assertFalse(any(os.path.exists(source) for source in sources))
+
+    def test_failed_copy_leaves_nothing(self):
+        storage = LocalStorage(custom_path=self.music)
+        with patch('music2storage.localstorage.os.link', side_effect=cross_device(os.link)), \
+                patch('music2storage.localstorage.copy_file', side_effect=OSError(errno.ENOSPC, 'No space left on device')):
+            with self.assertRaises(OSError):
+                storage.upload(self.source)
+        self.assertEqual(os.listdir(self.music), [])
+        self.assertTrue(os.path.exists(self.source))
+
+    def test_upload_without_hard_links(self):
+        write(os.path.join(self.music, 'filename.mp3'), b'old')
+        storage = LocalStorage(custom_path=self.music)
+        with patch('music2storage.localstorage.os.link', side_effect=PermissionError(errno.EPERM, 'Operation not permitted')):
+            location = storage.upload(self.source)
+        self.assertEqual(location, os.path.join(self.music, 'filename (2).mp3'))
+        self.assertEqual(read(os.path.join(self.music, 'filename.mp3')), b'old')
+
+    @patch('music2storage.localstorage.os.fsync')
+    def test_fsyncs_are_batched(self, fsync):
+        storage = LocalStorage(custom_path=self.music, sync_every=3, sync_interval=60)
+        for i in range(2):
+            write(self.source, b'abc')
+            storage.upload(self.source)
+        fsync.assert_not_called()
+        write(self.source, b'abc')
+        storage.upload(self.source)
+        self.assertEqual(fsync.call_count, 4)  # Three files and their folder
+        self.assertEqual(storage.flush(), 0)
+
+    @patch('music2storage.localstorage.os.fsync')
+    def test_fsync_after_interval(self, fsync):
+        storage = LocalStorage(custom_path=self.music, sync_every=100, sync_interval=0.01)
+        storage.upload(self.source)
+        storage.sync_timer.join(1)
+        self.assertEqual(fsync.call_count, 2)
+        self.assertIsNone(storage.sync_timer)
+
+    def test_upload_stream(self):
+        with TemporaryDirectory() as directory:
+            storage = LocalStorage(custom_path=directory)
+            location = storage.upload_stream(io.BytesIO(b'abc'), 'filename.mp3', chunk_size=2)
+            self.assertEqual(location, os.path.join(directory, 'filename.mp3'))
+            with open(location, 'rb') as f:
+                self.assertEqual(f.read(), b'abc')
+            self.assertEqual(os.listdir(directory), ['filename.mp3'])
+
+    def test_upload_stream_error_leaves_nothing(self):
+        stream = MagicMock()
+        stream.read.side_effect = [b'ab', OSError()]
+        with TemporaryDirectory() as directory:
+            storage = LocalStorage(custom_path=directory)
+            with self.assertRaises(OSError):
+                storage.upload_stream(stream, 'filename.mp3')
+            self.assertEqual(os.listdir(directory), [])
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from unittest.mock import MagicMock
+from urllib.request import urlopen
+
+from music2storage.job import Job
+from music2storage.metrics import Histogram, Metrics, MetricsServer
+from music2storage.queues import StageQueue
+
+
+class TestHistogram(TestCase):
+    def test_buckets_and_quantiles(self):
+        histogram = Histogram(buckets=(1, 2, 4))
+        for value in (0.5, 1.5, 1.5, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.sum, 16.5)
+        self.assertEqual(histogram.cumulative(), [(1, 1), (2, 3), (4, 4), (float('inf'), 5)])
+        self.assertEqual(histogram.quantile(0.5), 1.75)
+        self.assertIsNone(Histogram().quantile(0.5))
+
+
+class TestMetrics(TestCase):
+    def test_timed_counts_items_and_failures(self):
+        metrics = Metrics()
+
+        def download(job):
+            if job.url.endswith('bad'):
+                job.stage = 'failed'
+                return None
+            return job
+
+        timed = metrics.timed('download', download)
+        timed(Job('http://example.com/good'))
+        timed(Job('http://example.com/bad'))
+        with self.assertRaises(ValueError):
+            metrics.timed('download', MagicMock(side_effect=ValueError))(Job('http://example.com/'))
+
+        pool = MagicMock()
+        pool.size = 2
+        stats = metrics.stats({'download': pool})['stages']['download']
+        self.assertEqual(stats['count'], 3)
+        self.assertEqual(stats['errors'], 2)
+        self.assertEqual(stats['active'], 0)
+        self.assertEqual(stats['utilisation'], 0.0)
+        self.assertEqual(stats['workers'], 2)
+        self.assertIsNotNone(stats['latency']['p95'])
+
+    def test_intermediate_files_are_not_errors(self):
+        metrics = Metrics()
+        metrics.timed('delete', lambda item: None)('filename.mp4')
+        self.assertEqual(metrics.stats()['stages']['delete']['errors'], 0)
+
+    def test_prometheus_text(self):
+        metrics = Metrics(buckets=(1,))
+        metrics.observe('upload', 0.5)
+        metrics.add_bytes('uploaded', 42)
+        services = {'google drive': {'calls': 3, 'retries': 1, 'failures': 1, 'breaker': {'state': 'open'}}}
+        text = metrics.prometheus({'upload': StageQueue()}, None, services)
+        self.assertIn('music2storage_stage_seconds_bucket{stage="upload",le="1.0"} 1', text)
+        self.assertIn('music2storage_stage_seconds_bucket{stage="upload",le="+Inf"} 1', text)
+        self.assertIn('music2storage_stage_seconds_count{stage="upload"} 1', text)
+        self.assertIn('music2storage_bytes_total{direction="uploaded"} 42', text)
+        self.assertIn('music2storage_queue_depth{queue="upload"} 0', text)
+        self.assertIn('music2storage_service_retries_total{service="google drive"} 1', text)
+        self.assertIn('music2storage_service_circuit_open{service="google drive"} 1', text)
+
+
+class TestMetricsServer(TestCase):
+    def test_serves_metrics_text(self):
+        server = MetricsServer(lambda: 'music2storage_up 1\n', port=0)
+        server.start()
+        try:
+            with urlopen(f"http://127.0.0.1:{server.port}/metrics") as r:
+                self.assertEqual(r.read(), b'music2storage_up 1\n')
+                self.assertTrue(r.headers['Content-Type'].startswith('text/plain'))
+        finally:
+            server.stop()
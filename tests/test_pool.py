@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from music2storage.pool import Autoscaler, WorkerPool
+from music2storage.queues import StageQueue
+
+
+class TestWorkerPool(TestCase):
+    @patch('music2storage.pool.Worker')
+    def test_resize_within_bounds(self, mocked_worker):
+        mocked_worker.side_effect = lambda *args, **kwargs: MagicMock()
+        in_queue = StageQueue()
+        workers = []
+        pool = WorkerPool('convert', MagicMock(), in_queue, MagicMock(), MagicMock(), workers, min_size=1, max_size=3)
+        pool.start()
+        self.assertEqual(pool.size, 1)
+        self.assertEqual(pool.resize(10), 3)
+        self.assertEqual(len(workers), 3)
+        for worker in workers:
+            worker.start.assert_called()
+
+        self.assertEqual(pool.resize(0), 1)
+        self.assertEqual(in_queue.stops, 2)
+        self.assertEqual(pool.size, 1)
+
+        workers[1].is_alive.return_value = False
+        workers[2].is_alive.return_value = False
+        in_queue.stops = 0
+        self.assertEqual(pool.resize(1), 1)
+        self.assertEqual(len(workers), 1)
+
+
+class TestAutoscaler(TestCase):
+    def make_pool(self, depth, wait, size=2):
+        pool = MagicMock()
+        pool.min_size = 1
+        pool.max_size = 4
+        pool.size = size
+        pool.in_queue.qsize.return_value = depth
+        pool.in_queue.oldest_wait.return_value = wait
+        return pool
+
+    def test_scale_up_when_queue_backs_up(self):
+        autoscaler = Autoscaler([], MagicMock(), max_wait=10)
+        pool = self.make_pool(depth=5, wait=0)
+        autoscaler.scale(pool)
+        pool.resize.assert_called_with(3)
+        pool = self.make_pool(depth=1, wait=30)
+        autoscaler.scale(pool)
+        pool.resize.assert_called_with(3)
+
+    def test_scale_down_when_queue_empty(self):
+        autoscaler = Autoscaler([], MagicMock())
+        pool = self.make_pool(depth=0, wait=0)
+        autoscaler.scale(pool)
+        pool.resize.assert_called_with(1)
+
+    def test_fixed_size_pool_not_scaled(self):
+        autoscaler = Autoscaler([], MagicMock())
+        pool = self.make_pool(depth=100, wait=100)
+        pool.max_size = pool.min_size
+        autoscaler.scale(pool)
+        pool.resize.assert_not_called()
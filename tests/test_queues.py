@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+from queue import Empty
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import patch
+
+from music2storage.job import Job
+from music2storage.queues import STOP, StageQueue
+
+
+def jobs(tenant, count, priority=0):
+    return [Job(f'http://example.com/{tenant}/{i}', tenant=tenant, priority=priority) for i in range(count)]
+
+
+def drain(stage_queue):
+    items = []
+    while True:
+        try:
+            items.append(stage_queue.get_nowait())
+        except Empty:
+            return items
+
+
+class TestStageQueue(TestCase):
+    @patch('music2storage.queues.time')
+    def test_wait_time(self, mocked_time):
+        stage_queue = StageQueue(smoothing=0.5)
+        mocked_time.return_value = 100.0
+        stage_queue.put('item')
+        self.assertEqual(stage_queue.oldest_wait(), 0.0)
+        mocked_time.return_value = 104.0
+        self.assertEqual(stage_queue.oldest_wait(), 4.0)
+        self.assertEqual(stage_queue.get_nowait(), 'item')
+        self.assertEqual(stage_queue.wait_time, 2.0)
+        self.assertEqual(stage_queue.oldest_wait(), 0.0)
+
+    def test_stop_jumps_queue_and_ignores_capacity(self):
+        stage_queue = StageQueue(1)
+        stage_queue.put('item')
+        stage_queue.stop()
+        self.assertEqual(stage_queue.qsize(), 1)
+        self.assertIs(stage_queue.get_nowait(), STOP)
+        self.assertEqual(stage_queue.get_nowait(), 'item')
+
+    def test_stop_leaves_room_for_items(self):
+        stage_queue = StageQueue(1)
+        stage_queue.stop(2)
+        self.assertEqual(stage_queue.qsize(), 0)
+        stage_queue.put_nowait('item')
+        self.assertEqual(stage_queue.qsize(), 1)
+
+    def test_fifo_without_priorities_or_tenants(self):
+        stage_queue = StageQueue()
+        for item in ('first', 'second', 'third'):
+            stage_queue.put(item)
+        self.assertEqual(drain(stage_queue), ['first', 'second', 'third'])
+
+    def test_highest_priority_first(self):
+        stage_queue = StageQueue()
+        low, high = jobs('bulk', 2), jobs('user', 1, priority=10)
+        for job in low + high:
+            stage_queue.put(job)
+        self.assertEqual(drain(stage_queue), high + low)
+
+    def test_tenants_take_turns(self):
+        stage_queue = StageQueue()
+        bulk, user = jobs('bulk', 4), jobs('user', 2)
+        for job in bulk + user:
+            stage_queue.put(job)
+        self.assertEqual(drain(stage_queue), [bulk[0], user[0], bulk[1], user[1], bulk[2], bulk[3]])
+
+    def test_weighted_turns(self):
+        stage_queue = StageQueue(weights={'radio': 2})
+        radio, user = jobs('radio', 4), jobs('user', 2)
+        for job in user + radio:
+            stage_queue.put(job)
+        self.assertEqual(drain(stage_queue), [user[0], radio[0], radio[1], user[1], radio[2], radio[3]])
+
+    def test_idle_tenant_gets_no_credit(self):
+        stage_queue = StageQueue()
+        bulk, user = jobs('bulk', 6), jobs('user', 3)
+        for job in bulk:
+            stage_queue.put(job)
+        self.assertEqual([stage_queue.get_nowait() for _ in range(3)], bulk[:3])
+        for job in user:
+            stage_queue.put(job)
+        self.assertEqual(drain(stage_queue), [user[0], bulk[3], user[1], bulk[4], user[2], bulk[5]])
+
+    def test_tenant_cap(self):
+        stage_queue = StageQueue(cap=1)
+        bulk, user = jobs('bulk', 2), jobs('user', 1)
+        for job in bulk + user + ['file.mp4', 'other.mp4']:
+            stage_queue.put(job)
+        taken = drain(stage_queue)
+        self.assertEqual(len(taken), 4)
+        self.assertNotIn(bulk[1], taken)
+        self.assertEqual(stage_queue.qsize(), 1)
+
+        taken = []
+        thread = Thread(target=lambda: taken.append(stage_queue.get(timeout=1)))
+        thread.start()
+        stage_queue.release(bulk[0])
+        thread.join()
+        self.assertEqual(taken, [bulk[1]])
+
+    def test_siblings_share_tenant_cap(self):
+        first = StageQueue(cap=1)
+        second = StageQueue(cap=1, sibling=first)
+        bulk = jobs('bulk', 2)
+        first.put(bulk[0])
+        second.put(bulk[1])
+        self.assertIs(first.get_nowait(), bulk[0])
+        with self.assertRaises(Empty):
+            second.get_nowait()
+
+        taken = []
+        thread = Thread(target=lambda: taken.append(second.get(timeout=1)))
+        thread.start()
+        first.release(bulk[0])
+        thread.join()
+        self.assertEqual(taken, [bulk[1]])
+
+    def test_get_timeout_while_capped(self):
+        stage_queue = StageQueue(cap=1)
+        bulk = jobs('bulk', 2)
+        for job in bulk:
+            stage_queue.put(job)
+        stage_queue.get()
+        with self.assertRaises(Empty):
+            stage_queue.get(timeout=0.01)
+        stage_queue.stop()
+        self.assertIs(stage_queue.get(timeout=0.01), STOP)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from requests import Response
+from requests.exceptions import ChunkedEncodingError, ConnectionError, HTTPError
+
+from music2storage.resilience import CircuitBreaker, CircuitOpenError, is_transient, RetryPolicy, ServiceGuard, TokenBucket
+
+
+def http_error(status, headers=None):
+    response = Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return HTTPError(response=response)
+
+
+class TestResilience(TestCase):
+    def test_is_transient(self):
+        self.assertTrue(is_transient(http_error(429)))
+        self.assertTrue(is_transient(http_error(503)))
+        self.assertTrue(is_transient(ConnectionError()))
+        self.assertTrue(is_transient(ChunkedEncodingError()))
+        self.assertFalse(is_transient(http_error(404)))
+        self.assertFalse(is_transient(FileNotFoundError()))
+        self.assertFalse(is_transient(ValueError()))
+
+    @patch('music2storage.resilience.sleep')
+    @patch('music2storage.resilience.monotonic')
+    def test_token_bucket_waits_when_empty(self, mocked_monotonic, mocked_sleep):
+        mocked_monotonic.return_value = 0
+        bucket = TokenBucket(rate=2, burst=2)
+        bucket.acquire()
+        bucket.acquire()
+        mocked_sleep.side_effect = lambda delay: setattr(mocked_monotonic, 'return_value', mocked_monotonic.return_value + delay)
+        bucket.acquire()
+        mocked_sleep.assert_called_once_with(0.5)
+        self.assertEqual(bucket.stats()['acquired'], 3)
+        self.assertEqual(bucket.stats()['waited_seconds'], 0.5)
+
+    @patch('music2storage.resilience.random.uniform', side_effect=lambda low, high: high)
+    def test_retry_delay(self, mocked_uniform):
+        policy = RetryPolicy(base=1, cap=5)
+        self.assertEqual([policy.delay(attempt) for attempt in range(4)], [1, 2, 4, 5])
+        self.assertEqual(policy.delay(0, http_error(429, {'Retry-After': '3'})), 3)
+
+    @patch('music2storage.resilience.monotonic')
+    def test_circuit_breaker_opens_and_closes(self, mocked_monotonic):
+        mocked_monotonic.return_value = 0
+        breaker = CircuitBreaker(threshold=2, cooldown=10)
+        breaker.failure()
+        breaker.acquire()
+        breaker.failure()
+        self.assertEqual(breaker.stats(), {'state': 'open', 'failures': 2, 'trips': 1})
+        with self.assertRaises(CircuitOpenError):
+            breaker.acquire(timeout=0)
+
+        mocked_monotonic.return_value = 10
+        breaker.acquire()
+        self.assertEqual(breaker.state, 'half-open')
+        breaker.failure()
+        self.assertEqual(breaker.stats()['trips'], 2)
+
+        mocked_monotonic.return_value = 20
+        breaker.acquire()
+        breaker.success()
+        self.assertEqual(breaker.stats(), {'state': 'closed', 'failures': 0, 'trips': 2})
+
+    def test_circuit_breaker_pauses_callers(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=0.2)
+        breaker.failure()
+        waiter = Thread(target=breaker.acquire)
+        waiter.start()
+        waiter.join(0.05)
+        self.assertTrue(waiter.is_alive())
+        waiter.join(1)
+        self.assertFalse(waiter.is_alive())
+
+    @patch('music2storage.resilience.sleep')
+    def test_guard_retries_transient_errors(self, mocked_sleep):
+        guard = ServiceGuard('youtube', retries=2)
+        func = MagicMock(side_effect=[http_error(503), ConnectionError(), 'filename.mp4'])
+        self.assertEqual(guard.call(func, 'http://example.com/'), 'filename.mp4')
+        func.assert_called_with('http://example.com/')
+        self.assertEqual(guard.stats()['retries'], 2)
+        self.assertEqual(guard.stats()['breaker']['state'], 'closed')
+
+    @patch('music2storage.resilience.sleep')
+    def test_guard_does_not_retry(self, mocked_sleep):
+        guard = ServiceGuard('youtube', retries=2)
+        with self.assertRaises(HTTPError):
+            guard.call(MagicMock(side_effect=http_error(404)))
+        with self.assertRaises(HTTPError):
+            guard.call(MagicMock(side_effect=http_error(503)), retry=False)
+        self.assertFalse(mocked_sleep.called)
+        self.assertEqual(guard.stats()['calls'], 2)
+        self.assertEqual(guard.stats()['failures'], 1)
+        self.assertIsNone(guard.stats()['limiter'])
+
+    def test_guard_retries_coroutines_without_blocking(self):
+        guard = ServiceGuard('youtube', retries=2, backoff=0.01)
+        outcomes = [http_error(503), ConnectionError(), 'filename.mp4']
+        delays = []
+
+        async def request(url):
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        async def sleep(delay):
+            delays.append(delay)
+
+        loop = asyncio.new_event_loop()
+        try:
+            with patch('asyncio.sleep', side_effect=sleep), patch('music2storage.resilience.sleep') as mocked_sleep:
+                self.assertEqual(loop.run_until_complete(guard.call_async(request, 'http://example.com/')), 'filename.mp4')
+        finally:
+            loop.close()
+        self.assertEqual(len(delays), 2)
+        self.assertFalse(mocked_sleep.called)
+        self.assertEqual(guard.stats()['retries'], 2)
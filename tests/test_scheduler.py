@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from threading import Event, Thread
+from unittest import TestCase
+from unittest.mock import patch
+
+from music2storage.scheduler import ConversionScheduler
+
+
+class TestConversionScheduler(TestCase):
+    @patch('music2storage.scheduler.os.cpu_count', return_value=8)
+    def test_threads_split_between_jobs(self, mocked_cpu_count):
+        self.assertEqual(ConversionScheduler().max_jobs, 8)
+        self.assertEqual(ConversionScheduler().threads_per_job, 1)
+        self.assertEqual(ConversionScheduler(max_jobs=2).threads_per_job, 4)
+        self.assertEqual(ConversionScheduler(max_jobs=16).threads_per_job, 1)
+
+    @patch('music2storage.scheduler.os.cpu_count', return_value=8)
+    def test_fit_gives_every_worker_a_slot(self, mocked_cpu_count):
+        scheduler = ConversionScheduler()
+        scheduler.fit(4)
+        self.assertEqual((scheduler.max_jobs, scheduler.threads_per_job), (4, 2))
+        scheduler.fit(1)
+        self.assertEqual((scheduler.max_jobs, scheduler.threads_per_job), (1, 8))
+        scheduler.fit(40)
+        self.assertEqual((scheduler.max_jobs, scheduler.threads_per_job), (8, 1))
+
+        scheduler = ConversionScheduler(max_jobs=4)
+        scheduler.fit(6)
+        self.assertEqual((scheduler.max_jobs, scheduler.threads_per_job), (4, 2))
+
+    def test_slot_waits_for_free_slot(self):
+        scheduler = ConversionScheduler(max_jobs=1)
+        converted = Event()
+
+        def convert():
+            with scheduler.slot():
+                converted.set()
+
+        with scheduler.slot() as threads:
+            self.assertEqual(threads, scheduler.threads_per_job)
+            thread = Thread(target=convert)
+            thread.start()
+            self.assertFalse(converted.wait(0.05))
+        self.assertTrue(converted.wait(1))
+        thread.join()
+        self.assertEqual(scheduler.running, 0)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import json
+import subprocess
+import sys
+from unittest import TestCase
+
+from music2storage.service import MusicService
+
+
+class FakeService(MusicService):
+    HOSTS = ('example.com',)
+
+    def __init__(self):
+        self.name = 'fake'
+
+    def download(self, url):
+        return None
+
+
+class TestMusicService(TestCase):
+    def test_handles_hosts_and_subdomains(self):
+        service = FakeService()
+        self.assertTrue(service.handles('https://example.com/track'))
+        self.assertTrue(service.handles('https://www.example.com/track'))
+        self.assertFalse(service.handles('https://notexample.com/track'))
+
+    def test_urls_are_tracks_by_default(self):
+        service = FakeService()
+        self.assertFalse(service.is_playlist('https://example.com/playlist'))
+        with self.assertRaises(NotImplementedError):
+            next(service.expand('https://example.com/playlist'))
+
+
+class TestBackends(TestCase):
+    def loaded_modules(self, code):
+        code += '\nimport json, sys\nprint(json.dumps(sorted(sys.modules)))'
+        output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True).stdout
+        return set(json.loads(output.decode()))
+
+    def test_import_loads_no_backend(self):
+        modules = self.loaded_modules('import music2storage')
+        for module in ('music2storage.youtube', 'music2storage.googledrive', 'pytube', 'googleapiclient', 'oauth2client', 'requests',
+                       'ffmpy'):
+            self.assertNotIn(module, modules)
+
+    def test_backends_loaded_on_first_use(self):
+        modules = self.loaded_modules(
+            'import tempfile\n'
+            'from music2storage import Music2Storage\n'
+            'm2s = Music2Storage()\n'
+            "m2s.use_music_service('soundcloud')\n"
+            "m2s.use_storage_service('local', custom_path=tempfile.gettempdir())")
+        self.assertIn('music2storage.soundcloud', modules)
+        self.assertIn('music2storage.localstorage', modules)
+        for module in ('music2storage.youtube', 'music2storage.googledrive', 'pytube', 'googleapiclient', 'oauth2client'):
+            self.assertNotIn(module, modules)
+
+    def test_backends_still_importable_from_service(self):
+        from music2storage.service import GoogleDrive
+        from music2storage.googledrive import GoogleDrive as DriveBackend
+        self.assertIs(GoogleDrive, DriveBackend)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from music2storage.sessions import UploadSessionStore
+
+
+class TestUploadSessionStore(TestCase):
+    def test_add_get_and_remove_after_reopen(self):
+        with TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'sessions.db')
+            file_name = os.path.join(directory, 'filename.mp3')
+            with open(file_name, 'wb') as f:
+                f.write(b'abc')
+            sessions = UploadSessionStore(path)
+            self.assertIsNone(sessions.get(file_name))
+            sessions.add(file_name, 'https://upload/session')
+            sessions.close()
+
+            sessions = UploadSessionStore(path)
+            self.assertEqual(sessions.get(file_name), 'https://upload/session')
+            sessions.remove(file_name)
+            self.assertIsNone(sessions.get(file_name))
+            sessions.close()
+
+    def test_changed_file_is_not_resumed(self):
+        with TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'filename.mp3')
+            with open(file_name, 'wb') as f:
+                f.write(b'abc')
+            sessions = UploadSessionStore(os.path.join(directory, 'sessions.db'))
+            sessions.add(file_name, 'https://upload/session')
+            with open(file_name, 'ab') as f:
+                f.write(b'def')
+            self.assertIsNone(sessions.get(file_name))
+            sessions.close()
@@ -21,5 +21,6 @@ class TestSignalHandler(TestCase):
         handler(mocked_signum, mocked_frame)
         mocked_stopper.set.assert_called()
         for mocked_worker in mocked_workers:
+            mocked_worker.stop.assert_called()
             mocked_worker.join.assert_called()
         mocked_exit.assert_called_with(0)
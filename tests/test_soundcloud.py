@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from requests.exceptions import HTTPError
+
+from music2storage.soundcloud import Soundcloud
+
+
+def make_response(status_code=200, json=None, headers=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.json.return_value = json
+    response.headers = headers or {}
+    response.ok = status_code < 400
+    if not response.ok:
+        response.raise_for_status.side_effect = HTTPError(response=response)
+    return response
+
+
+class TestSoundcloud(TestCase):
+    def test_track_id_normalizes_url(self):
+        service = Soundcloud()
+        self.assertEqual(service.track_id('https://soundcloud.com/artist/track'), 'soundcloud:soundcloud.com/artist/track')
+        self.assertEqual(service.track_id('http://m.soundcloud.com/artist/track/?in=set'), 'soundcloud:soundcloud.com/artist/track')
+
+    def test_pool_size(self):
+        service = Soundcloud(pool_size=3, connections=2)
+        service.set_pool_size(8)
+        self.assertEqual(service.session.get_adapter('https://api.soundcloud.com')._pool_maxsize, 16)
+
+    def test_resolve_is_cached(self):
+        service = Soundcloud()
+        service.session = MagicMock()
+        service.session.get.return_value = make_response(json={'title': 'track', 'stream_url': 'https://api/tracks/1/stream'})
+        self.assertEqual(service.resolve('https://soundcloud.com/artist/track')['title'], 'track')
+        self.assertEqual(service.resolve('https://m.soundcloud.com/artist/track/')['title'], 'track')
+        self.assertEqual(service.session.get.call_count, 1)
+
+    def test_resolving_set_caches_its_tracks(self):
+        service = Soundcloud()
+        service.session = MagicMock()
+        track = {'title': 'track', 'permalink_url': 'https://soundcloud.com/artist/track', 'stream_url': 'https://api/tracks/1/stream'}
+        service.session.get.return_value = make_response(json={'title': 'set', 'tracks': [track]})
+        service.resolve('https://soundcloud.com/artist/sets/set')
+        self.assertEqual(service.resolve('https://soundcloud.com/artist/track'), track)
+        self.assertEqual(service.session.get.call_count, 1)
+
+    def test_is_playlist(self):
+        service = Soundcloud()
+        self.assertTrue(service.is_playlist('https://soundcloud.com/artist/sets/set'))
+        self.assertFalse(service.is_playlist('https://soundcloud.com/artist/track'))
+
+    def test_expand_pages_remaining_tracks(self):
+        service = Soundcloud(page_size=2)
+        service.session = MagicMock()
+        tracks = [{'title': f"track {i}", 'permalink_url': f"https://soundcloud.com/artist/track-{i}",
+                   'stream_url': f"https://api/tracks/{i}/stream"} for i in range(5)]
+        service.session.get.side_effect = [
+            make_response(json={'id': 7, 'track_count': 5, 'tracks': tracks[:1] + [{'id': 1}, {'id': 2}]}),
+            make_response(json={'collection': tracks[1:3], 'next_href': 'https://api/playlists/7/tracks?cursor=3'}),
+            make_response(json={'collection': tracks[3:]}),
+        ]
+        urls = service.expand('https://soundcloud.com/artist/sets/set')
+        self.assertEqual(next(urls), tracks[0]['permalink_url'])
+        self.assertEqual(service.session.get.call_count, 1)
+        self.assertEqual(list(urls), [track['permalink_url'] for track in tracks[1:]])
+        self.assertEqual(service.session.get.call_args_list[1][1]['params']['offset'], 1)
+        service.session.get.assert_called_with('https://api/playlists/7/tracks?cursor=3', params={'client_id': service.client_id},
+                                               headers={'Accept': 'application/json'})
+        self.assertEqual(service.resolve(tracks[4]['permalink_url']), tracks[4])
+
+    def test_open_stream_refreshes_expired_location(self):
+        service = Soundcloud()
+        service.session = MagicMock()
+        service.resolved.set(service.track_id('https://soundcloud.com/artist/track'),
+                             {'title': 'track', 'stream_url': 'https://api/tracks/1/stream'})
+        service.locations.set('https://api/tracks/1/stream', 'https://cdn/expired')
+        stream = make_response()
+        service.session.get.side_effect = [make_response(403), make_response(302, headers={'location': 'https://cdn/fresh'}), stream]
+        title, chunks = service.open_stream('https://soundcloud.com/artist/track')
+        self.assertEqual(title, 'track')
+        self.assertEqual(chunks, stream.iter_content.return_value)
+        service.session.get.assert_called_with('https://cdn/fresh', stream=True)
+        self.assertEqual(service.locations.get('https://api/tracks/1/stream'), 'https://cdn/fresh')
+
+    def test_locate_fresh_looks_location_up_again(self):
+        service = Soundcloud()
+        service.session = MagicMock()
+        service.resolved.set(service.track_id('https://soundcloud.com/artist/track'),
+                             {'title': 'track', 'stream_url': 'https://api/tracks/1/stream'})
+        service.locations.set('https://api/tracks/1/stream', 'https://cdn/expired')
+        self.assertEqual(service.locate('https://soundcloud.com/artist/track'), ('https://cdn/expired', 'track.mp3', 'mp3'))
+        service.session.get.return_value = make_response(302, headers={'location': 'https://cdn/fresh'})
+        self.assertEqual(service.locate('https://soundcloud.com/artist/track', fresh=True), ('https://cdn/fresh', 'track.mp3', 'mp3'))
@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
 
-import queue
 from unittest import TestCase
 from unittest.mock import MagicMock
 
+from music2storage.queues import STOP, StageQueue
 from music2storage.worker import Worker
 
 
@@ -15,12 +15,24 @@ class TestWorker(TestCase):
         mocked_in_queue.get.return_value = 'next item'
         mocked_out_queue = MagicMock()
         mocked_stopper = MagicMock()
-        mocked_stopper.is_set.side_effect = [False, True]
+        mocked_stopper.is_set.side_effect = [False, False, True]
         worker = Worker(mocked_func, mocked_in_queue, mocked_out_queue, mocked_stopper)
         worker.run()
-        mocked_in_queue.get.assert_called_with(timeout=5)
+        mocked_in_queue.get.assert_called_with()
         mocked_func.assert_called_with('next item')
-        mocked_out_queue.put.assert_called_with('result')
+        mocked_out_queue.put.assert_called_with('result', timeout=1)
+
+    def test_worker_run_none_result(self):
+        mocked_func = MagicMock()
+        mocked_func.return_value = None
+        mocked_in_queue = MagicMock()
+        mocked_out_queue = MagicMock()
+        mocked_stopper = MagicMock()
+        mocked_stopper.is_set.side_effect = [False, True]
+        worker = Worker(mocked_func, mocked_in_queue, mocked_out_queue, mocked_stopper)
+        worker.run()
+        self.assertTrue(mocked_func.called)
+        self.assertFalse(mocked_out_queue.put.called)
 
     def test_worker_run_stopper_is_set(self):
         mocked_func = MagicMock()
@@ -34,28 +46,60 @@ class TestWorker(TestCase):
         self.assertFalse(mocked_func.called)
         self.assertFalse(mocked_out_queue.put.called)
 
-    def test_worker_run_empty_in_queue(self):
+    def test_worker_run_stop_sentinel(self):
         mocked_func = MagicMock()
         mocked_in_queue = MagicMock()
-        mocked_in_queue.get.side_effect = queue.Empty()
+        mocked_in_queue.get.return_value = STOP
         mocked_out_queue = MagicMock()
         mocked_stopper = MagicMock()
-        mocked_stopper.is_set.side_effect = [False, True]
+        mocked_stopper.is_set.return_value = False
         worker = Worker(mocked_func, mocked_in_queue, mocked_out_queue, mocked_stopper)
         worker.run()
-        mocked_in_queue.get.assert_called_with(timeout=5)
+        mocked_in_queue.get.assert_called_once_with()
         self.assertFalse(mocked_func.called)
         self.assertFalse(mocked_out_queue.put.called)
 
-    def test_worker_run_type_error(self):
+    def test_worker_stop_wakes_blocked_worker(self):
+        in_queue = StageQueue()
+        mocked_stopper = MagicMock()
+        mocked_stopper.is_set.return_value = False
+        worker = Worker(MagicMock(), in_queue, MagicMock(), mocked_stopper)
+        worker.start()
+        worker.stop()
+        worker.join(1)
+        self.assertFalse(worker.is_alive())
+
+    def test_worker_full_out_queue_stopper_set(self):
+        out_queue = StageQueue(1)
+        out_queue.put('waiting')
+        mocked_stopper = MagicMock()
+        mocked_stopper.is_set.side_effect = [False, False, True, True]
+        worker = Worker(MagicMock(return_value='result'), MagicMock(), out_queue, mocked_stopper, put_timeout=0.01)
+        worker.run()
+        self.assertEqual(out_queue.qsize(), 1)
+
+    def test_worker_run_exception(self):
         mocked_func = MagicMock()
-        mocked_func.side_effect = TypeError()
+        mocked_func.side_effect = [ValueError(), 'result']
         mocked_in_queue = MagicMock()
+        mocked_in_queue.get.side_effect = ['bad item', 'next item']
         mocked_out_queue = MagicMock()
         mocked_stopper = MagicMock()
-        mocked_stopper.is_set.side_effect = [False, True]
+        mocked_stopper.is_set.side_effect = [False, False, False, True]
         worker = Worker(mocked_func, mocked_in_queue, mocked_out_queue, mocked_stopper)
         worker.run()
-        mocked_in_queue.get.assert_called_with(timeout=5)
-        self.assertTrue(mocked_func.called)
+        self.assertEqual(mocked_func.call_count, 2)
+        mocked_out_queue.put.assert_called_once_with('result', timeout=1)
+
+    def test_worker_run_exception_on_error(self):
+        error = ValueError()
+        mocked_on_error = MagicMock(side_effect=RuntimeError())
+        mocked_in_queue = MagicMock()
+        mocked_in_queue.get.return_value = 'bad item'
+        mocked_out_queue = MagicMock()
+        mocked_stopper = MagicMock()
+        mocked_stopper.is_set.side_effect = [False, True]
+        worker = Worker(MagicMock(side_effect=error), mocked_in_queue, mocked_out_queue, mocked_stopper, on_error=mocked_on_error)
+        worker.run()
+        mocked_on_error.assert_called_once_with('bad item', error)
         self.assertFalse(mocked_out_queue.put.called)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import os
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import time
+from unittest import TestCase
+
+from music2storage.job import Job
+from music2storage.workspace import Sweeper, Workspace
+
+
+def write(path, size):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+
+
+class TestWorkspace(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.root = os.path.join(self.directory.name, 'scratch')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_every_job_has_its_own_directory(self):
+        workspace = Workspace(self.root)
+        first, second = Job('http://example.com/1'), Job('http://example.com/2')
+        write(os.path.join(workspace.admit(first), 'title.mp3'), 10)
+        write(os.path.join(workspace.admit(second), 'title.mp3'), 20)
+        self.assertEqual(os.path.getsize(os.path.join(self.root, Workspace.key(first), 'title.mp3')), 10)
+        self.assertEqual(os.path.getsize(os.path.join(self.root, Workspace.key(second), 'title.mp3')), 20)
+
+        workspace.remove(first)
+        self.assertEqual(os.listdir(self.root), [Workspace.key(second)])
+        self.assertEqual(workspace.stats()['jobs'], 1)
+
+    def test_kept_files_resumed_by_same_track(self):
+        workspace = Workspace(self.root)
+        failed = Job('http://example.com/1', track_id='youtube:id')
+        write(os.path.join(workspace.admit(failed), 'title.webm.part'), 10)
+        workspace.remove(failed, keep=True)
+        self.assertEqual(workspace.stats()['jobs'], 0)
+
+        retry = Job('http://example.com/2', track_id='youtube:id')
+        self.assertEqual(os.listdir(workspace.admit(retry)), ['title.webm.part'])
+        self.assertNotEqual(workspace.admit(Job('http://example.com/1')), workspace.directory(retry))
+
+    def test_admission_waits_for_budget(self):
+        workspace = Workspace(self.root, budget=64 * 1024, usage_ttl=0.01)
+        first, second = Job('http://example.com/1'), Job('http://example.com/2')
+        write(os.path.join(workspace.admit(first), 'title.mp3'), 128 * 1024)
+
+        admitted = Event()
+        thread = Thread(target=lambda: (workspace.admit(second), admitted.set()))
+        thread.start()
+        self.assertFalse(admitted.wait(0.1))
+        workspace.remove(first)
+        self.assertTrue(admitted.wait(1))
+        thread.join()
+
+    def test_kept_directories_evicted_oldest_first(self):
+        workspace = Workspace(self.root, budget=96 * 1024, usage_ttl=10)
+        running = Job('http://example.com/running')
+        write(os.path.join(workspace.admit(running), 'title.mp3'), 32 * 1024)
+        kept = [Job(f"http://example.com/{i}") for i in range(3)]
+        for age, job in enumerate(kept):
+            write(os.path.join(workspace.admit(job), 'title.webm.part'), 32 * 1024)
+            workspace.remove(job, keep=True)
+            mtime = time() - 100 * (3 - age)
+            os.utime(os.path.join(self.root, Workspace.key(job)), (mtime, mtime))
+
+        workspace.admit(Job('http://example.com/new'))
+        remaining = set(os.listdir(self.root))
+        self.assertIn(Workspace.key(running), remaining)
+        self.assertNotIn(Workspace.key(kept[0]), remaining)
+        self.assertNotIn(Workspace.key(kept[1]), remaining)
+        self.assertIn(Workspace.key(kept[2]), remaining)
+
+    def test_lone_job_admitted_over_budget(self):
+        workspace = Workspace(self.root, budget=1)
+        write(os.path.join(self.root, 'leftover'), 4096)
+        job = Job('http://example.com/')
+        self.assertEqual(workspace.admit(job), os.path.join(self.root, Workspace.key(job)))
+
+    def test_admission_stops_with_stopper(self):
+        workspace = Workspace(self.root, budget=1, usage_ttl=0.01)
+        write(os.path.join(workspace.admit(Job('http://example.com/1')), 'title.mp3'), 4096)
+        stopper = Event()
+        stopper.set()
+        workspace.admit(Job('http://example.com/2'), stopper)
+
+    def test_sweep_removes_old_orphans_only(self):
+        workspace = Workspace(self.root, orphan_age=60)
+        active = Job('http://example.com/')
+        workspace.admit(active)
+        os.makedirs(os.path.join(self.root, 'crashed'))
+        write(os.path.join(self.root, 'crashed', 'title.webm'), 10)
+        write(os.path.join(self.root, 'title.webm'), 10)
+        os.makedirs(os.path.join(self.root, 'recent'))
+        old = time() - 120
+        for name in ('crashed', 'title.webm', Workspace.key(active)):
+            os.utime(os.path.join(self.root, name), (old, old))
+
+        self.assertEqual(workspace.sweep(), 2)
+        self.assertEqual(sorted(os.listdir(self.root)), sorted([Workspace.key(active), 'recent']))
+        self.assertEqual(workspace.stats()['swept'], 2)
+
+    def test_kept_jobs_are_not_swept(self):
+        workspace = Workspace(self.root, orphan_age=0)
+        job = Job('http://example.com/')
+        os.makedirs(os.path.join(self.root, Workspace.key(job)))
+        workspace.keep(job)
+        self.assertEqual(workspace.sweep(), 0)
+
+
+class TestSweeper(TestCase):
+    def test_sweeps_right_away_until_stopped(self):
+        with TemporaryDirectory() as directory:
+            workspace = Workspace(directory, orphan_age=0)
+            os.makedirs(os.path.join(directory, 'crashed'))
+            stopper = Event()
+            sweeper = Sweeper(workspace, stopper, interval=60)
+            sweeper.start()
+            stopper.set()
+            sweeper.join(1)
+            self.assertFalse(sweeper.is_alive())
+            self.assertEqual(os.listdir(directory), [])
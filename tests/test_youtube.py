@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from music2storage.youtube import Youtube
+
+
+def make_stream(abr, audio_codec='opus'):
+    stream = MagicMock()
+    stream.abr = abr
+    stream.audio_codec = audio_codec
+    stream.default_filename = f"title {abr}.webm"
+    return stream
+
+
+class TestYoutube(TestCase):
+    def make_video(self, *abrs):
+        yt = MagicMock()
+        yt.streams.filter.return_value = [make_stream(abr) for abr in abrs]
+        return yt
+
+    def test_select_stream_best_audio(self):
+        yt = self.make_video('160kbps', '50kbps', '128kbps')
+        self.assertEqual(Youtube().select_stream(yt).abr, '160kbps')
+        yt.streams.filter.assert_called_with(only_audio=True)
+
+    def test_select_stream_under_ceiling(self):
+        yt = self.make_video('160kbps', '50kbps', '128kbps')
+        self.assertEqual(Youtube(max_abr=130).select_stream(yt).abr, '128kbps')
+        self.assertEqual(Youtube(max_abr=10).select_stream(yt).abr, '50kbps')
+
+    def test_select_stream_smallest_above_floor(self):
+        yt = self.make_video('160kbps', '50kbps', '128kbps')
+        self.assertEqual(Youtube(min_abr=100).select_stream(yt).abr, '128kbps')
+        self.assertEqual(Youtube(min_abr=200).select_stream(yt).abr, '160kbps')
+        self.assertEqual(Youtube(min_abr=200, max_abr=130).select_stream(yt).abr, '128kbps')
+
+    def test_select_stream_without_audio_only(self):
+        yt = self.make_video()
+        self.assertEqual(Youtube().select_stream(yt), yt.streams.first.return_value)
+
+    @patch('music2storage.youtube.YouTube')
+    def test_download_records_codec(self, mocked_youtube):
+        mocked_youtube.return_value.streams.filter.return_value = [make_stream('160kbps', 'opus')]
+        youtube = Youtube()
+        youtube.downloader = MagicMock()
+        youtube.downloader.download.side_effect = lambda url, file_name: file_name
+        file_name = youtube.download('https://www.youtube.com/watch?v=DhHGDOgjie4')
+        stream = mocked_youtube.return_value.streams.filter.return_value[0]
+        youtube.downloader.download.assert_called_with(stream.url, 'title 160kbps.webm')
+        self.assertEqual(file_name, 'title 160kbps.webm')
+        self.assertEqual(youtube.codec(file_name), 'opus')
+        self.assertIsNone(youtube.codec(file_name))
+
+    @patch('music2storage.youtube.YouTube')
+    def test_download_into_directory(self, mocked_youtube):
+        mocked_youtube.return_value.streams.filter.return_value = [make_stream('160kbps', 'opus')]
+        youtube = Youtube()
+        youtube.downloader = MagicMock()
+        file_name = youtube.download('https://www.youtube.com/watch?v=DhHGDOgjie4', '/scratch/job')
+        self.assertEqual(file_name, '/scratch/job/title 160kbps.webm')
+        youtube.downloader.download.assert_called_with(mocked_youtube.return_value.streams.filter.return_value[0].url, file_name)
+        self.assertEqual(youtube.codec(file_name), 'opus')
+
+    @patch('music2storage.youtube.YouTube')
+    def test_locate(self, mocked_youtube):
+        mocked_youtube.return_value.streams.filter.return_value = [make_stream('160kbps', 'opus')]
+        media = Youtube().locate('https://www.youtube.com/watch?v=DhHGDOgjie4')
+        stream = mocked_youtube.return_value.streams.filter.return_value[0]
+        self.assertEqual(media, (stream.url, 'title 160kbps.webm', 'opus'))
+
+    def test_handles_youtube_hosts(self):
+        youtube = Youtube()
+        self.assertTrue(youtube.handles('https://www.youtube.com/watch?v=DhHGDOgjie4'))
+        self.assertTrue(youtube.handles('https://youtu.be/DhHGDOgjie4'))
+        self.assertFalse(youtube.handles('https://soundcloud.com/artist/track'))
+        self.assertFalse(youtube.handles('https://notyoutube.com/watch?v=DhHGDOgjie4'))
+
+    def test_is_playlist(self):
+        youtube = Youtube()
+        self.assertTrue(youtube.is_playlist('https://www.youtube.com/playlist?list=PL590L5WQmH8fJ54F369BLDSqIwcs-TCfs'))
+        self.assertFalse(youtube.is_playlist('https://www.youtube.com/watch?v=DhHGDOgjie4&list=PL590L5WQmH8fJ54F369BLDSqIwcs-TCfs'))
+        self.assertFalse(youtube.is_playlist('https://www.youtube.com/watch?v=DhHGDOgjie4'))
+
+    @patch('music2storage.youtube.Playlist')
+    def test_expand_pages_lazily(self, mocked_playlist):
+        mocked_playlist.return_value.url_generator.return_value = iter(['https://www.youtube.com/watch?v=1'])
+        urls = Youtube().expand('https://www.youtube.com/playlist?list=PL')
+        mocked_playlist.assert_not_called()
+        self.assertEqual(list(urls), ['https://www.youtube.com/watch?v=1'])
+        mocked_playlist.assert_called_with('https://www.youtube.com/playlist?list=PL')
+
+    def test_track_id_same_for_every_url_form(self):
+        youtube = Youtube()
+        urls = [
+            'https://www.youtube.com/watch?v=DhHGDOgjie4',
+            'https://m.youtube.com/watch?v=DhHGDOgjie4&t=42s',
+            'https://youtu.be/DhHGDOgjie4',
+            'https://www.youtube.com/embed/DhHGDOgjie4',
+            'https://www.youtube.com/shorts/DhHGDOgjie4',
+        ]
+        for url in urls:
+            self.assertEqual(youtube.track_id(url), 'youtube:DhHGDOgjie4')